@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Admission control for the API. Every request is classified into a lane (control mutations, reads, bulk/debug) and
+# each lane admits a bounded number of requests at a time with a bounded queue behind it. A full queue, or a request
+# queued for too long, is shed with 503 so a script hammering reads cannot starve interactive control calls.
+# Lanes live on the event loop and are only touched from it, no locking needed.
+
+import asyncio
+from collections import deque
+
+CONTROL = "control"
+READ = "read"
+BULK = "bulk"
+
+LANES = (CONTROL, READ, BULK)
+
+# Bulk lane: requests doing a lot of work at once or holding their slot a long time, besides any long-poll
+BULK_REQUESTS = (("POST", "/batch"), ("POST", "/config"), ("GET", "/jobs"), ("GET", "/status/events"), \
+				 ("GET", "/docs"), ("GET", "/redoc"), ("GET", "/openapi.json"))
+
+# Never queued nor shed: liveness checks and the lane metrics themselves
+EXEMPT_PATHS = ("/ping", "/admission")
+
+
+def classify(method, path, query):
+	"""Lane for a request, None when it bypasses admission control"""
+	if path in EXEMPT_PATHS:
+		return None
+	if "wait" in query or (method, path) in BULK_REQUESTS:
+		return BULK
+	if method in ("GET", "HEAD"):
+		return READ
+	return CONTROL
+
+
+class Lane(object):
+
+	def __init__(self, name, concurrency, queue_depth, queue_timeout):
+		self.name = name
+		self.concurrency = concurrency
+		self.queue_depth = queue_depth
+		self.queue_timeout = queue_timeout
+
+		self.active = 0
+		self.waiters = deque()	# futures of queued requests, first in first out
+
+		self.admitted = 0
+		self.rejected = 0
+		self.timed_out = 0
+		self.peak_queued = 0
+
+	async def acquire(self):
+		"""True once the request may run, False when it has to be shed"""
+		if self.active < self.concurrency and not self.waiters:
+			self.active += 1
+			self.admitted += 1
+			return True
+
+		if len(self.waiters) >= self.queue_depth:
+			self.rejected += 1
+			return False
+
+		waiter = asyncio.get_running_loop().create_future()
+		self.waiters.append(waiter)
+		self.peak_queued = max(self.peak_queued, len(self.waiters))
+		try:
+			await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+		except asyncio.TimeoutError:
+			if waiter.done():
+				# Handed a slot just as the wait ran out, take it
+				self.admitted += 1
+				return True
+			self.waiters.remove(waiter)
+			self.timed_out += 1
+			return False
+		except asyncio.CancelledError:
+			# Client gone while queued, pass on a slot it may just have been handed
+			if waiter.done():
+				self.release()
+			else:
+				self.waiters.remove(waiter)
+			raise
+
+		self.admitted += 1
+		return True
+
+	def release(self):
+		# Hand the slot straight to the next queued request, active only drops when nobody is waiting
+		while self.waiters:
+			waiter = self.waiters.popleft()
+			if not waiter.done():
+				waiter.set_result(None)
+				return
+		self.active -= 1
+
+	def metrics(self):
+		return {
+			"concurrency": self.concurrency,
+			"queue_depth": self.queue_depth,
+			"active": self.active,
+			"queued": len(self.waiters),
+			"peak_queued": self.peak_queued,
+			"admitted": self.admitted,
+			"rejected": self.rejected,
+			"timed_out": self.timed_out,
+		}
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Hot reload of config.ini. The directory holding the file is watched with inotify (falling back to polling its mtime
+# where inotify is not available); once an edit has settled, the file is parsed again and diffed section by section
+# against what the server last loaded. Changed values of live subsystems are validated against their schemas and
+# applied as one bulk config change, then every subsystem gets apply_config with the keys that changed: a running
+# process restarts when one of them is on its command line, everything else is left alone.
+#
+# Changes which cannot be applied live (new or removed keys, s_class, l_requires, read-only keys, [server], services)
+# and sections with invalid values are reported and kept pending until the next restart; the config writer leaves the
+# edited values in the file alone meanwhile. A reload and a write of the config writer never overlap (server.config_lock).
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from configparser import ConfigParser, Error as ConfigError
+from threading import Thread
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct("iIII")	# wd, mask, cookie, name length
+
+
+def inotify(directory):
+	"""Non-blocking inotify descriptor watching directory for files written or renamed into it"""
+	libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+	fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+	if fd < 0:
+		raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+	if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+		errno = ctypes.get_errno()
+		os.close(fd)
+		raise OSError(errno, "inotify_add_watch failed on {}".format(directory))
+	return fd
+
+
+def changed_names(data):
+	names = set()
+	offset = 0
+	while offset + EVENT.size <= len(data):
+		wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+		offset += EVENT.size
+		names.add(data[offset:offset + length].rstrip(b"\0").decode(errors="replace"))
+		offset += length
+	return names
+
+
+class ConfigWatcher(Thread):
+
+	def __init__(self, server, path, settle):
+		Thread.__init__(self, name="configwatch")
+		self.server = server
+		self.path = path
+		self.settle = settle
+		self.running = True
+
+		self.reloads = 0
+		self.last_reload = None
+
+	def _changed(self, fd):
+		"""Wait up to half a second for config.ini to change"""
+		if fd is None:
+			# Polling fallback
+			time.sleep(0.5)
+			try:
+				mtime = os.stat(self.path).st_mtime_ns
+			except OSError:
+				return False
+			changed, self.mtime = mtime != self.mtime, mtime
+			return changed
+		readable, _, _ = select.select([fd], [], [], 0.5)
+		if not readable:
+			return False
+		try:
+			return os.path.basename(self.path) in changed_names(os.read(fd, 65536))
+		except BlockingIOError:
+			return False
+
+	def run(self):
+		try:
+			fd = inotify(os.path.dirname(self.path))
+		except (OSError, AttributeError) as e:
+			print("inotify not available ({}), polling {} instead".format(e, self.path))
+			fd = None
+			self.mtime = os.stat(self.path).st_mtime_ns
+
+		try:
+			while self.running:
+				if not self._changed(fd):
+					continue
+				# Editors write in several steps, reload once the file was left alone for a moment
+				settled = time.monotonic() + self.settle
+				while self.running and time.monotonic() < settled:
+					if self._changed(fd):
+						settled = time.monotonic() + self.settle
+				if self.running:
+					self.reload()
+		finally:
+			if fd is not None:
+				os.close(fd)
+
+	def reload(self):
+		# Not while the config writer writes the file, the server's parser is replaced here
+		with self.server.config_lock:
+			return self._reload()
+
+	def _reload(self):
+		parser = ConfigParser()
+		try:
+			mtime = os.stat(self.path).st_mtime_ns	# Before reading, an edit landing meanwhile is newer
+			with open(self.path) as f:
+				parser.read_file(f)
+		except (OSError, ConfigError) as e:
+			print("Not reloading {}: {}".format(self.path, e))
+			return
+		self.server.config_mtime = mtime
+		current = self.server.configurator
+
+		changes = {}	# s_id -> {key: parsed value} applied live
+		pending = {}	# section -> keys waiting for a restart
+		errors = []
+		for section in set(parser.sections()) | set(current.sections()):
+			old = dict(current.items(section)) if current.has_section(section) else {}
+			new = dict(parser.items(section)) if parser.has_section(section) else {}
+			if old == new:
+				continue
+			changed = {key for key in set(old) | set(new) if old.get(key) != new.get(key)}
+			if section.startswith("profile."):
+				continue	# Read from the configurator whenever a profile is applied
+
+			if section not in self.server.sections and not parser.has_option(section, "s_class") and section not in ("server", "hardware"):
+				continue	# Not loaded by the server, before nor after the edit
+
+			system = getattr(self.server, section) if section in self.server.api_sections else None
+			if system is None or set(old) != set(new):
+				pending[section] = changed
+				continue
+			live = {}
+			section_errors = []
+			schema = self.server.schemas[section]
+			for key in changed:
+				field = schema.fields[key]
+				if field.read_only:
+					pending.setdefault(section, set()).add(key)
+					continue
+				try:
+					live[key] = field.parse(new[key])
+				except (ValueError, TypeError) as e:
+					section_errors.append("[{}] {} = {}: {}".format(section, key, new[key], e))
+			if section_errors:
+				# A section with an invalid value is not applied at all, like at boot
+				errors += section_errors
+				pending.setdefault(section, set()).update(changed)
+			elif live:
+				changes[system.config["s_id"]] = live
+
+		if not changes and not pending and not errors:
+			return None	# Written by the config writer, or only profiles changed
+		result = {"applied": {}, "restarted": [], "pending": {section: sorted(keys) for section, keys in pending.items()}, "errors": errors}
+		if changes:
+			try:
+				update = self.server.update_config(changes, persist=False).result()
+			except RuntimeError as e:
+				update = {"success": False, "response": ["Not applied: {}".format(e)]}	# Executor shut down
+			if not update["success"]:
+				result["errors"] += update["response"]
+				result["pending"].update({s_id: sorted(values) for s_id, values in changes.items()})
+				changes = {}
+			result["applied"] = {s_id: sorted(values) for s_id, values in changes.items()}
+
+		# The file is what the server now runs with, or will after a restart: the config writer keeps what was edited
+		for section, keys in result["pending"].items():
+			self.server.pending_restart.setdefault(section, set()).update(keys)
+		self.server.configurator = parser
+
+		futures = {}
+		for s_id, values in changes.items():
+			system = self.server.systems_by_id[s_id]
+			if hasattr(system, "apply_config"):
+				try:
+					futures[s_id] = self.server.executor.submit(s_id, system.apply_config, sorted(values))
+				except RuntimeError as e:
+					result["errors"].append("[{}] restart failed: {}".format(s_id, e))
+		for s_id, future in futures.items():
+			try:
+				if future.result().get("restarted"):
+					result["restarted"].append(s_id)
+			except Exception as e:
+				result["errors"].append("[{}] restart failed: {}".format(s_id, e))
+
+		self.reloads += 1
+		self.last_reload = result
+		print("Reloaded {}: {}".format(self.path, result))
+		return result
+
+	def get_status(self):
+		return {"success": True, "status": {"reloads": self.reloads, "last_reload": self.last_reload}}
+
+	def _shutdown_thread(self):
+		self.running = False
+		self.join()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Debounced, atomic persistence of config.ini. Saving only marks the file dirty; the writer thread waits until no save
+# was requested for f_save_debounce seconds (or f_save_max_delay passed since the first one) and then writes the current
+# config of every subsystem once, however many keys changed in the burst. The file is written next to config.ini,
+# fsynced and renamed over it, so a power cut leaves either the old or the new file on the SD card, never half of one.
+# A hand edit made since the file was last loaded is taken in first (see _merge_edits), never overwritten.
+
+import json
+import os
+import time
+from configparser import ConfigParser
+from threading import Condition, Lock, Thread
+
+
+def format_value(key, value):
+	"""config.ini text of a typed config value, the inverse of the parsers in schema.py"""
+	type_tag = key[:2]
+	if type_tag == "b_":
+		return "yes" if value else "no"
+	if type_tag == "l_":
+		return json.dumps(value)
+	return str(value)
+
+
+class ConfigWriter(Thread):
+
+	def __init__(self, server, path, debounce, max_delay):
+		Thread.__init__(self, name="configwriter")
+		self.server = server
+		self.path = path
+		self.debounce = debounce
+		self.max_delay = max_delay
+
+		self.condition = Condition()
+		self.first_request = None	# monotonic time of the first save of the pending burst, None when nothing is pending
+		self.last_request = None
+		self.running = True
+		self.write_lock = Lock()	# one write at a time, taken by the thread and by flush
+
+		self.saves = 0
+		self.requests = 0
+		self.last_error = None
+
+	def request(self):
+		"""Ask for config.ini to be written, returns right away"""
+		with self.condition:
+			now = time.monotonic()
+			if self.first_request is None:
+				self.first_request = now
+			self.last_request = now
+			self.requests += 1
+			self.condition.notify()
+
+	def _take_pending(self):
+		# With the condition held: wait for a burst to settle, True when there is something to write
+		while self.running and self.first_request is None:
+			self.condition.wait()
+		while self.running and self.first_request is not None:	# flush may take the burst meanwhile
+			due = min(self.last_request + self.debounce, self.first_request + self.max_delay)
+			remaining = due - time.monotonic()
+			if remaining <= 0:
+				break
+			self.condition.wait(remaining)
+		pending = self.first_request is not None
+		self.first_request = self.last_request = None
+		return pending
+
+	def _merge_edits(self):
+		"""Take in an edit made to config.ini since it was last loaded or written, instead of overwriting it"""
+		watcher = self.server.config_watcher
+		if watcher is not None and watcher.running:
+			watcher.reload()	# Applied to the subsystems right away, as it would be once the watcher sees it
+			if os.stat(self.path).st_mtime_ns == self.server.config_mtime:
+				return
+			raise RuntimeError("{} was edited and cannot be reloaded, not overwriting it".format(self.path))
+
+		# Without hot reload the edited values wait for a restart, like edits the watcher cannot apply live
+		mtime = os.stat(self.path).st_mtime_ns
+		parser = ConfigParser()
+		with open(self.path) as f:
+			parser.read_file(f)
+		current = self.server.configurator
+		for section in set(parser.sections()) | set(current.sections()):
+			old = dict(current.items(section)) if current.has_section(section) else {}
+			new = dict(parser.items(section)) if parser.has_section(section) else {}
+			changed = {key for key in set(old) | set(new) if old.get(key) != new.get(key)}
+			if changed:
+				self.server.pending_restart.setdefault(section, set()).update(changed)
+		self.server.configurator = parser
+		self.server.config_mtime = mtime
+
+	def write(self):
+		with self.server.config_lock:
+			if os.stat(self.path).st_mtime_ns != self.server.config_mtime:
+				self._merge_edits()
+			self._write()
+
+	def _write(self):
+		snapshot = self.server.snapshot()
+		configurator = self.server.configurator
+		for s_id, config, status in snapshot.systems:
+			if configurator.has_section(s_id):
+				# Edits to config.ini waiting for a restart stay as they were written, see configwatch.py
+				pending = self.server.pending_restart.get(s_id, ())
+				for key, value in config.items():
+					if key not in pending:
+						configurator.set(s_id, key, format_value(key, value))
+
+		# A copy is written, the server's parser keeps being read while the file is on its way out
+		parser = ConfigParser()
+		parser.read_dict(configurator)
+		temporary = "{}.tmp".format(self.path)
+		with open(temporary, "w") as f:
+			parser.write(f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(temporary, self.path)
+		self.server.config_mtime = os.stat(self.path).st_mtime_ns
+		# The rename itself is only durable once the directory is synced
+		directory = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+		try:
+			os.fsync(directory)
+		finally:
+			os.close(directory)
+		self.saves += 1
+
+	def _write_pending(self):
+		with self.write_lock:
+			try:
+				self.write()
+				self.last_error = None
+			except Exception as e:
+				self.last_error = str(e)
+				print("Could not save {}: {}".format(self.path, e))
+
+	def run(self):
+		while True:
+			with self.condition:
+				pending = self._take_pending()
+				running = self.running
+			if pending:
+				self._write_pending()
+			if not running:
+				break
+
+	def flush(self):
+		"""Write a pending save right away, e.g. for a client waiting for the file"""
+		with self.condition:
+			pending = self.first_request is not None
+			self.first_request = self.last_request = None
+		if pending:
+			self._write_pending()
+		else:
+			# A write the thread already started is waited for
+			with self.write_lock:
+				pass
+		return {"success": self.last_error is None, "response": self.last_error or "Saved"}
+
+	def get_status(self):
+		with self.condition:
+			pending = self.first_request is not None
+		return {"success": True, "status": {"pending": pending, "requests": self.requests, "saves": self.saves, "error": self.last_error}}
+
+	def _shutdown_thread(self):
+		# A burst still settling is written before the server goes down
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		self.join()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# ZMQ ROUTER command channel next to the HTTP API, for clients which need button-press-to-action latency the HTTP stack
+# cannot give on a Pi. A request is [request id, operation, body] from a DEALER socket, the reply is [request id, body]:
+# the id is opaque bytes chosen by the client and echoed back, the body compact JSON. Replies come back as soon as
+# their operation is done, so a client can pipeline many commands over one connection and match them up by id.
+# Blocking subsystem actions go through the subsystem executor exactly like the HTTP routes; their replies are handed
+# back to the channel thread, which alone touches the ZMQ socket.
+
+import json
+import queue
+import socket
+from concurrent.futures import Future
+from threading import Thread
+
+from systems import bind_ipc
+
+
+def encode(value):
+	return json.dumps(value, separators=(",", ":"), default=str).encode('utf-8')
+
+
+class ControlChannel(Thread):
+
+	def __init__(self, server, endpoint, ipc_endpoint):
+		Thread.__init__(self, name="control")
+		self.server = server
+		self.endpoint = endpoint
+		self.ipc_endpoint = ipc_endpoint
+
+		# Replies of operations finishing on worker threads, the wake socket pair interrupts the poll for them
+		self.replies = queue.SimpleQueue()
+		self.wake_receiver, self.wake_sender = socket.socketpair()
+		self.wake_receiver.setblocking(False)
+
+		self.operations = {
+			"ping":				lambda body: {"success": True, "response": "pong"},
+			"systems":			lambda body: self.server.get_systems(),
+			"status":			lambda body: self._view("status", body),
+			"config":			lambda body: self._view("config", body),
+			"configstatus":		lambda body: self._view("configstatus", body),
+			"save_config":		self._save_config,
+			"update_config":	lambda body: self.server.update_config(body["changes"], body.get("persist", True)),
+			"call":				self._call,
+			"job":				lambda body: self.server.jobs.get(body["id"]),
+			"jobs":				lambda body: self.server.jobs.list(body.get("system")),
+			"cancel_job":		lambda body: self.server.jobs.cancel(body["id"]),
+			"profiles":			lambda body: self.server.profiles.get_profiles(),
+			"apply_profile":	lambda body: self.server.apply_profile(body["name"], job=body.get("job", False)),
+		}
+
+		self.running = True
+
+	def _view(self, name, body):
+		# Already encoded once per state version for the HTTP readers, sent as is
+		systems = tuple(body["systems"]) if body.get("systems") else None
+		fields = tuple(body["fields"]) if body.get("fields") else None
+		return self.server.snapshot().json(name, systems, fields)
+
+	def _save_config(self, body):
+		if body.get("wait"):
+			# Writing the file blocks, the reply comes once it is on the SD card
+			return self.server.executor.submit("config", self.server.save_config, True)
+		return self.server.save_config()
+
+	def _call(self, body):
+		return self.server.invoke(body["system"], body["function"], body.get("args"), job=body.get("job", False), timeout=body.get("timeout"))
+
+	def run(self):
+		import zmq
+		self.context = zmq.Context()
+		self.socket = self.context.socket(zmq.ROUTER)
+		self.socket.setsockopt(zmq.LINGER, 0)
+		self.socket.bind(self.endpoint)
+		bind_ipc(self.socket, self.ipc_endpoint)
+
+		poller = zmq.Poller()
+		poller.register(self.socket, zmq.POLLIN)
+		poller.register(self.wake_receiver, zmq.POLLIN)
+
+		while self.running:
+			events = dict(poller.poll(500))
+			if self.socket in events:
+				while True:
+					try:
+						frames = self.socket.recv_multipart(zmq.NOBLOCK)
+					except zmq.Again:
+						break
+					self._handle(frames)
+
+			if self.wake_receiver in events:
+				try:
+					while self.wake_receiver.recv(4096):
+						pass
+				except BlockingIOError:
+					pass
+
+			while True:
+				try:
+					frames = self.replies.get_nowait()
+				except queue.Empty:
+					break
+				self.socket.send_multipart(frames)
+
+		self.socket.close()
+		self.context.term()
+
+	def _handle(self, frames):
+		if len(frames) < 3:
+			return	# Not even a request id to answer to
+		identity, request_id, operation = frames[:3]
+
+		try:
+			body = json.loads(frames[3]) if len(frames) > 3 and frames[3] else {}
+			handler = self.operations.get(operation.decode())
+			if handler is None:
+				result = {"success": False, "response": "Unknown operation {}".format(operation.decode(errors="replace"))}
+			else:
+				result = handler(body)
+		except Exception as e:
+			result = {"success": False, "response": str(e)}
+
+		if isinstance(result, Future):
+			result.add_done_callback(lambda future: self._reply_later(identity, request_id, future))
+		else:
+			self.socket.send_multipart([identity, request_id, result if isinstance(result, bytes) else encode(result)])
+
+	def _reply_later(self, identity, request_id, future):
+		# Runs on the worker thread that finished the action
+		try:
+			result = future.result()
+		except Exception as e:
+			result = {"success": False, "response": str(e)}
+		self.replies.put([identity, request_id, encode(result)])
+		try:
+			self.wake_sender.send(b"\0")
+		except OSError:
+			pass	# Channel already closed
+
+	def _shutdown_thread(self):
+		self.running = False
+		self.join()
+		self.wake_sender.close()
+		self.wake_receiver.close()
@@ -4,37 +4,160 @@
 __author__ = 'Tom Mladenov'
 
 # TODO: UNPICKLE
+import itertools
 import json
+import os
 import pickle
-from threading import Thread
+import socket
+import struct
+import time
+from threading import Lock, Thread
 import sys
 
 import requests
 import zmq
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+# Same-host transports of the server, see s_unix_socket and s_ipc_endpoint in config.ini
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+UNIX_SOCKET = "/tmp/cyberdeck/api.sock"
+IPC_ENDPOINT = "ipc:///tmp/cyberdeck/publisher"
+CONTROL_IPC = "ipc:///tmp/cyberdeck/control"
+
+
+class UnixConnection(HTTPConnection):
+
+    def __init__(self, socket_path, **kwargs):
+        HTTPConnection.__init__(self, "localhost", **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout if isinstance(self.timeout, (int, float)) else None)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class UnixConnectionPool(HTTPConnectionPool):
+
+    def __init__(self, socket_path):
+        HTTPConnectionPool.__init__(self, "localhost")
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        return UnixConnection(self.socket_path, timeout=self.timeout.connect_timeout)
+
+
+class UnixAdapter(HTTPAdapter):
+
+    # Sends every request of the session over the server's Unix domain socket, whatever host the URL names
+
+    def __init__(self, socket_path):
+        HTTPAdapter.__init__(self)
+        self.pool = UnixConnectionPool(socket_path)
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.pool
+
+    def close(self):
+        self.pool.close()
+
+
+class ControlClient(object):
+
+    # DEALER side of the server's ZMQ command channel (control.py). submit() sends a command and returns its request id
+    # without waiting, so many commands can be in flight at once; result() collects the reply for one id.
+
+    def __init__(self, context, endpoint, timeout=5.0):
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(endpoint)
+        self.timeout = timeout
+
+        self.lock = Lock()
+        self.ids = itertools.count(1)
+        self.replies = {}       # request id -> reply body received while waiting for another one
+        self.abandoned = set()  # request ids which timed out, their late replies are dropped
+
+    def submit(self, operation, **body):
+        request_id = next(self.ids)
+        with self.lock:
+            self.socket.send_multipart([struct.pack("!Q", request_id), operation.encode(), json.dumps(body, separators=(",", ":")).encode('utf-8')])
+        return request_id
+
+    def result(self, request_id, timeout=None):
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        with self.lock:
+            while request_id not in self.replies:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.socket.poll(int(remaining * 1000)):
+                    self.abandoned.add(request_id)
+                    return {"success": False, "response": "No reply to control request {}".format(request_id)}
+                reply_id, body = self.socket.recv_multipart()
+                reply_id = struct.unpack("!Q", reply_id)[0]
+                if reply_id in self.abandoned:
+                    self.abandoned.discard(reply_id)
+                else:
+                    self.replies[reply_id] = body
+            return json.loads(self.replies.pop(request_id))
+
+    def call(self, operation, **body):
+        return self.result(self.submit(operation, **body))
+
+    def close(self):
+        self.socket.close()
 
 
 class RemoteCyberdeck(Thread):
 
-    def __init__(self, ip, http_port, zmq_port):
+    def __init__(self, ip, http_port, zmq_port, control_port=None, unix_socket=UNIX_SOCKET, ipc_endpoint=IPC_ENDPOINT, control_ipc=CONTROL_IPC):
         Thread.__init__(self)
 
         self.ip = ip
         self.http_port = http_port
 
+        # On the deck itself, talk to the server over its Unix socket and ipc:// publisher instead of TCP loopback
+        local = ip in LOCAL_HOSTS
+        self.session = requests.Session()
+        self.base_url = 'http://{}:{}'.format(ip, http_port)
+        if local and unix_socket and os.path.exists(unix_socket):
+            self.session.mount('http://', UnixAdapter(unix_socket))
+
         self.connected = False
 
+        # path -> (ETag, body) of the last full response, replayed when the server answers 304 Not Modified
+        self.etags = {}
+        # State version of the last /status, /config or /configstatus response, pass it as since to long-poll
+        self.state_version = None
+
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.SUB)
-        self.host = 'tcp://' + ip + ':' + str(zmq_port)
+        if local and ipc_endpoint and os.path.exists(ipc_endpoint[len("ipc://"):]):
+            self.host = ipc_endpoint
+        else:
+            self.host = 'tcp://' + ip + ':' + str(zmq_port)
         self.socket.connect(self.host)
         self.socket.setsockopt_string(zmq.SUBSCRIBE, "")
         self.socket.setsockopt(zmq.RCVTIMEO, 5000)
 
+        # With a control_port, subsystem actions and status reads go over the ZMQ command channel instead of HTTP
+        self.control = None
+        if control_port:
+            if local and control_ipc and os.path.exists(control_ipc[len("ipc://"):]):
+                self.control = ControlClient(self.context, control_ipc)
+            else:
+                self.control = ControlClient(self.context, 'tcp://{}:{}'.format(ip, control_port))
+
         self.active = True
 
-    def _put_request(self, path, params=None):
+    def _put_request(self, path, params=None, body=None):
         try:
-            r = requests.put('http://{}:{}{}'.format(self.ip, self.http_port, path), params=params)
+            r = self.session.put(self.base_url + path, params=params, json=body)
             if r.status_code == 200:
                 return r.json()  # Server responded with a success status
             else:
@@ -44,17 +167,24 @@ class RemoteCyberdeck(Thread):
 
     def _get_request(self, path, params=None):
         try:
-            r = requests.get('http://{}:{}{}'.format(self.ip, self.http_port, path), params=params)
+            headers = {"If-None-Match": self.etags[path][0]} if path in self.etags else None
+            r = self.session.get(self.base_url + path, params=params, headers=headers)
+            if "X-State-Version" in r.headers:
+                self.state_version = int(r.headers["X-State-Version"])
             if r.status_code == 200:
+                if "ETag" in r.headers:
+                    self.etags[path] = (r.headers["ETag"], r.json())
                 return r.json()
+            elif r.status_code == 304:
+                return self.etags[path][1]
             else:
                 return {"success": False, "response": r.status_code}
         except Exception as e:
             return {"success": False, "response": str(e)}
 
-    def _post_request(self, path, params=None):
+    def _post_request(self, path, params=None, body=None):
         try:
-            r = requests.post('http://{}:{}{}'.format(self.ip, self.http_port, path), params=params)
+            r = self.session.post(self.base_url + path, params=params, json=body)
             if r.status_code == 200:
                 return r.json()
             else:
@@ -62,92 +192,168 @@ class RemoteCyberdeck(Thread):
         except Exception as e:
             return {"success": False, "response": str(e)}
 
+    def _delete_request(self, path, params=None):
+        try:
+            r = self.session.delete(self.base_url + path, params=params)
+            if r.status_code == 200:
+                return r.json()
+            else:
+                return {"success": False, "response": r.status_code}
+        except Exception as e:
+            return {"success": False, "response": str(e)}
+
+    def _invoke(self, system, function, args=None, path=None, params=None, method="put", job=False):
+        # Over the control channel when there is one, otherwise through the HTTP route at path
+        if self.control is not None:
+            return self.control.call("call", system=system, function=function, args=args or [], job=job)
+        return getattr(self, "_{}_request".format(method))(path=path, params=params)
+
+    def _view(self, name, system, since, wait, systems, fields):
+        if system:
+            return self._invoke(system, "get_{}".format(name), path="/systems/{}/{}".format(system, name), method="get")
+        if self.control is not None and not wait:
+            # Long-polls stay on HTTP, they would hold up the replies pipelined behind them
+            return self.control.call(name, systems=systems.split(",") if systems else None, fields=fields.split(",") if fields else None)
+        return self._get_request(path="/{}".format(name), params={"since": since, "wait": wait, "systems": systems, "fields": fields})
+
     def handshake(self):
+        if self.control is not None:
+            return self.control.call("ping")
         return self._put_request(path="/ping")
 
+    def get_admission(self):
+        # Per lane concurrency, queue depth and shed counts
+        return self._get_request(path="/admission")
+
     def get_systems(self):
+        if self.control is not None:
+            return self.control.call("systems")
         return self._get_request(path="/systems")
 
     def get_config(self, system=None):
-        if system:
-            return self._get_request(path="/systems/{}/config".format(system))
-        else:
-            return self._get_request(path="/config")
-
-    def save_config(self):
-        return self._post_request(path="/config")
-
-    def get_status(self, system=None):
-        if system:
-            return self._get_request(path="/systems/{}/status".format(system))
-        else:
-            return self._get_request(path="/status")
-
-    def get_configstatus(self, system=None):
-        if system:
-            return self._get_request(path="/systems/{}/configstatus".format(system))
-        else:
-            return self._get_request(path="/configstatus")
+        return self._view("config", system, None, None, None, None)
+
+    def save_config(self, wait=False):
+        # Without wait the server only schedules the write, bursts of changes are saved once
+        if self.control is not None:
+            return self.control.call("save_config", wait=wait)
+        return self._post_request(path="/config", params={"wait": wait or None})
+
+    def update_config(self, changes, persist=True):
+        # Several keys of several systems at once, e.g. {"rs1": {"i_freq": 403500000}, "rs2": {"i_gain": 30}}.
+        # Either all of them are set or none, response lists every value that was refused
+        if self.control is not None:
+            return self.control.call("update_config", changes=changes, persist=persist)
+        return self._put_request(path="/config", body={"changes": changes, "persist": persist})
+
+    def get_status(self, system=None, since=None, wait=None, systems=None, fields=None):
+        # since/wait: long-poll until the state version moves past since (e.g. self.state_version), for at most wait seconds
+        # systems/fields: only return these systems (ids or s_type) and keys, e.g. systems="gps", fields="lat,lon"
+        return self._view("status", system, since, wait, systems, fields)
+
+    def get_configstatus(self, system=None, since=None, wait=None, systems=None, fields=None):
+        return self._view("configstatus", system, since, wait, systems, fields)
+
+    def batch(self, operations):
+        # One round trip for several actions, e.g. [{"system": "aprs", "function": "set_config", "args": ["s_callsign", "ON4ABC"]},
+        # {"system": "aprs", "function": "start_process", "after": [0]}]. after lists operations that must succeed first,
+        # everything else runs concurrently. response holds one result per operation, in order.
+        return self._post_request(path="/batch", body=operations)
+
+    def submit_job(self, system, function, args=None, timeout=None):
+        # Returns the job right away, its id is in response["id"]
+        if self.control is not None:
+            return self.control.call("call", system=system, function=function, args=args or [], job=True, timeout=timeout)
+        return self._post_request(path="/jobs", body={"system": system, "function": function, "args": args or [], "timeout": timeout})
+
+    def get_job(self, job_id, wait=None):
+        # With wait, the server holds the request until the job is finished (or wait seconds pass)
+        if self.control is not None and not wait:
+            return self.control.call("job", id=job_id)
+        return self._get_request(path="/jobs/{}".format(job_id), params={"wait": wait})
+
+    def get_jobs(self, system=None):
+        if self.control is not None:
+            return self.control.call("jobs", system=system)
+        return self._get_request(path="/jobs", params={"system": system})
+
+    def cancel_job(self, job_id):
+        if self.control is not None:
+            return self.control.call("cancel_job", id=job_id)
+        return self._delete_request(path="/jobs/{}".format(job_id))
+
+    def get_profiles(self):
+        if self.control is not None:
+            return self.control.call("profiles")
+        return self._get_request(path="/profiles")
+
+    def apply_profile(self, name, job=False):
+        # Switches the deck to a [profile.<name>] setup, response holds the time every step took
+        if self.control is not None:
+            return self.control.call("apply_profile", name=name, job=job)
+        return self._put_request(path="/profiles/{}/apply".format(name), params={"job": job})
 
     def set_config(self, system, key, value):
-        return self._put_request(path="/systems/{}/config".format(system), params={"key": key, "value": value})
+        return self._invoke(system, "set_config", [key, str(value)], path="/systems/{}/config".format(system), params={"key": key, "value": value})
 
-    def set_power(self, system, power):
-        return self._put_request(path="/systems/{}/power".format(system), params={"power": power})
+    def set_power(self, system, power, job=False):
+        return self._invoke(system, "set_power", [power], path="/systems/{}/power".format(system), params={"power": power, "job": job}, job=job)
 
-    def toggle_power(self, system):
-        return self._put_request(path="/systems/{}/power/toggle".format(system))
+    def toggle_power(self, system, job=False):
+        return self._invoke(system, "toggle_power", path="/systems/{}/power/toggle".format(system), params={"job": job}, job=job)
 
-    def start_process(self, system):
-        return self._put_request(path="/systems/{}/start_process".format(system))
+    def start_process(self, system, job=False):
+        return self._invoke(system, "start_process", path="/systems/{}/start_process".format(system), params={"job": job}, job=job)
 
-    def stop_process(self, system):
-        return self._put_request(path="/systems/{}/stop_process".format(system))
+    def stop_process(self, system, job=False):
+        return self._invoke(system, "stop_process", path="/systems/{}/stop_process".format(system), params={"job": job}, job=job)
 
-    def reboot(self):
-        return self._put_request(path="/systems/obc/reboot")
+    def reboot(self, job=False):
+        return self._invoke("obc", "reboot", path="/systems/obc/reboot", params={"job": job}, job=job)
 
-    def shutdown(self):
-        return self._put_request(path="/systems/obc/shutdown")
+    def shutdown(self, job=False):
+        return self._invoke("obc", "shutdown", path="/systems/obc/shutdown", params={"job": job}, job=job)
 
     def set_volume(self, volume):
-        return self._put_request(path="/systems/audio/volume", params={"volume": volume})
+        return self._invoke("audio", "set_volume", [volume], path="/systems/audio/volume", params={"volume": volume})
 
     def increment_volume(self):
-        return self._put_request(path="/systems/audio/volume/increment")
+        return self._invoke("audio", "increment_volume", path="/systems/audio/volume/increment")
 
     def decrement_volume(self):
-        return self._put_request(path="/systems/audio/volume/decrement")
+        return self._invoke("audio", "decrement_volume", path="/systems/audio/volume/decrement")
 
     def set_mute(self, mute):
-        return self._put_request(path="/systems/audio/mute", params={"mute": mute})
+        return self._invoke("audio", "set_mute", [mute], path="/systems/audio/mute", params={"mute": mute})
 
     def toggle_mute(self):
-        return self._put_request(path="/systems/audio/mute/toggle")
+        return self._invoke("audio", "toggle_mute", path="/systems/audio/mute/toggle")
 
     def set_test(self, test):
-        return self._put_request(path="/systems/audio/test", params={"test": test})
+        return self._invoke("audio", "set_test", [test], path="/systems/audio/test", params={"test": test})
 
     def set_brightness(self, brightness):
-        return self._put_request(path="/systems/display/brightness", params={"brightness": brightness})
+        return self._invoke("display", "set_brightness", [brightness], path="/systems/display/brightness", params={"brightness": brightness})
 
     def increment_brightness(self):
-        return self._put_request(path="/systems/display/brightness/increment")
+        return self._invoke("display", "increment_brightness", path="/systems/display/brightness/increment")
 
     def decrement_brightness(self):
-        return self._put_request(path="/systems/display/brightness/decrement")
+        return self._invoke("display", "decrement_brightness", path="/systems/display/brightness/decrement")
 
     def screenshot(self):
-        return self._put_request(path="/systems/display/screenshot")
+        return self._invoke("display", "screenshot", path="/systems/display/screenshot")
 
     def get_frequency(self):
-        return self._get_request(path="/systems/rigctl/frequency")
+        return self._invoke("rigctl", "get_frequency", path="/systems/rigctl/frequency", method="get")
 
     def set_frequency(self, frequency):
-        return self._put_request(path="/systems/rigctl/frequency", params={"frequency": frequency})
+        return self._invoke("rigctl", "set_frequency", [frequency], path="/systems/rigctl/frequency", params={"frequency": frequency})
 
     def stop(self):
         self.active = False
+        if self.control is not None:
+            self.control.close()
 
     def run(self):
         while self.active:
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Bounded worker pool for blocking subsystem actions (uhubctl, gpsd scripts, opening RTL devices, backlight fades).
+# Every subsystem gets its own ordered queue: actions on one subsystem run one at a time in submission order,
+# actions on different subsystems run in parallel on the shared pool.
+
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class SubsystemExecutor(object):
+
+	def __init__(self, max_workers):
+		self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="worker")
+		self.lock = threading.Lock()
+
+		self.queues = {}	# key -> deque of (future, function, args) waiting to run
+		self.active = set()	# keys which currently have a drain task on the pool
+
+	def submit(self, key, function, *args):
+		future = Future()
+		with self.lock:
+			self.queues.setdefault(key, deque()).append((future, function, args))
+			if key in self.active:
+				return future
+			self.active.add(key)
+
+		try:
+			self.pool.submit(self._drain, key)
+		except RuntimeError:
+			# Shut down already, nothing would ever run the action: it is not left queued
+			with self.lock:
+				self.queues[key].remove((future, function, args))
+				self.active.discard(key)
+			raise
+		return future
+
+	def _drain(self, key):
+		# Run a single queued action, then requeue behind the other subsystems so a busy subsystem cannot hog a worker
+		with self.lock:
+			future, function, args = self.queues[key].popleft()
+
+		if future.set_running_or_notify_cancel():
+			try:
+				result = function(*args)
+			except BaseException as e:
+				future.set_exception(e)
+			else:
+				future.set_result(result)
+
+		with self.lock:
+			if not self.queues[key]:
+				self.active.discard(key)
+				return
+
+		self.pool.submit(self._drain, key)
+
+	def pending(self):
+		with self.lock:
+			return {key: len(queue) for key, queue in self.queues.items() if queue}
+
+	def shutdown(self):
+		self.pool.shutdown(wait=True)
@@ -24,10 +24,10 @@ class Packet(object):
 
 class Forwarder(object):
 
-    def __init__(self, ip, port):
+    def __init__(self, endpoint):
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.PUB)
-        self.host = 'tcp://' + ip + ':' + str(port)
+        self.host = endpoint
         self.socket.connect(self.host)
 
     def publish(self, packet):
@@ -49,6 +49,9 @@ if __name__ == '__main__':
     parser.add_argument(
         '-t', '--tag', type=str, help='unique tag to append to data', required=True)
 
+    parser.add_argument(
+        '-e', '--endpoint', type=str, help='proxy subX endpoint, tcp:// or ipc://', default='tcp://127.0.0.1:5005')
+
     args = parser.parse_args()
 
     tag = args.tag
@@ -58,7 +61,7 @@ if __name__ == '__main__':
         signal.signal(signal.SIGINT, handler_stop_signals)
         signal.signal(signal.SIGTERM, handler_stop_signals)
 
-        fwdr = Forwarder('127.0.0.1', 5005)
+        fwdr = Forwarder(args.endpoint)
 
         while run:
             line = sys.stdin.readline().rstrip()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Hardware backends. Every piece of hardware the subsystems touch (GPIO, I2C sensors, RTL dongles, gpsd, the ALSA mixer,
+# the backlight, the RFCOMM socket and the shell commands driving uhubctl/rfkill/systemctl) is reached through one of these
+# objects, selected by s_backend in the [hardware] section of config.ini. The "pi" backend talks to the real devices,
+# the "sim" backend fakes them so the full server can boot and be load tested on a build box.
+
+import datetime
+import logging
+import os
+import random
+import re
+import subprocess
+import threading
+import time
+
+
+class PiBackend(object):
+
+	# Real hardware of the deck, imports are done here so that nothing Pi specific is loaded when simulating
+
+	name = "pi"
+
+	def __init__(self, config):
+		self.config = config
+
+		import RPi.GPIO as GPIO
+		self.gpio = GPIO
+
+		self._i2c = None
+		self.lock = threading.Lock()
+
+	def i2c(self):
+		#Subsystems are constructed concurrently, make sure the bus is only opened once
+		with self.lock:
+			if self._i2c is None:
+				import board
+				self._i2c = board.I2C()
+		return self._i2c
+
+	def ads1115(self, address):
+		import Adafruit_ADS1x15
+		return Adafruit_ADS1x15.ADS1115(address=address)
+
+	def ina219(self, address):
+		from ina219 import CustomINA219
+		ina219 = CustomINA219(self.i2c(), addr=address)
+		ina219.set_custom_calibration_16V_3A()
+		return ina219
+
+	def rtlsdr(self, index):
+		from rtlsdr import RtlSdr
+		return RtlSdr(index)
+
+	def rtlsdr_index_by_serial(self, serial):
+		from rtlsdr import RtlSdr
+		return RtlSdr.get_device_index_by_serial(serial)
+
+	def gpsd(self):
+		import gpsd
+		return gpsd
+
+	def mixer(self, control, id, cardindex, device):
+		import alsaaudio
+		return alsaaudio.Mixer(control=control, id=id, cardindex=cardindex, device=device)
+
+	def backlight(self):
+		#Returns None if no official touchscreen is connected
+		if os.path.isfile('/sys/class/backlight/rpi_backlight/max_brightness'):
+			from rpi_backlight import Backlight
+			return Backlight()
+		else:
+			return None
+
+	def bluetooth_socket(self):
+		import socket
+		return socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+
+	def ifaddresses(self, interface):
+		import netifaces
+		return netifaces.ifaddresses(interface)
+
+	def wifi_ssid(self):
+		ssid_output = subprocess.check_output(['iwgetid']).decode('utf-8')
+		return ssid_output.split('"')[1]
+
+	def soc_temperature(self):
+		output = subprocess.check_output(['vcgencmd', 'measure_temp'])
+		floats = re.findall(r"\d+\.\d+", output.decode('utf-8'))
+		return float(floats[0])
+
+	def ds18b20_temperature(self, sensor):
+		output = subprocess.check_output(['cat', '/sys/bus/w1/devices/{TEMP_ID}/temperature'.format(TEMP_ID=sensor)])
+		return int(output.decode('utf-8'))/1000.0
+
+	def run(self, command):
+		return subprocess.run([command], shell=True)
+
+	def popen(self, command, **kwargs):
+		return subprocess.Popen(command, shell=True, **kwargs)
+
+
+class SimBackend(object):
+
+	# Simulated hardware. Every device access sleeps for f_sim_latency (+/- jitter), fails with probability
+	# f_sim_failure_rate and adds f_sim_noise relative noise to its readings.
+
+	name = "sim"
+
+	def __init__(self, config):
+		self.config = config
+
+		self.latency = self.config.get("f_sim_latency", 0.0)
+		self.noise = self.config.get("f_sim_noise", 0.0)
+		self.failure_rate = self.config.get("f_sim_failure_rate", 0.0)
+		self.random = random.Random(self.config.get("i_sim_seed", None))
+		self.lock = threading.Lock()
+
+		self.gpio = SimGPIO(self)
+		self._i2c = object()
+
+		self.commands = []
+
+	def _access(self, what):
+		#Apply latency and failure injection to a single device access
+		with self.lock:
+			delay = self.latency * self.random.uniform(0.5, 1.5) if self.latency else 0.0
+			failed = self.random.random() < self.failure_rate
+
+		if delay:
+			time.sleep(delay)
+		if failed:
+			raise IOError("Simulated failure of {}".format(what))
+
+	def _noisy(self, value):
+		if not self.noise:
+			return value
+		with self.lock:
+			return value * (1.0 + self.random.gauss(0.0, self.noise))
+
+	def i2c(self):
+		return self._i2c
+
+	def ads1115(self, address):
+		self._access("ADS1115 at {}".format(hex(address)))
+		return SimADS1115(self, address)
+
+	def ina219(self, address):
+		self._access("INA219 at {}".format(hex(address)))
+		return SimINA219(self, address)
+
+	def rtlsdr(self, index):
+		self._access("RTL-SDR #{}".format(index))
+		if index >= len(self.config.get("l_sim_rtl_serials", [])):
+			raise IOError("Error opening the RTL-SDR device with index {}".format(index))
+		return SimRtlSdr(index)
+
+	def rtlsdr_index_by_serial(self, serial):
+		self._access("RTL-SDR enumeration")
+		serials = self.config.get("l_sim_rtl_serials", [])
+		if serial not in serials:
+			raise IOError("No RTL-SDR device with serial {}".format(serial))
+		return serials.index(serial)
+
+	def gpsd(self):
+		return SimGpsd(self)
+
+	def mixer(self, control, id, cardindex, device):
+		self._access("ALSA mixer {}".format(control))
+		return SimMixer(self)
+
+	def backlight(self):
+		return SimBacklight(self)
+
+	def bluetooth_socket(self):
+		return SimBluetoothSocket(self)
+
+	def ifaddresses(self, interface):
+		self._access("interface {}".format(interface))
+		return {2: [{"addr": "10.0.0.{}".format(2 + abs(hash(interface)) % 250)}]}
+
+	def wifi_ssid(self):
+		self._access("iwgetid")
+		return "cyberdeck-sim"
+
+	def soc_temperature(self):
+		self._access("vcgencmd")
+		return round(self._noisy(45.0), 1)
+
+	def ds18b20_temperature(self, sensor):
+		self._access("DS18B20 {}".format(sensor))
+		return round(self._noisy(25.0), 3)
+
+	def run(self, command):
+		#Shell commands (uhubctl, rfkill, reboot, ...) are only recorded, never executed
+		logging.debug("Simulated command: {}".format(command))
+		self.commands.append(command)
+		self._access(command)
+		return subprocess.CompletedProcess(args=[command], returncode=0)
+
+	def popen(self, command, **kwargs):
+		logging.debug("Simulated process: {}".format(command))
+		self.commands.append(command)
+		self._access(command)
+		return SimProcess(command)
+
+
+class SimGPIO(object):
+
+	BCM = 11
+	BOARD = 10
+	OUT = 0
+	IN = 1
+
+	def __init__(self, backend):
+		self.backend = backend
+		self.pins = {}
+
+	def setmode(self, mode):
+		self.mode = mode
+
+	def setup(self, pin, direction):
+		self.pins.setdefault(pin, 1)
+
+	def output(self, pin, value):
+		self.pins[pin] = int(value)
+
+	def input(self, pin):
+		self.backend._access("GPIO {}".format(pin))
+		return self.pins.get(pin, 1)
+
+	def cleanup(self):
+		self.pins = {}
+
+
+class SimADS1115(object):
+
+	def __init__(self, backend, address):
+		self.backend = backend
+		self.address = address
+
+	def read_adc(self, channel, gain=1):
+		self.backend._access("ADS1115 channel {}".format(channel))
+		return int(self.backend._noisy(self.backend.config.get("i_sim_adc_raw", 3300)))
+
+
+class SimINA219(object):
+
+	def __init__(self, backend, address):
+		self.backend = backend
+		self.address = address
+
+	def set_custom_calibration_16V_3A(self):
+		pass
+
+	@property
+	def bus_voltage(self):
+		self.backend._access("INA219 bus voltage")
+		return self.backend._noisy(5.1)
+
+	@property
+	def current(self):
+		self.backend._access("INA219 current")
+		return self.backend._noisy(800.0)
+
+
+class SimRtlSdr(object):
+
+	def __init__(self, index):
+		self.index = index
+
+	def close(self):
+		pass
+
+
+class SimGpsdPacket(object):
+
+	def __init__(self, mode, sats, sats_valid, lat, lon, alt):
+		self.mode = mode
+		self.sats = sats
+		self.sats_valid = sats_valid
+		self.lat = lat
+		self.lon = lon
+		self.alt = alt
+		self.track = 0.0
+		self.hspeed = 0.0
+		self.climb = 0.0
+		self.time = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000Z")
+		self.error = {"c": 0.0, "s": 0.0, "t": 0.0, "v": 0.0, "x": 0.0, "y": 0.0}
+
+
+class SimGpsd(object):
+
+	# Same module level interface as the gpsd-py3 package: connect() and get_current()
+
+	def __init__(self, backend):
+		self.backend = backend
+
+	def connect(self, host="127.0.0.1", port=2947):
+		self.backend._access("gpsd at {}:{}".format(host, port))
+
+	def get_current(self):
+		self.backend._access("gpsd")
+		config = self.backend.config
+		with self.backend.lock:
+			jitter_lat = self.backend.random.gauss(0.0, self.backend.noise * 1e-3)
+			jitter_lon = self.backend.random.gauss(0.0, self.backend.noise * 1e-3)
+		return SimGpsdPacket(mode=3, sats=12, sats_valid=8, \
+							lat=config.get("f_sim_lat", 0.0) + jitter_lat, \
+							lon=config.get("f_sim_lon", 0.0) + jitter_lon, \
+							alt=self.backend._noisy(config.get("f_sim_alt", 0.0)))
+
+
+class SimMixer(object):
+
+	def __init__(self, backend):
+		self.backend = backend
+		self.volume = 50
+		self.mute = 0
+
+	def getvolume(self):
+		return [self.volume]
+
+	def setvolume(self, volume):
+		self.backend._access("ALSA volume")
+		if volume < 0 or volume > 100:
+			raise ValueError("Volume must be between 0 and 100")
+		self.volume = volume
+
+	def getmute(self):
+		return [self.mute]
+
+	def setmute(self, mute):
+		self.backend._access("ALSA mute")
+		self.mute = int(mute)
+
+
+class SimBacklight(object):
+
+	def __init__(self, backend):
+		self.backend = backend
+		self._power = True
+		self._brightness = 100
+		self.fade_duration = 0
+
+	@property
+	def power(self):
+		return self._power
+
+	@power.setter
+	def power(self, power):
+		self.backend._access("backlight power")
+		self._power = bool(power)
+
+	@property
+	def brightness(self):
+		return self._brightness
+
+	@brightness.setter
+	def brightness(self, brightness):
+		if brightness < 0 or brightness > 100:
+			raise ValueError("Brightness must be between 0 and 100")
+		self.backend._access("backlight brightness")
+		time.sleep(self.fade_duration)
+		self._brightness = brightness
+
+
+class SimBluetoothSocket(object):
+
+	# Never receives a connection, accept() blocks until the socket is closed
+
+	def __init__(self, backend):
+		self.backend = backend
+		self.closed = threading.Event()
+
+	def bind(self, address):
+		self.backend._access("RFCOMM bind {}".format(address))
+
+	def listen(self, backlog):
+		pass
+
+	def accept(self):
+		self.closed.wait()
+		raise OSError("Simulated RFCOMM socket closed")
+
+	def close(self):
+		self.closed.set()
+
+
+class SimProcess(object):
+
+	def __init__(self, command):
+		self.args = command
+		self.returncode = 0
+
+	def communicate(self, input=None, timeout=None):
+		return b"", b""
+
+	def poll(self):
+		return self.returncode
+
+	def wait(self, timeout=None):
+		return self.returncode
+
+
+BACKENDS = {
+	PiBackend.name: PiBackend,
+	SimBackend.name: SimBackend,
+}
+
+
+def load_backend(config):
+	backend = config.get("s_backend", PiBackend.name)
+	if backend not in BACKENDS:
+		raise ValueError('Invalid hardware backend {B}, expected one of {O}'.format(B=backend, O=", ".join(BACKENDS)))
+	return BACKENDS[backend](config)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Import time budget check for the server cold start. Imports everything main.py imports at module level in a fresh
+# interpreter with -X importtime (without constructing the Server), reports which modules dominate and exits with 1
+# when the total is over budget, e.g.:
+#
+#   python3 import_budget.py --budget 1.5 --top 10
+
+import argparse
+import ast
+import os
+import subprocess
+import sys
+
+
+def module_imports(path):
+	#Top level imports of a script, in order, skipping anything under if __name__ == '__main__'
+	with open(path) as f:
+		tree = ast.parse(f.read(), filename=path)
+
+	modules = []
+	for node in tree.body:
+		if isinstance(node, ast.Import):
+			modules += [alias.name for alias in node.names]
+		elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+			modules.append(node.module)
+	return modules
+
+
+def measure(modules, cwd):
+	#Returns [(depth, self_us, cumulative_us, module)] as reported by -X importtime
+	source = "; ".join("import {}".format(module) for module in modules)
+	result = subprocess.run([sys.executable, "-X", "importtime", "-c", source], cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	stderr = result.stderr.decode('utf-8', errors='replace')
+	if result.returncode != 0:
+		raise RuntimeError("Importing {} failed:\n{}".format(", ".join(modules), stderr.strip().splitlines()[-1]))
+
+	entries = []
+	for line in stderr.splitlines():
+		if not line.startswith("import time:") or "self [us]" in line:
+			continue
+		self_us, cumulative_us, name = line[len("import time:"):].split("|")
+		depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+		entries.append((depth, int(self_us), int(cumulative_us), name.strip()))
+	return entries
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Report the import time of the server cold start')
+	parser.add_argument('-s', '--script', type=str, default='main.py', help='script whose top level imports are measured')
+	parser.add_argument('-b', '--budget', type=float, default=1.5, help='total import time budget in seconds')
+	parser.add_argument('-t', '--top', type=int, default=10, help='number of modules to report')
+	args = parser.parse_args()
+
+	script = os.path.abspath(args.script)
+	modules = module_imports(script)
+
+	try:
+		entries = measure(modules, cwd=os.path.dirname(script))
+	except RuntimeError as e:
+		sys.exit(str(e))
+
+	# Interpreter startup (site, encodings, ...) is reported before the measured imports, only count what the script adds
+	measured = [e for e in entries if e[0] == 0 and e[3].split(".")[0] in set(m.split(".")[0] for m in modules)]
+	total = sum(e[2] for e in measured) / 1e6
+
+	print("Imports of {} ({}):".format(os.path.basename(script), ", ".join(modules)))
+	for depth, self_us, cumulative_us, name in sorted(measured, key=lambda e: e[2], reverse=True):
+		print("  {:<30} {:>8.3f}s".format(name, cumulative_us / 1e6))
+
+	print("Heaviest individual modules (self time):")
+	for depth, self_us, cumulative_us, name in sorted(entries, key=lambda e: e[1], reverse=True)[:args.top]:
+		print("  {:<30} {:>8.3f}s".format(name, self_us / 1e6))
+
+	print("Total {:.3f}s, budget {:.3f}s".format(total, args.budget))
+	if total > args.budget:
+		sys.exit("Import time budget exceeded")
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Background jobs for slow subsystem actions (uhubctl power cycles, gpsd scripts, starting GQRX or Gpredict, reboots).
+# A job goes through the subsystem executor like any other action but the API answers with its id right away; clients
+# poll or long-poll the job until it is done. A queued job can be cancelled, a running one cannot be interrupted: once
+# it runs past its timeout it is reported as timed out and its eventual result is kept for reference. A job still
+# queued at its timeout is never started, whether or not a client polled it meanwhile.
+
+import asyncio
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMED_OUT = "timed_out"
+
+FINISHED = (DONE, FAILED, CANCELLED, TIMED_OUT)
+
+
+def _notify(loop, finished):
+	try:
+		loop.call_soon_threadsafe(_wake, finished)
+	except RuntimeError:
+		pass	# Loop already closed, nobody is waiting anymore
+
+
+def _wake(finished):
+	if not finished.done():
+		finished.set_result(None)
+
+
+class Job(object):
+
+	def __init__(self, job_id, system, function_name, args, timeout):
+		self.id = job_id
+		self.system = system
+		self.function_name = function_name
+		self.args = args
+		self.timeout = timeout
+
+		self.state = QUEUED
+		self.submitted = time.time()
+		self.started = None
+		self.finished = None
+		self.result = None
+		self.future = None
+		self.lock = threading.Lock()	# state changes of the worker, readers and cancel
+
+	def _expired(self, now):
+		return bool(self.timeout) and now - self.submitted > self.timeout
+
+	def _run(self, function, *args):
+		with self.lock:
+			if self.state != QUEUED:
+				return None	# Timed out while queued, whether or not anyone read the job
+			if self._expired(time.time()):
+				# Nobody polled meanwhile: the client gave up on it already, it is not run this late
+				self.state = TIMED_OUT
+				return {"success": False, "response": "Timed out after {} s in the queue".format(self.timeout)}
+			self.started = time.time()
+			self.state = RUNNING
+		return function(*args)
+
+	def _finish(self, future):
+		finished = time.time()
+		with self.lock:
+			self.finished = finished
+			if future.cancelled():
+				if self.state != TIMED_OUT:
+					self.state = CANCELLED
+				return
+			error = future.exception()
+			if error is not None:
+				self.result = {"success": False, "response": str(error)}
+			else:
+				self.result = future.result()
+
+			if self.state == TIMED_OUT or self._expired(finished):
+				self.state = TIMED_OUT	# Also when it finished late without being read meanwhile
+			elif isinstance(self.result, dict) and self.result.get("success") is False:
+				self.state = FAILED
+			else:
+				self.state = DONE
+
+	def _check_timeout(self):
+		with self.lock:
+			if self.state in FINISHED or not self._expired(time.time()):
+				return
+			# A queued job never got a worker in time, drop it from the queue. A running one keeps its worker.
+			# Set first, cancelling runs _finish right away and it must not report a user cancel
+			self.state = TIMED_OUT
+		self.future.cancel()
+
+	def to_dict(self):
+		self._check_timeout()
+		return {
+			"id": self.id,
+			"system": self.system,
+			"function": self.function_name,
+			"args": self.args,
+			"state": self.state,
+			"submitted": self.submitted,
+			"started": self.started,
+			"finished": self.finished,
+			"timeout": self.timeout,
+			"result": self.result,
+		}
+
+
+class JobRegistry(object):
+
+	def __init__(self, executor, default_timeout, max_finished):
+		self.executor = executor
+		self.default_timeout = default_timeout
+		self.max_finished = max_finished
+
+		self.lock = threading.Lock()
+		self.jobs = OrderedDict()	# id -> Job, in submission order
+		self.ids = itertools.count(1)
+
+	def submit(self, system, function_name, function, args, timeout=None):
+		job = Job(next(self.ids), system, function_name, list(args), self.default_timeout if timeout is None else timeout)
+		job.future = self.executor.submit(system, job._run, function, *args)
+		job.future.add_done_callback(job._finish)
+
+		with self.lock:
+			self.jobs[job.id] = job
+			self._prune()
+		return {"success": True, "response": job.to_dict()}
+
+	def _prune(self):
+		# Keep every unfinished job, only the most recent max_finished finished ones
+		finished = [job_id for job_id, job in self.jobs.items() if job.state in FINISHED]
+		for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+			del self.jobs[job_id]
+
+	def get(self, job_id):
+		job = self.jobs.get(job_id)
+		if job is None:
+			return {"success": False, "response": "Job {} not found".format(job_id)}
+		return {"success": True, "response": job.to_dict()}
+
+	async def wait(self, job_id, timeout):
+		"""Long-poll: return the job once it is finished, or after timeout seconds"""
+		job = self.jobs.get(job_id)
+		if job is not None and timeout > 0:
+			remaining = timeout
+			if job.timeout:
+				# Wake up in time to report a job running past its own timeout
+				remaining = min(remaining, max(job.submitted + job.timeout - time.time(), 0) + 0.1)
+			# Not wrap_future, cancelling the wait must not cancel the job
+			loop = asyncio.get_running_loop()
+			finished = loop.create_future()
+			job.future.add_done_callback(lambda future: _notify(loop, finished))
+			try:
+				await asyncio.wait_for(finished, remaining)
+			except asyncio.TimeoutError:
+				pass
+		return self.get(job_id)
+
+	def list(self, system=None):
+		with self.lock:
+			jobs = list(self.jobs.values())
+		return {"success": True, "response": [job.to_dict() for job in jobs if system is None or job.system == system]}
+
+	def cancel(self, job_id):
+		job = self.jobs.get(job_id)
+		if job is None:
+			return {"success": False, "response": "Job {} not found".format(job_id)}
+		if job.future.cancel():
+			return {"success": True, "response": job.to_dict()}
+		return {"success": False, "response": "Job {} is {}, only queued jobs can be cancelled".format(job_id, job.to_dict()["state"])}
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Dependency ordered, parallel construction/start/stop of the server subsystems. Every subsystem is added with the names
+# of the subsystems it needs; independent subsystems are handled concurrently on a small pool, a subsystem is only
+# handled once everything it needs is done (or, when stopping, once everything needing it is stopped).
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Lifecycle(object):
+
+	def __init__(self, max_workers):
+		self.max_workers = max_workers
+
+		self.requires = {}		# name -> names it needs
+		self.deadlines = {}		# name -> {phase: seconds}
+		self.timings = {}		# phase -> {name: seconds}
+		self.failures = {}		# phase -> {name: message}
+		self.durations = {}		# phase -> wall clock seconds
+
+	def add(self, name, requires=(), start_deadline=30.0, stop_deadline=10.0, **deadlines):
+		# deadlines: seconds for any other phase, e.g. apply=20.0
+		self.requires[name] = list(requires)
+		self.deadlines[name] = dict(deadlines, construct=start_deadline, start=start_deadline, stop=stop_deadline)
+
+	def _dependents(self):
+		dependents = {name: [] for name in self.requires}
+		for name, requires in self.requires.items():
+			for required in requires:
+				dependents[required].append(name)
+		return dependents
+
+	def run_phase(self, phase, action, names=None, reverse=False):
+		"""Run action(name) for every (selected) subsystem in dependency order, reverse=True runs dependents first.
+		Returns the results by name, failures and missed deadlines are recorded in self.failures[phase]."""
+
+		names = list(self.requires) if names is None else list(names)
+		selected = set(names)
+		for name in names:
+			missing = [r for r in self.requires[name] if r not in self.requires]
+			if missing:
+				raise ValueError("Subsystem {} requires unknown subsystem(s) {}".format(name, ", ".join(missing)))
+
+		# Only ordering constraints between selected subsystems matter for this phase
+		edges = self._dependents() if reverse else self.requires
+		waits_on = {name: [n for n in edges[name] if n in selected] for name in names}
+
+		timings = self.timings[phase] = {}
+		failures = self.failures[phase] = {}
+		results = {}
+
+		pending = list(names)
+		running = {}	# future -> (name, start time)
+		done = set()
+
+		phase_started = time.monotonic()
+		pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=phase)
+		try:
+			while pending or running:
+				for name in list(pending):
+					if all(n in done for n in waits_on[name]):
+						pending.remove(name)
+						running[pool.submit(action, name)] = (name, time.monotonic())
+
+				if not running:
+					# Whatever is left waits on a failed subsystem (or on a dependency cycle)
+					for name in pending:
+						failures[name] = "not handled, waiting on {}".format(", ".join(n for n in waits_on[name] if n not in done))
+					break
+
+				now = time.monotonic()
+				timeout = min(t + self.deadlines[name][phase] for name, t in running.values()) - now
+				finished, _ = wait(list(running), timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+
+				now = time.monotonic()
+				for future in finished:
+					name, started = running.pop(future)
+					timings[name] = now - started
+					try:
+						results[name] = future.result()
+						done.add(name)
+					except Exception as e:
+						failures[name] = str(e)
+
+				for future, (name, started) in list(running.items()):
+					if now - started > self.deadlines[name][phase]:
+						# The worker cannot be interrupted, abandon it and report the missed deadline
+						running.pop(future)
+						timings[name] = now - started
+						failures[name] = "missed {} deadline of {}s".format(phase, self.deadlines[name][phase])
+
+				if failures and not reverse:
+					# Do not bring up anything else once something failed to come up, only wait for the running ones
+					for name in pending:
+						failures[name] = "not handled, boot aborted"
+					pending = []
+		finally:
+			# Never join here, a worker stuck past its deadline must not hold up the rest
+			pool.shutdown(wait=False, cancel_futures=True)
+
+		self.durations[phase] = time.monotonic() - phase_started
+		return results
+
+	def report(self, phases, unit="subsystems"):
+		lines = []
+		for phase in phases:
+			timings = self.timings.get(phase, {})
+			failures = self.failures.get(phase, {})
+			lines.append("{} of {} {} took {:.3f}s ({:.3f}s summed):".format(phase, len(timings), unit, self.durations.get(phase, 0.0), sum(timings.values())))
+			for name, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+				lines.append("  {:<12} {:>8.3f}s {}".format(name, seconds, failures.get(name, "")))
+			for name, message in failures.items():
+				if name not in timings:
+					lines.append("  {:<12} {:>9} {}".format(name, "-", message))
+		return "\n".join(lines)
@@ -3,19 +3,22 @@
 
 __author__ = 'Tom Mladenov'
 
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
-from fastapi import FastAPI, Request
-from fastapi.openapi.utils import get_openapi
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
 from server import Server
-from packet import Packet
-from fastapi.responses import JSONResponse
+import admission
+import state
+import stream
 
 import sys
-import uvicorn
+import json
+import asyncio
+from concurrent.futures import Future
 import logging
 import time
-import inspect
 import os
 
 tags_metadata = [
@@ -43,151 +46,355 @@ server = Server()
 #Load API
 api = FastAPI(openapi_tags=tags_metadata)
 
-def execute_function_subsystem(**kwargs):
+async def execute_function_subsystem(**kwargs):
 	# print("Server subsystem function invocation: {}.{}({})".format(kwargs["system"], kwargs["function_name"], kwargs["args"]))
 	try:
-		s = [sys for sys in server.systems if sys.config["s_id"] == kwargs["system"]][0]
-		target_function = getattr(s, kwargs["function_name"])
-		if kwargs["args"]:
-			return target_function(*kwargs["args"])
-		else:
-			return target_function()
-	except IndexError:
-		return {"success": False, "response": "System with provided ID not found"}
+		result = server.invoke(kwargs["system"], kwargs["function_name"], kwargs["args"], job=kwargs.get("job", False), timeout=kwargs.get("timeout"))
+		if isinstance(result, Future):
+			# Blocking actions run on the worker pool, in order per subsystem, while the event loop keeps serving
+			return await asyncio.wrap_future(result)
+		return result
 	except Exception as e:
 		return {"success": False, "response": str(e)}
 
 
+class BatchOperation(BaseModel):
+	system: str
+	function: str
+	args: List[Any] = []
+	after: List[int] = []	# indices of operations that must have succeeded before this one starts
+
+
+async def execute_batch(operations):
+	"""Run operations concurrently, each one as soon as the operations it is after are done. Operations on the same
+	subsystem keep their list order through its executor queue. Returns one result per operation, in order."""
+	for index, operation in enumerate(operations):
+		invalid = [i for i in operation.after if i < 0 or i >= len(operations) or i == index]
+		if invalid:
+			return {"success": False, "response": "Operation {} is after invalid operation(s) {}".format(index, ", ".join(str(i) for i in invalid))}
+
+	# Reject cycles in after up front, they would only surface as a timeout
+	ordered = set()
+	remaining = set(range(len(operations)))
+	while remaining:
+		ready = {index for index in remaining if ordered.issuperset(operations[index].after)}
+		if not ready:
+			return {"success": False, "response": "Operations {} are after each other".format(", ".join(str(i) for i in sorted(remaining)))}
+		ordered |= ready
+		remaining -= ready
+
+	tasks = {}
+
+	async def run(index, operation):
+		for i in operation.after:
+			result = await tasks[i]
+			if isinstance(result, dict) and result.get("success") is False:
+				return {"success": False, "response": "Skipped, operation {} failed".format(i)}
+
+		# Typed JSON values go to set_config as they are, its schema parses strings and typed values alike
+		return await execute_function_subsystem(system=operation.system, function_name=operation.function, args=operation.args)
+
+	# Created in list order, so operations without after are submitted to the subsystem queues in list order
+	for index, operation in enumerate(operations):
+		tasks[index] = asyncio.ensure_future(run(index, operation))
+
+	done, pending = await asyncio.wait(list(tasks.values()), timeout=server.max_batch_wait)
+	results = []
+	for index in range(len(operations)):
+		if tasks[index] in done:
+			results.append(tasks[index].result())
+		else:
+			# An operation stuck on its subsystem, or after one that is
+			tasks[index].cancel()
+			results.append({"success": False, "response": "Operation {} did not complete within {}s".format(index, server.max_batch_wait)})
+
+	return {"success": all(not (isinstance(r, dict) and r.get("success") is False) for r in results), "response": results}
+
+
+class JobOperation(BaseModel):
+	system: str
+	function: str
+	args: List[Any] = []
+	timeout: Optional[float] = None	# seconds, f_job_timeout when not given
+
+
+def split_query(value):
+	if value is None:
+		return None
+	return tuple(v.strip() for v in value.split(",") if v.strip()) or None
+
+
+async def snapshot_response(request, view, since, wait, systems=None, fields=None):
+	loop = asyncio.get_running_loop()
+	deadline = loop.time() + min(wait or 0, server.max_poll_wait)
+	known_etags = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+	systems = split_query(systems)
+	fields = split_query(fields)
+
+	# Long-poll: hold the request until the state version moves past since (or wait seconds pass).
+	# A since ahead of the current version was handed out before a restart, answer right away
+	if since is not None and wait and since <= state.current_version():
+		await state.wait_for_version(since, deadline - loop.time())
+
+	while True:
+		snapshot = server.snapshot()
+		try:
+			content = snapshot.json(view, systems, fields)
+		except ValueError as e:
+			return {"success": False, "response": str(e)}
+		etag = snapshot.etag(view, systems, fields)
+
+		if etag not in known_etags or loop.time() >= deadline:
+			break
+		# The client already has this content, keep holding a long-poll until its selection changes
+		await state.wait_for_version(snapshot.version, deadline - loop.time())
+
+	headers = {"ETag": etag, "X-State-Version": str(snapshot.version)}
+	if etag in known_etags:
+		return Response(status_code=304, headers=headers)
+	return Response(content=content, media_type="application/json", headers=headers)
+
+
+@api.middleware("http")
+async def admission_control(request: Request, call_next):
+	lane = admission.classify(request.method, request.url.path, request.query_params)
+	if lane is None:
+		return await call_next(request)
+
+	lane = server.lanes[lane]
+	if not await lane.acquire():
+		return JSONResponse(status_code=503, headers={"Retry-After": str(server.retry_after)}, \
+							content={"success": False, "response": "Server busy, {} lane saturated".format(lane.name)})
+	try:
+		# Held until the response starts, a stream keeps going without its slot
+		return await call_next(request)
+	finally:
+		lane.release()
+
+
 @api.put("/ping")
-def ping():
+async def ping():
 	return {"success": True, "response": "pong"}
 
+@api.get("/admission")
+async def get_admission():
+	return {"success": True, "response": {name: lane.metrics() for name, lane in server.lanes.items()}}
+
+@api.post("/batch")
+async def batch(operations: List[BatchOperation]):
+	return await execute_batch(operations)
+
+@api.get("/jobs")
+async def get_jobs(system: Optional[str] = None):
+	return server.jobs.list(system)
+
+@api.post("/jobs")
+async def submit_job(operation: JobOperation):
+	return await execute_function_subsystem(system=operation.system, function_name=operation.function, args=operation.args, job=True, timeout=operation.timeout)
+
+@api.get("/jobs/{job_id}")
+async def get_job(job_id: int, wait: Optional[float] = None):
+	return await server.jobs.wait(job_id, min(wait or 0, server.max_poll_wait))
+
+@api.delete("/jobs/{job_id}")
+async def cancel_job(job_id: int):
+	return server.jobs.cancel(job_id)
+
+@api.get("/profiles")
+async def get_profiles():
+	return server.profiles.get_profiles()
+
+@api.put("/profiles/{name}/apply")
+async def apply_profile(name: str, job: bool = False):
+	result = server.apply_profile(name, job=job)
+	if isinstance(result, Future):
+		return await asyncio.wrap_future(result)
+	return result
+
 @api.get("/systems")
-def get_systems():
+async def get_systems():
 	return server.get_systems()
 
 @api.get("/config")
-def get_config():
-	return server.get_config()
+async def get_config(request: Request, since: Optional[int] = None, wait: Optional[float] = None, systems: Optional[str] = None, fields: Optional[str] = None):
+	return await snapshot_response(request, "config", since, wait, systems, fields)
 
 @api.post("/config")
-def save_config():
-	return server.save_config()
+def save_config(wait: bool = False):
+	"""Schedules config.ini to be written, with wait it is written before the response"""
+	return server.save_config(wait)
+
+class ConfigUpdate(BaseModel):
+	changes: Dict[str, Dict[str, Any]]	# {s_id: {key: value}}
+	persist: bool = True	# schedule config.ini to be saved afterwards
+
+@api.put("/config")
+async def update_config(update: ConfigUpdate):
+	"""Sets config keys of several subsystems at once, all of them or none"""
+	return await asyncio.wrap_future(server.update_config(update.changes, update.persist))
 
 @api.get("/status")
-def get_status():
-	return server.get_status()
+async def get_status(request: Request, since: Optional[int] = None, wait: Optional[float] = None, systems: Optional[str] = None, fields: Optional[str] = None):
+	return await snapshot_response(request, "status", since, wait, systems, fields)
 
 @api.get("/configstatus")
-def get_configstatus():
-	return server.get_configstatus()
+async def get_configstatus(request: Request, since: Optional[int] = None, wait: Optional[float] = None, systems: Optional[str] = None, fields: Optional[str] = None):
+	return await snapshot_response(request, "configstatus", since, wait, systems, fields)
+
+
+def stream_rate(rate):
+	return min(max(rate, 0.01), server.max_stream_rate)
+
+@api.get("/status/events")
+async def status_events(request: Request, view: str = "status", systems: Optional[str] = None, fields: Optional[str] = None, rate: float = 1.0):
+	"""Server-Sent Events stream of status deltas, see stream.deltas"""
+	systems = split_query(systems)
+	fields = split_query(fields)
+	try:
+		server.snapshot().view(view, systems, fields)
+	except ValueError as e:
+		return {"success": False, "response": str(e)}
+
+	async def events():
+		async for delta in stream.deltas(server, view, systems, fields, stream_rate(rate), server.stream_keepalive):
+			if await request.is_disconnected():
+				break
+			if delta is None:
+				yield ": keepalive\n\n"
+			else:
+				yield "id: {}\ndata: {}\n\n".format(delta["version"], json.dumps(delta, default=str))
+
+	return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@api.websocket("/status/ws")
+async def status_websocket(websocket: WebSocket, view: str = "status", systems: Optional[str] = None, fields: Optional[str] = None, rate: float = 1.0):
+	"""WebSocket stream of status deltas, see stream.deltas"""
+	await websocket.accept()
+	systems = split_query(systems)
+	fields = split_query(fields)
+	try:
+		server.snapshot().view(view, systems, fields)
+	except ValueError as e:
+		await websocket.send_json({"success": False, "response": str(e)})
+		await websocket.close()
+		return
+
+	try:
+		async for delta in stream.deltas(server, view, systems, fields, stream_rate(rate), server.stream_keepalive):
+			if delta is None:
+				await websocket.send_json({"keepalive": True})
+			else:
+				await websocket.send_text(json.dumps(delta, default=str))
+	except WebSocketDisconnect:
+		pass
 
 
 @api.get("/systems/{system}/config", tags=["common"])
-def get_config(system: str):
-	return execute_function_subsystem(system=system, function_name=inspect.stack()[0][3], args=None)
+async def get_config(system: str):
+	return await execute_function_subsystem(system=system, function_name="get_config", args=None)
 
 @api.put("/systems/{system}/config", tags=["common"])
-def set_config(system: str, key: str, value: str):
-	return execute_function_subsystem(system=system, function_name=inspect.stack()[0][3], args=[key, value])
+async def set_config(system: str, key: str, value: str):
+	return await execute_function_subsystem(system=system, function_name="set_config", args=[key, value])
 
 @api.get("/systems/{system}/status", tags=["common"])
-def get_status(system: str):
-	return execute_function_subsystem(system=system, function_name=inspect.stack()[0][3], args=None)
+async def get_status(system: str):
+	return await execute_function_subsystem(system=system, function_name="get_status", args=None)
 
 @api.get("/systems/{system}/configstatus", tags=["common"])
-def get_configstatus(system: str):
-	return execute_function_subsystem(system=system, function_name=inspect.stack()[0][3], args=None)
+async def get_configstatus(system: str):
+	return await execute_function_subsystem(system=system, function_name="get_configstatus", args=None)
 
 @api.put("/systems/{system}/power", tags=["common"])
-def set_power(system: str, power: bool):
-	return execute_function_subsystem(system=system, function_name=inspect.stack()[0][3], args=[power])
+async def set_power(system: str, power: bool, job: bool = False):
+	return await execute_function_subsystem(system=system, function_name="set_power", args=[power], job=job)
 
 @api.put("/systems/{system}/power/toggle", tags=["common"])
-def toggle_power(system: str):
-	return execute_function_subsystem(system=system, function_name=inspect.stack()[0][3], args=None)
+async def toggle_power(system: str, job: bool = False):
+	return await execute_function_subsystem(system=system, function_name="toggle_power", args=None, job=job)
 
 @api.put("/systems/{system}/start_process", tags=["common"])
-def start_process(system: str):
-	return execute_function_subsystem(system=system, function_name=inspect.stack()[0][3], args=None)
+async def start_process(system: str, job: bool = False):
+	return await execute_function_subsystem(system=system, function_name="start_process", args=None, job=job)
 
 @api.put("/systems/{system}/stop_process", tags=["common"])
-def stop_process(system: str):
-	return execute_function_subsystem(system=system, function_name=inspect.stack()[0][3], args=None)
+async def stop_process(system: str, job: bool = False):
+	return await execute_function_subsystem(system=system, function_name="stop_process", args=None, job=job)
 
 
 
 
 
 @api.put("/systems/obc/reboot", tags=["obc"])
-def reboot():
-	return execute_function_subsystem(system="obc", function_name=inspect.stack()[0][3], args=None)
+async def reboot(job: bool = False):
+	return await execute_function_subsystem(system="obc", function_name="reboot", args=None, job=job)
 
 @api.put("/systems/obc/shutdown", tags=["obc"])
-def shutdown():
-	return execute_function_subsystem(system="obc", function_name=inspect.stack()[0][3], args=None)
+async def shutdown(job: bool = False):
+	return await execute_function_subsystem(system="obc", function_name="shutdown", args=None, job=job)
 
 
 #-------------AUDIO-------------
 @api.put("/systems/audio/volume", tags=["audio"])
-def set_volume(volume: int):
-	return execute_function_subsystem(system="audio", function_name=inspect.stack()[0][3], args=[volume])
+async def set_volume(volume: int):
+	return await execute_function_subsystem(system="audio", function_name="set_volume", args=[volume])
 
 @api.put("/systems/audio/volume/increment", tags=["audio"])
-def increment_volume():
-	return execute_function_subsystem(system="audio", function_name=inspect.stack()[0][3], args=None)
+async def increment_volume():
+	return await execute_function_subsystem(system="audio", function_name="increment_volume", args=None)
 
 @api.put("/systems/audio/volume/decrement", tags=["audio"])
-def decrement_volume():
-	return execute_function_subsystem(system="audio", function_name=inspect.stack()[0][3], args=None)
+async def decrement_volume():
+	return await execute_function_subsystem(system="audio", function_name="decrement_volume", args=None)
 
 @api.put("/systems/audio/mute", tags=["audio"])
-def set_mute(muted: bool):
-	return execute_function_subsystem(system="audio", function_name=inspect.stack()[0][3], args=[muted])
+async def set_mute(muted: bool):
+	return await execute_function_subsystem(system="audio", function_name="set_mute", args=[muted])
 
 @api.put("/systems/audio/mute/toggle", tags=["audio"])
-def toggle_mute():
-	return execute_function_subsystem(system="audio", function_name=inspect.stack()[0][3], args=None)
+async def toggle_mute():
+	return await execute_function_subsystem(system="audio", function_name="toggle_mute", args=None)
 
 @api.put("/systems/audio/test", tags=["audio"])
-def set_test(test: bool):
-	return execute_function_subsystem(system="audio", function_name=inspect.stack()[0][3], args=[test])
+async def set_test(test: bool):
+	return await execute_function_subsystem(system="audio", function_name="set_test", args=[test])
 
 
 #-------------DISPLAY-------------
 @api.put("/systems/display/brightness", tags=["display"])
-def set_brightness(brightness: int):
-	return execute_function_subsystem(system="display", function_name=inspect.stack()[0][3], args=[brightness])
+async def set_brightness(brightness: int):
+	return await execute_function_subsystem(system="display", function_name="set_brightness", args=[brightness])
 
 @api.put("/systems/display/brightness/increment", tags=["display"])
-def increment_brightness():
-	return execute_function_subsystem(system="display", function_name=inspect.stack()[0][3], args=None)
+async def increment_brightness():
+	return await execute_function_subsystem(system="display", function_name="increment_brightness", args=None)
 
 @api.put("/systems/display/brightness/decrement", tags=["display"])
-def decrement_brightness():
-	return execute_function_subsystem(system="display", function_name=inspect.stack()[0][3], args=None)
+async def decrement_brightness():
+	return await execute_function_subsystem(system="display", function_name="decrement_brightness", args=None)
 
 @api.put("/systems/display/screenshot")
-def screenshot():
-	return execute_function_subsystem(system="display", function_name=inspect.stack()[0][3], args=None)
+async def screenshot():
+	return await execute_function_subsystem(system="display", function_name="screenshot", args=None)
 
 @api.get("/systems/rigctl/frequency")
-def get_frequency():
-	return execute_function_subsystem(system="rigctl", function_name=inspect.stack()[0][3], args=None)
+async def get_frequency():
+	return await execute_function_subsystem(system="rigctl", function_name="get_frequency", args=None)
 
 @api.put("/systems/rigctl/frequency")
-def set_frequency(frequency: float):
-	return execute_function_subsystem(system="rigctl", function_name=inspect.stack()[0][3], args=[frequency])
+async def set_frequency(frequency: float):
+	return await execute_function_subsystem(system="rigctl", function_name="set_frequency", args=[frequency])
 
 @api.get("/systems/rigctl/mode")
-def get_mode():
-	return execute_function_subsystem(system="rigctl", function_name=inspect.stack()[0][3], args=None)
+async def get_mode():
+	return await execute_function_subsystem(system="rigctl", function_name="get_mode", args=None)
 
 
 
 def custom_openapi():
 	if api.openapi_schema:
 		return api.openapi_schema
+	from fastapi.openapi.utils import get_openapi
 	openapi_schema = get_openapi(
 		title="RPi Cyberdeck API",
 		version="0.1.0",
@@ -200,6 +407,8 @@ def custom_openapi():
 
 if __name__ == '__main__':
 
+	import uvicorn
+
 	logging_format = "%(asctime)s %(levelname)-8s %(threadName)-4s %(message)s (L%(lineno)d)"
 
 	for handler in logging.root.handlers[:]:
@@ -215,6 +424,20 @@ if __name__ == '__main__':
 
 	api.openapi = custom_openapi
 
-	uvicorn.run(api, host=server.host, port=server.port, log_config=log_config, headers=[('Server', server.s_header_description)])
+	config = uvicorn.Config(api, host=server.host, port=server.port, log_config=log_config, headers=[('Server', server.s_header_description)])
+	sockets = [config.bind_socket()]
+	if server.unix_socket:
+		# Same-host clients (the touchscreen GUI) skip the TCP stack, one server answers on both sockets
+		import socket
+		if os.path.dirname(server.unix_socket):
+			os.makedirs(os.path.dirname(server.unix_socket), exist_ok=True)	# A bare file name is in the working directory
+		if os.path.exists(server.unix_socket):
+			os.remove(server.unix_socket)
+		unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		unix_socket.bind(server.unix_socket)
+		os.chmod(server.unix_socket, 0o666)
+		sockets.append(unix_socket)
+
+	uvicorn.Server(config).run(sockets=sockets)
 	server.stop_threads()
 	sys.exit("Please wait until all systems are stopped...")
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Deck profiles: named setups in config.ini ([profile.maritime], [profile.balloon], ...) declaring which processes and
+# applications should run, which devices should be powered and which config values to override. Applying a profile
+# diffs it against the current state and runs only the steps needed, in parallel through the Lifecycle scheduler:
+#
+#   config:<id>     set_config overrides, before the subsystem is (re)started
+#   power:<id>      power a device on, before any process is started
+#   stop:<id>       stop a process that is not wanted, or that uses the same device as a process to be started
+#   start:<id>      start a process or application, after the power steps, its config and the stops it conflicts with
+#   poweroff:<id>   power a device off, after every stop
+#
+# Profile keys, all optional:
+#   l_run = ["ais", "opencpn"]             processes and applications which should be running
+#   l_stop = ["gqrx"]                      processes and applications which should not be running
+#   b_exclusive = yes                      stop every other running process (decoders compete for the dongles)
+#   l_power_on = ["usb"], l_power_off = [] devices to power on or off
+#   l_config = {"ais": {"i_gain": 40}}    config overrides, a running process is restarted to apply them
+#   f_step_deadline = 30                   seconds a single step may take
+
+from lifecycle import Lifecycle
+
+PREFIX = "profile."
+
+
+class StepFailed(Exception):
+	pass
+
+
+class Orchestrator(object):
+
+	def __init__(self, server, workers, step_deadline):
+		self.server = server
+		self.workers = workers
+		self.step_deadline = step_deadline
+
+	def profiles(self):
+		configurator = self.server.configurator
+		return {section[len(PREFIX):]: dict(self.server.load_config(configurator.items(section), section)) \
+				for section in configurator.sections() if section.startswith(PREFIX)}
+
+	def get_profiles(self):
+		return {"success": True, "profiles": self.profiles()}
+
+	def _call(self, system, function_name, *args):
+		# Through the subsystem queue, so the step is ordered with API calls on the same subsystem
+		result = self.server.executor.submit(system, self.server.dispatch[system][function_name], *args).result()
+		if isinstance(result, dict) and result.get("success") is False:
+			raise StepFailed(result.get("response") or result.get("message") or "{}.{} failed".format(system, function_name))
+		return result
+
+	def plan(self, profile):
+		"""{step name: (requires, action)} taking the current state to the profile"""
+		systems = self.server.systems_by_id
+		for key in ("l_run", "l_stop", "l_power_on", "l_power_off"):
+			unknown = [s for s in profile.get(key, []) if s not in systems]
+			if unknown:
+				raise ValueError("Profile {} names unknown system(s) {}".format(key, ", ".join(unknown)))
+		overrides = profile.get("l_config", {})
+		unknown = [s for s in overrides if s not in systems]
+		if unknown:
+			raise ValueError("Profile l_config names unknown system(s) {}".format(", ".join(unknown)))
+
+		def running(s_id):
+			return bool(systems[s_id].status.get("running", 0))
+
+		def powered(s_id):
+			return bool(systems[s_id].status.get("power", 0))
+
+		def device(s_id):
+			return systems[s_id].config.get("s_device")
+
+		wanted = set(profile.get("l_run", []))
+		to_start = {s for s in wanted if not running(s) or (s in overrides)}
+		to_stop = {s for s in profile.get("l_stop", []) if running(s)}
+		to_stop |= {s for s in to_start if running(s)}	# Restarted to pick up their config overrides
+		for s_id, system in systems.items():
+			if s_id in wanted or "running" not in system.status or not running(s_id):
+				continue
+			if profile.get("b_exclusive") and system.config.get("s_type") == "process":
+				to_stop.add(s_id)
+			elif device(s_id) and any(device(s) == device(s_id) for s in to_start):
+				to_stop.add(s_id)
+		# A running process with overrides is restarted to apply them even when l_run does not name it, unless the
+		# profile stops it anyway
+		restarted = {s for s in overrides if "running" in systems[s].status and running(s) and s not in to_stop}
+		to_start |= restarted
+		to_stop |= restarted
+
+		power_on = [s for s in profile.get("l_power_on", []) if not powered(s)]
+		power_off = [s for s in profile.get("l_power_off", []) if powered(s)]
+
+		steps = {}
+		for s_id in power_on:
+			steps["power:{}".format(s_id)] = ([], lambda s_id=s_id: self._call(s_id, "set_power", True))
+		for s_id in to_stop:
+			steps["stop:{}".format(s_id)] = ([], lambda s_id=s_id: self._call(s_id, "stop_process"))
+		for s_id, values in overrides.items():
+			requires = ["stop:{}".format(s_id)] if s_id in to_stop else []
+			steps["config:{}".format(s_id)] = (requires, lambda s_id=s_id, values=values: \
+											[self._call(s_id, "set_config", key, value) for key, value in values.items()])
+		for s_id in to_start:
+			requires = ["power:{}".format(s) for s in power_on]
+			requires += ["stop:{}".format(s) for s in to_stop if s == s_id or (device(s) and device(s) == device(s_id))]
+			if s_id in overrides:
+				requires.append("config:{}".format(s_id))
+			steps["start:{}".format(s_id)] = (requires, lambda s_id=s_id: self._call(s_id, "start_process"))
+		for s_id in power_off:
+			steps["poweroff:{}".format(s_id)] = (["stop:{}".format(s) for s in to_stop], lambda s_id=s_id: self._call(s_id, "set_power", False))
+		return steps
+
+	def apply(self, name):
+		profile = self.profiles().get(name)
+		if profile is None:
+			return {"success": False, "response": "Profile {} not found".format(name)}
+		try:
+			steps = self.plan(profile)
+		except ValueError as e:
+			return {"success": False, "response": str(e)}
+
+		deadline = profile.get("f_step_deadline", self.step_deadline)
+		lifecycle = Lifecycle(self.workers)
+		for step, (requires, action) in steps.items():
+			lifecycle.add(step, requires, apply=deadline)
+		lifecycle.run_phase("apply", lambda step: steps[step][1]())
+
+		report = lifecycle.report(["apply"], unit="steps")
+		print("Profile {}: {}".format(name, report))
+		failures = lifecycle.failures["apply"]
+		return {"success": not failures, "response": {
+			"profile": name,
+			"duration": lifecycle.durations["apply"],
+			"steps": {step: {"seconds": lifecycle.timings["apply"].get(step), "error": failures.get(step)} for step in steps},
+			"report": report,
+		}}
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Typed config schema. The type of every config.ini key comes from its tag (s_ string, f_ float, i_ int, b_ boolean,
+# l_ JSON); subsystem classes add rules per key in config_rules (read-only, ranges, choices, a validator). A Schema is
+# compiled once per section into one Field per key, so parsing a value is a single dict lookup and a call, both when the
+# server loads config.ini and on every set_config. Loading collects every error instead of stopping at the first one.
+
+import json
+
+TRUE = ("true", "1", "yes", "t")
+FALSE = ("false", "0", "no", "f")
+
+
+def parse_bool(value):
+	if isinstance(value, (bool, int)):
+		return bool(value)
+	lowered = str(value).strip().lower()
+	if lowered in TRUE:
+		return True
+	if lowered in FALSE:
+		return False
+	raise ValueError("Value {} not valid boolean".format(value))
+
+
+def parse_list(value):
+	return json.loads(value) if isinstance(value, str) else value
+
+
+PARSERS = {
+	"s_": str,
+	"f_": float,
+	"i_": int,
+	"b_": parse_bool,
+	"l_": parse_list,
+}
+
+
+class Rule(object):
+
+	def __init__(self, read_only=False, minimum=None, maximum=None, choices=None, validate=None):
+		self.read_only = read_only
+		self.minimum = minimum
+		self.maximum = maximum
+		self.choices = choices
+		self.validate = validate	# callable raising ValueError for a parsed value it rejects
+
+
+READ_ONLY = Rule(read_only=True)
+NO_RULE = Rule()
+
+# Identity of a subsystem and how the server builds it, never changed at runtime
+BASE_RULES = {key: READ_ONLY for key in ("s_id", "s_class", "l_requires", "b_enabled", "b_service")}
+
+
+class Field(object):
+
+	def __init__(self, key, parser, rule):
+		self.key = key
+		self.parser = parser
+		self.read_only = rule.read_only
+		self.minimum = rule.minimum
+		self.maximum = rule.maximum
+		self.choices = rule.choices
+		self.validate = rule.validate
+
+	def parse(self, value):
+		parsed = self.parser(value)
+		if self.minimum is not None and parsed < self.minimum:
+			raise ValueError("{} is below the minimum of {}".format(parsed, self.minimum))
+		if self.maximum is not None and parsed > self.maximum:
+			raise ValueError("{} is above the maximum of {}".format(parsed, self.maximum))
+		if self.choices is not None and parsed not in self.choices:
+			raise ValueError("{} is not one of {}".format(parsed, ", ".join(str(c) for c in self.choices)))
+		if self.validate is not None:
+			self.validate(parsed)
+		return parsed
+
+
+class Schema(object):
+
+	def __init__(self, name, fields, errors):
+		self.name = name
+		self.fields = fields	# key -> Field
+		self.errors = errors	# keys which could not be compiled
+
+	@classmethod
+	def compile(cls, name, keys, rules=None):
+		rules = dict(BASE_RULES, **(rules or {}))
+		fields = {}
+		errors = []
+		for key in keys:
+			parser = PARSERS.get(key[:2])
+			if parser is None:
+				errors.append("[{}] {}: invalid type tag {}".format(name, key, key[:2]))
+				continue
+			fields[key] = Field(key, parser, rules.get(key, NO_RULE))
+		return cls(name, fields, errors)
+
+	def load(self, items):
+		"""Parse the (key, value) pairs of a section. Returns ([(key, parsed value)], [every error])"""
+		values = []
+		errors = list(self.errors)
+		for key, value in items:
+			field = self.fields.get(key)
+			if field is None:
+				continue	# Reported by compile already
+			try:
+				values.append((key, field.parse(value)))
+			except (ValueError, TypeError) as e:
+				errors.append("[{}] {} = {}: {}".format(self.name, key, value, e))
+		return values, errors
+
+	def set(self, config, key, value):
+		"""set_config for the API: parse and validate value, then store it in config"""
+		field = self.fields.get(key)
+		if field is None:
+			return {"success": False, "message": "Key {} not present in target configuration dict".format(key)}
+		if field.read_only:
+			return {"success": False, "message": "Modification of {} is not allowed".format(key)}
+		try:
+			config[key] = field.parse(value)
+		except Exception as e:
+			return {"success": False, "message": "Exception occurred: {}".format(str(e))}
+		return {"success": True, "config": config}
+
+
+class Configurable(object):
+
+	# set_config of every subsystem, the server compiles self.schema from the subsystem's section and its config_rules
+	# and attaches it right after construction
+
+	config_rules = {}
+
+	def store_config(self, key, value):
+		"""Parse and store a value without acting on it, bulk changes store every value under a lock first"""
+		return self.schema.set(self.config, key, value)
+
+	def config_applied(self, keys):
+		"""Act on stored keys, e.g. retune a running receiver. Called outside any lock, None when there is nothing to do"""
+		return None
+
+	def set_config(self, key, value):
+		result = self.store_config(key, value)
+		if result["success"]:
+			# The value is kept when acting on it fails (it still applies on the next start), the failure is a warning
+			applied = self.config_applied([key])
+			if applied is not None and not applied["success"]:
+				result["warning"] = applied.get("message")
+		return result
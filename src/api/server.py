@@ -3,19 +3,96 @@
 
 __author__ = 'Tom Mladenov'
 
-import systems
-import RPi.GPIO as GPIO
-import board
+import hardware
+import admission
+from executor import SubsystemExecutor
+from jobs import JobRegistry
+from control import ControlChannel
+from warmstart import WarmStartCache
+from profiles import Orchestrator
+from configwriter import ConfigWriter
+from configwatch import ConfigWatcher
+from lifecycle import Lifecycle
+from schema import Schema
+import state
+import threading
 from threading import Thread
 from configparser import ConfigParser
+import importlib
 import json
 import subprocess
 import time
 import os
-from influxdb import InfluxDBClient
 import datetime
 
 
+# Subsystem classes by the s_class name config.ini sections use, as module:attribute. A class is only imported once an
+# enabled section needs it; other packages can add classes through the "cyberdeck.subsystems" entry point group and a
+# section may also name any class directly as module:Class.
+SYSTEM_CLASSES = {
+    "OBC":                  "systems:OBC",
+    "Display":              "systems:Display",
+    "Battery":              "systems:Battery",
+    "DCDC":                 "systems:DCDC",
+    "Audio":                "systems:Audio",
+    "USB":                  "systems:USB",
+    "LAN":                  "systems:LAN",
+    "WLAN":                 "systems:WLAN",
+    "Bluetooth":            "systems:Bluetooth",
+    "GPS":                  "systems:GPS",
+    "RigCtl":               "systems:RigCtl",
+    "RF":                   "systems:RF",
+    "Indicator":            "systems:Indicator",
+    "Publisher":            "systems:Publisher",
+    "Clock":                "systems:Clock",
+    "APRS":                 "systems:APRS",
+    "AIS":                  "systems:AIS",
+    "VDL":                  "systems:VDL",
+    "ACARS":                "systems:ACARS",
+    "ISM":                  "systems:ISM",
+    "ADSB":                 "systems:ADSB",
+    "RS":                   "systems:RS",
+    "RTLTCP":               "systems:RTLTCP",
+    "GQRX":                 "systems:GQRX",
+    "Proxy":                "systems:Proxy",
+    "Subscriber":           "systems:Subscriber",
+    "Application":          "systems:Application",
+    "Gpredict":             "systems:Gpredict",
+    "Database":             "systems:Database",
+    "StatusTableWriter":    "statustable:StatusTableWriter",
+}
+
+_loaded_classes = {}
+_classes_lock = threading.Lock()
+
+
+def load_class(name):
+    with _classes_lock:
+        if name not in _loaded_classes:
+            target = SYSTEM_CLASSES.get(name)
+            if target is None:
+                from importlib.metadata import entry_points
+                try:
+                    group = entry_points(group="cyberdeck.subsystems")
+                except TypeError:
+                    group = entry_points().get("cyberdeck.subsystems", [])  # Python < 3.10
+                for entry_point in group:
+                    if entry_point.name == name:
+                        target = entry_point.value
+                        break
+            if target is None and ":" in name:
+                target = name
+            if target is None:
+                raise ValueError("Unknown subsystem class {}".format(name))
+
+            module, colon, attribute = target.partition(":")
+            _loaded_classes[name] = getattr(importlib.import_module(module), attribute)
+        return _loaded_classes[name]
+
+
+# Plain reads of the subsystem dicts, these never block and skip the subsystem queue
+INLINE_FUNCTIONS = ("get_status", "get_config", "get_configstatus")
+
 
 class Server(object):
 
@@ -29,171 +106,291 @@ class Server(object):
         config_path = os.path.join(script_dir, 'config.ini')
         # Initialize ConfigParser and read the configuration file
         self.configurator = ConfigParser()
+        # mtime of config.ini as last loaded or written: the config writer does not overwrite an edit made since
+        self.config_mtime = os.stat(config_path).st_mtime_ns
         self.configurator.read(config_path)
+        self.config_path = config_path
+        # Taken by the config writer and the config watcher around self.configurator and the file
+        self.config_lock = threading.RLock()
 
-        server_config = dict(self.load_config(self.configurator.items("server")))
+        server_config = dict(self.load_config(self.configurator.items("server"), "server"))
 
         self.host = server_config["s_server_host"]
         self.port = server_config["i_server_port"]
+        self.unix_socket = server_config["s_unix_socket"]
         self.s_header_description = server_config["s_header_description"]
 
-        GPIO.setmode(GPIO.BCM)
-        self.I2C_BUS = board.I2C()
-
-        # DEVICES
-        self.obc = systems.OBC(			self, dict(self.load_config(self.configurator.items("obc"))))
-        self.display = systems.Display(	self, dict(self.load_config(self.configurator.items("display"))))
-        self.battery = systems.Battery(	self, dict(self.load_config(self.configurator.items("battery"))))
-        self.dcdc = systems.DCDC(		self, dict(self.load_config(self.configurator.items("dcdc"))))
-        self.audio = systems.Audio(		self, dict(self.load_config(self.configurator.items("audio"))))
-        self.usb = systems.USB(			self, dict(self.load_config(self.configurator.items("usb"))))
-        self.lan = systems.LAN(			self, dict(self.load_config(self.configurator.items("lan"))))
-        self.wlan = systems.WLAN(		self, dict(self.load_config(self.configurator.items("wlan"))))
-        self.bluetooth = systems.Bluetooth(		self, dict(self.load_config(self.configurator.items("bluetooth"))))
-        self.gps = systems.GPS(			self, dict(self.load_config(self.configurator.items("gps"))))
-        self.rigctl = systems.RigCtl(	self, dict(self.load_config(self.configurator.items("rigctl"))))
-        self.rf = systems.RF(			self, dict(self.load_config(self.configurator.items("rf"))))
-        self.indicator = systems.Indicator(self, dict(self.load_config(self.configurator.items("indicator"))))
-        self.publisher = systems.Publisher(self, dict(self.load_config(self.configurator.items("publisher"))))
-        self.clock = systems.Clock(self, dict(self.load_config(self.configurator.items("clock"))))
-        self.database = systems.Database(self, dict(self.load_config(self.configurator.items("database"))))
-
-        # PROCESSES
-        self.aprs = systems.APRS(self, 		dict(self.load_config(self.configurator.items("aprs"))))
-        self.ais = systems.AIS(self, 		dict(self.load_config(self.configurator.items("ais"))))
-        self.rtltcp1 = systems.RTLTCP(self, dict(self.load_config(self.configurator.items("rtltcp1"))))
-        self.rtltcp2 = systems.RTLTCP(self, dict(self.load_config(self.configurator.items("rtltcp2"))))
-        self.rs1 = systems.RS(self, 		dict(self.load_config(self.configurator.items("rs1"))))
-        self.rs2 = systems.RS(self, 		dict(self.load_config(self.configurator.items("rs2"))))
-        self.acars = systems.ACARS(self, 	dict(self.load_config(self.configurator.items("acars"))))
-        self.vdl = systems.VDL(self, 		dict(self.load_config(self.configurator.items("vdl"))))
-        self.ism = systems.ISM(self, 		dict(self.load_config(self.configurator.items("ism"))))
-        self.gqrx = systems.GQRX(self, 		dict(self.load_config(self.configurator.items("gqrx"))))
-        self.proxy = systems.Proxy(self, 		dict(self.load_config(self.configurator.items("proxy"))))
-        self.subscriber = systems.Subscriber(self, 		dict(self.load_config(self.configurator.items("subscriber"))))
-
-        # APPLICATIONS
-        self.opencpn = 		systems.Application(self, dict(self.load_config(self.configurator.items("opencpn"))))
-        self.fldigi = 		systems.Application(self, dict(self.load_config(self.configurator.items("fldigi"))))
-        self.keyboard = 	systems.Application(self, dict(self.load_config(self.configurator.items("keyboard"))))
-        self.navigation = 	systems.Application(self, dict(self.load_config(self.configurator.items("navigation"))))
-        self.gpredict = 	systems.Gpredict(self, dict(self.load_config(self.configurator.items("gpredict"))))
-        self.vnc1 = 	systems.Application(self, dict(self.load_config(self.configurator.items("vnc1"))))
-        self.vnc2 = 	systems.Application(self, dict(self.load_config(self.configurator.items("vnc2"))))
-
-        self.systems = [
-            self.obc,
-            self.display,
-            self.battery,
-            self.dcdc,
-            self.audio,
-            self.usb,
-            self.lan,
-            self.wlan,
-            self.bluetooth,
-            self.gps,
-            self.rigctl,
-            self.rf,
-            self.indicator,
-            self.publisher,
-            self.clock,
-            self.aprs,
-            self.ais,
-            self.vdl,
-            self.acars,
-            self.ism,
-            self.rs1,
-            self.rs2,
-            self.rtltcp1,
-            self.rtltcp2,
-            self.gqrx,
-            self.proxy,
-            self.subscriber,
-            self.opencpn,
-            self.fldigi,
-            self.keyboard,
-            self.navigation,
-            self.gpredict,
-            self.vnc1,
-            self.vnc2,
-            # self.gqrx,
-        ]
+        # Blocking subsystem actions invoked through the API run here, serialized per subsystem
+        self.executor = SubsystemExecutor(server_config["i_worker_threads"])
+        # Slow actions submitted as background jobs, see jobs.py
+        self.jobs = JobRegistry(self.executor, server_config["f_job_timeout"], server_config["i_max_finished_jobs"])
 
-        # Start threads
-        # = [system.start() for system in self.systems if isinstance(system, Thread)]
+        # Real or simulated hardware, see [hardware] in config.ini
+        self.hardware = hardware.load_backend(dict(self.load_config(self.configurator.items("hardware"), "hardware")))
+        self.hardware.gpio.setmode(self.hardware.gpio.BCM)
+
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self.max_poll_wait = server_config["i_max_poll_wait"]
+        self.max_stream_rate = server_config["f_max_stream_rate"]
+        self.stream_keepalive = server_config["i_stream_keepalive"]
+        self.max_batch_wait = server_config["i_max_batch_wait"]
+
+        # Admission control lanes for the API, see admission.py
+        self.lanes = {lane: admission.Lane(lane, server_config["i_{}_concurrency".format(lane)], server_config["i_{}_queue".format(lane)], \
+                                           server_config["f_admission_wait"]) for lane in admission.LANES}
+        self.retry_after = server_config["i_retry_after"]
+
+        # Every config.ini section with an s_class is a subsystem, its server attribute carries the section name, e.g.
+        # self.rf. Sections with b_enabled = no are not even imported, b_service = yes ones are not exposed through the API
+        self.sections = []
+        self.api_sections = []
+        for section in self.configurator.sections():
+            if not self.configurator.has_option(section, "s_class") or not self.configurator.getboolean(section, "b_enabled", fallback=True):
+                continue
+            self.sections.append(section)
+            if not self.configurator.getboolean(section, "b_service", fallback=False):
+                self.api_sections.append(section)
+
+        # Every subsystem section is parsed and checked against the config_rules of its class before anything is
+        # constructed, so one boot reports every mistake in config.ini, see schema.py
+        self.schemas = {}
+        self.section_configs = {}
+        errors = []
+        for section in self.sections:
+            try:
+                rules = getattr(load_class(self.configurator.get(section, "s_class")), "config_rules", {})
+            except (ImportError, AttributeError, ValueError) as e:
+                errors.append("[{}] s_class = {}: {}".format(section, self.configurator.get(section, "s_class"), e))
+                continue
+            items = self.configurator.items(section)
+            schema = Schema.compile(section, [key for key, value in items], rules)
+            values, section_errors = schema.load(items)
+            errors.extend(section_errors)
+            self.schemas[section] = schema
+            self.section_configs[section] = values
+        if errors:
+            raise RuntimeError("config.ini has {} error(s):\n  {}".format(len(errors), "\n  ".join(errors)))
+
+        # Subsystems are constructed concurrently, each one only after the subsystems it requires
+        self.lifecycle = Lifecycle(server_config["i_boot_workers"])
+        for section in self.sections:
+            requires = json.loads(self.configurator.get(section, "l_requires", fallback="[]"))
+            self.lifecycle.add(section, requires, \
+                               start_deadline=self.configurator.getfloat(section, "f_start_deadline", fallback=server_config["f_start_deadline"]), \
+                               stop_deadline=self.configurator.getfloat(section, "f_stop_deadline", fallback=server_config["f_stop_deadline"]))
+
+        self.lifecycle.run_phase("construct", self._construct_system)
+        if self.lifecycle.failures["construct"]:
+            print(self.lifecycle.report(["construct"]))
+            raise RuntimeError("Server could not construct {}".format(", ".join(self.lifecycle.failures["construct"])))
+
+        # In config.ini order, indexed by s_id for lookups
+        self.systems = [getattr(self, section) for section in self.api_sections]
+        self.systems_by_id = {system.config["s_id"]: system for system in self.systems}
+
+        # Dispatch table for the API, built once: s_id -> {function name -> bound method}
+        self.dispatch = {}
         for system in self.systems:
-            if isinstance(system, Thread):
-                system.start()
-                time.sleep(1)
-
-
-    def str2bool(self, v):
-      return v.lower() in ("yes", "true", "t", "1")
-
-    def load_config(self, items):
-        result = []
-        for (key, value) in items:
-            type_tag = key[:2]
-            if type_tag == "s_":
-                result.append((key, value))
-            elif type_tag == "f_":
-                result.append((key, float(value)))
-            elif type_tag == "b_":
-                result.append((key, self.str2bool(value)))
-            elif type_tag == "i_":
-                result.append((key, int(value)))
-            elif type_tag == "l_":
-                result.append((key, json.loads(value)))
-            else:
-                raise ValueError('Invalid type tag {T} found in ini file at key {K}, value {V}'.format(T=type_tag, K=key, V=value))
-
-        return result
+            self.dispatch[system.config["s_id"]] = {name: getattr(system, name) for name in system.capabilities}
+
+        # Last known measurements from before the restart, until the polling threads have fresh ones, see warmstart.py
+        self.warmstart = None
+        if server_config["s_warm_cache"]:
+            self.warmstart = WarmStartCache(self, server_config["s_warm_cache"], server_config["f_warm_period"])
+            print("Restored {} status values from {}".format(self.warmstart.restore(), server_config["s_warm_cache"]))
+
+        # Start threads
+        self.lifecycle.run_phase("start", self._start_system, names=self._thread_sections())
+        print(self.lifecycle.report(["construct", "start"]))
+
+        if self.warmstart is not None:
+            self.warmstart.start()
+
+        # config.ini is saved in the background, once per burst of changes, see configwriter.py
+        self.config_writer = ConfigWriter(self, self.config_path, server_config["f_save_debounce"], server_config["f_save_max_delay"])
+        self.config_writer.start()
+
+        # Edits to config.ini are applied to the running subsystems, see configwatch.py
+        self.pending_restart = {}
+        self.config_watcher = None
+        if server_config["b_hot_reload"]:
+            self.config_watcher = ConfigWatcher(self, self.config_path, server_config["f_reload_settle"])
+            self.config_watcher.start()
+
+        # Named deck setups from the [profile.*] sections, see profiles.py
+        self.profiles = Orchestrator(self, server_config["i_boot_workers"], server_config["f_start_deadline"])
+
+        # ZMQ command channel next to HTTP, see control.py
+        self.control = None
+        if server_config["s_control_endpoint"]:
+            self.control = ControlChannel(self, server_config["s_control_endpoint"], server_config["s_control_ipc"])
+            self.control.start()
+
+    def invoke(self, system, function_name, args=None, job=False, timeout=None):
+        """Call a subsystem function from the dispatch table. Returns the result of inline reads, the job of job=True
+        calls, and for any other action a Future of its result from the subsystem executor"""
+        functions = self.dispatch.get(system)
+        if functions is None:
+            return {"success": False, "response": "System with provided ID not found"}
+
+        target_function = functions.get(function_name)
+        if target_function is None:
+            return {"success": False, "response": "Function {} not supported by system {}".format(function_name, system)}
+
+        args = args or []
+        if function_name in INLINE_FUNCTIONS:
+            return target_function(*args)
+        elif job:
+            # Answer with the job right away, the client follows it on /jobs/{job_id}
+            return self.jobs.submit(system, function_name, target_function, args, timeout)
+        else:
+            # Blocking actions run on the worker pool, in order per subsystem
+            return self.executor.submit(system, target_function, *args)
+
+    def update_config(self, changes, persist=True):
+        """Future of the set_configs result"""
+        return self.executor.submit("config", self.set_configs, changes, persist)
+
+    def apply_profile(self, name, job=False):
+        """Future of the profile transition report, or its job with job=True. Transitions run one at a time"""
+        if job:
+            return self.jobs.submit("profiles", "apply", self.profiles.apply, [name])
+        return self.executor.submit("profiles", self.profiles.apply, name)
+
+    def _construct_system(self, section):
+        system_class = load_class(self.configurator.get(section, "s_class"))
+        system = system_class(self, state.VersionedDict(self.section_configs[section]))
+        system.schema = self.schemas[section]
+        # Set right away, subsystems requiring this one look it up on the server while being constructed
+        setattr(self, section, system)
+        return system
+
+    def _start_system(self, section):
+        getattr(self, section).start()
+
+    def _stop_system(self, section):
+        getattr(self, section)._shutdown_thread()
+
+    def _thread_sections(self):
+        return [section for section in self.sections if isinstance(getattr(self, section), Thread)]
+
+    def load_config(self, items, name="config"):
+        """Typed (key, value) pairs of a config section, a ValueError lists every value that could not be parsed"""
+        items = list(items)
+        values, errors = Schema.compile(name, [key for key, value in items]).load(items)
+        if errors:
+            raise ValueError("; ".join(errors))
+        return values
 
     def get_systems(self):
         return {"success": True, "systems": [s.config["s_id"] for s in self.systems]}
 
+    def snapshot(self):
+        """Immutable copy of every subsystem config and status, rebuilt only when some subsystem changed since the last one"""
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != state.current_version():
+            with self._snapshot_lock:
+                snapshot = self._snapshot
+                version = state.current_version()
+                if snapshot is None or snapshot.version != version:
+                    snapshot = state.Snapshot.capture(version, self.systems)
+                    self._snapshot = snapshot
+        return snapshot
+
     def get_status(self):
-        status = []
-        indexes = range(len(self.systems))
-        keys = [s.config["s_id"] for s in self.systems]
-        statuses = [s.status for s in self.systems]
-        for i in indexes:
-            status.append({"id": keys[i], "status": statuses[i]})
-        return {"success": True, "status": status}
+        return self.snapshot().view("status")
 
     def get_config(self):
-        config = []
-        indexes = range(len(self.systems))
-        keys = [s.config["s_id"] for s in self.systems]
-        configs = [s.config for s in self.systems]
-        for i in indexes:
-            config.append({"id": keys[i], "config": configs[i]})
-        return {"success": True, "config": config}
+        return self.snapshot().view("config")
 
     def get_configstatus(self):
-        configstatus = []
-        indexes = range(len(self.systems))
-        keys = [s.config["s_id"] for s in self.systems]
-        configs = [s.config for s in self.systems]
-        statuses = [s.status for s in self.systems]
-        for i in indexes:
-             configstatus.append({"id": keys[i], "config": configs[i], "status": statuses[i]})
-        return {"success": True, "configstatus": configstatus}
-
-    def save_config(self):
-        current_config = self.get_config()["config"]
-        self.configurator.read_dict(current_config)
-        with open('config.ini', 'w') as f:
-            self.configurator.write(f)
-        return {"success": True}
+        return self.snapshot().view("configstatus")
+
+    def save_config(self, wait=False):
+        """Schedule config.ini to be written, with wait=True write it right away and report how that went"""
+        self.config_writer.request()
+        if wait:
+            return self.config_writer.flush()
+        return {"success": True, "response": "Scheduled"}
+
+    def set_configs(self, changes, persist=True):
+        """Apply {s_id: {key: value}} across subsystems as one change: every value is checked against the schemas
+        before any is set, and the ones already set are rolled back when a subsystem still refuses its value.
+        Runs on the "config" executor queue, one bulk change at a time"""
+        errors = []
+        parsed = []
+        for s_id, values in changes.items():
+            system = self.systems_by_id.get(s_id)
+            if system is None:
+                errors.append("System {} not found".format(s_id))
+                continue
+            if not hasattr(system, "store_config"):
+                errors.append("[{}] configuration cannot be changed".format(s_id))
+                continue
+            for key, value in values.items():
+                field = system.schema.fields.get(key)
+                if field is None:
+                    errors.append("[{}] {}: not present in target configuration dict".format(s_id, key))
+                elif field.read_only:
+                    errors.append("[{}] {}: modification is not allowed".format(s_id, key))
+                else:
+                    try:
+                        parsed.append((system, key, field.parse(value)))
+                    except Exception as e:
+                        errors.append("[{}] {} = {}: {}".format(s_id, key, value, e))
+        if errors:
+            return {"success": False, "response": errors}
+
+        applied = []
+        # Snapshots wait on this lock while they are rebuilt, so no reader sees half of the change. Only the values are
+        # stored under it, anything slow a subsystem does with them (network, processes) runs after it is released
+        with self._snapshot_lock:
+            for system, key, value in parsed:
+                previous = system.config[key]
+                try:
+                    result = system.store_config(key, value)
+                except Exception as e:
+                    result = {"success": False, "message": "Exception occurred: {}".format(e)}
+                if not result.get("success"):
+                    for applied_system, applied_key, applied_previous in reversed(applied):
+                        applied_system.store_config(applied_key, applied_previous)
+                    return {"success": False, "response": ["[{}] {}: {}".format(system.config["s_id"], key, result.get("message"))]}
+                applied.append((system, key, previous))
+
+        warnings = []
+        for s_id, values in changes.items():
+            result = self.systems_by_id[s_id].config_applied(list(values))
+            if result is not None and not result["success"]:
+                warnings.append("[{}] {}".format(s_id, result.get("message") or result.get("response")))
+
+        if persist:
+            self.config_writer.request()
+        response = {"success": True, "response": {s_id: {key: self.systems_by_id[s_id].config[key] for key in values} for s_id, values in changes.items()}}
+        if warnings:
+            response["warnings"] = warnings
+        return response
 
     def stop_threads(self):
-        status = [system._shutdown_thread() for system in self.systems if isinstance(system, Thread)]
+        # Everything submitting to the executor is stopped before it
+        if self.control is not None:
+            self.control._shutdown_thread()
+        if self.config_watcher is not None:
+            self.config_watcher._shutdown_thread()
+        self.executor.shutdown()
+        if self.warmstart is not None:
+            # Saved while the subsystems still hold their last readings
+            self.warmstart._shutdown_thread()
+        # Changes still settling are written while the subsystems hold their config
+        self.config_writer._shutdown_thread()
+        # Subsystems are stopped before the subsystems they require
+        self.lifecycle.run_phase("stop", self._stop_system, names=self._thread_sections(), reverse=True)
+        print(self.lifecycle.report(["stop"]))
 
     def shutdown(self):
         self.stop_threads()
-        subprocess.run(["sudo shutdown now"], shell=True)
+        self.hardware.run("sudo shutdown now")
 
     def reboot(self):
         self.stop_threads()
-        subprocess.run(["sudo reboot now"], shell=True)
+        self.hardware.run("sudo reboot now")
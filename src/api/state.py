@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Versioned subsystem state. The config and status dicts of every subsystem are VersionedDicts: each change takes a
+# number from one counter shared by all of them, so the server can tell with a single comparison whether anything
+# changed since its last snapshot. A Snapshot is an immutable copy of all subsystems at one version which is encoded
+# (JSON for the API, pickle for the Publisher) at most once per format, however many readers share it.
+
+import asyncio
+import hashlib
+import json
+import pickle
+import threading
+
+_lock = threading.Lock()
+_version = 0
+_waiters = set()	# (event loop, future) of long-polling requests waiting for the next change
+
+_MISSING = object()
+
+# Dict sections each snapshot view carries per subsystem
+VIEWS = {"status": ("status",), "config": ("config",), "configstatus": ("config", "status")}
+
+
+def current_version():
+	return _version
+
+
+def _bump():
+	global _version
+	with _lock:
+		_version += 1
+		version = _version
+		waiters = list(_waiters)
+		_waiters.clear()
+
+	for loop, future in waiters:
+		try:
+			loop.call_soon_threadsafe(_wake, future)
+		except RuntimeError:
+			pass	# Loop already closed, nobody is waiting anymore
+	return version
+
+
+def _wake(future):
+	if not future.done():
+		future.set_result(None)
+
+
+async def wait_for_version(since, timeout):
+	"""Wait until the state version is past since, at most timeout seconds. Returns the current version."""
+	loop = asyncio.get_running_loop()
+	deadline = loop.time() + timeout
+	while _version <= since:
+		remaining = deadline - loop.time()
+		if remaining <= 0:
+			break
+
+		waiter = (loop, loop.create_future())
+		with _lock:
+			if _version > since:
+				break
+			_waiters.add(waiter)
+		try:
+			await asyncio.wait_for(waiter[1], remaining)
+		except asyncio.TimeoutError:
+			pass
+		finally:
+			with _lock:
+				_waiters.discard(waiter)
+	return _version
+
+
+class VersionedDict(dict):
+
+	# Only the mutating methods used on subsystem dicts need to record a version, reads are plain dict reads
+
+	def __init__(self, *args, **kwargs):
+		super(VersionedDict, self).__init__(*args, **kwargs)
+		self.stale = {}		# key -> time of a value restored from before a restart, until a fresh reading is set
+		self.version = _bump()
+
+	def __setitem__(self, key, value):
+		old = dict.get(self, key, _MISSING)
+		if old is value or (type(old) is type(value) and old == value):
+			# Polling threads rewrite unchanged readings all the time, these are not changes. Unless the value was
+			# restored, then the reading confirms it and only its stale marker goes
+			if self.stale and self.stale.pop(key, None) is not None:
+				self.version = _bump()
+			return
+		if self.stale:
+			self.stale.pop(key, None)
+		dict.__setitem__(self, key, value)
+		self.version = _bump()
+
+	def restore(self, values):
+		"""Set last known values of existing keys, {key: (value, known since)}, marked stale until they are set again"""
+		for key, (value, since) in values.items():
+			if key in self:
+				dict.__setitem__(self, key, value)
+				self.stale[key] = since
+		self.version = _bump()
+
+	def __delitem__(self, key):
+		dict.__delitem__(self, key)
+		self.version = _bump()
+
+	def update(self, *args, **kwargs):
+		for key, value in dict(*args, **kwargs).items():
+			self[key] = value
+
+	def setdefault(self, key, default=None):
+		if key not in self:
+			self[key] = default
+		return self[key]
+
+	def pop(self, key, *args):
+		result = dict.pop(self, key, *args)
+		self.version = _bump()
+		return result
+
+	def clear(self):
+		dict.clear(self)
+		self.version = _bump()
+
+
+class Snapshot(object):
+
+	def __init__(self, version, systems):
+		# systems: [(s_id, config, status)] with plain dict copies that nobody modifies afterwards
+		self.version = version
+		self.systems = tuple(systems)
+		self.versions = {}
+		self.stale = {}		# s_id -> {status key: stale since}, only for systems with stale values
+		self._views = {}
+		self._encoded = {}
+
+	@classmethod
+	def capture(cls, version, systems):
+		# dict() of a dict is a single C level copy, safe against polling threads adding keys meanwhile
+		snapshot = cls(version, [(s.config["s_id"], dict(s.config), dict(s.status)) for s in systems])
+		snapshot.versions = {s.config["s_id"]: max(s.config.version, s.status.version) for s in systems}
+		snapshot.stale = {s.config["s_id"]: dict(s.status.stale) for s in systems if s.status.stale}
+		return snapshot
+
+	def view(self, name, systems=None, fields=None):
+		"""Status, config or configstatus view, optionally limited to systems (s_id or s_type) and projected on
+		fields ("status.lat", "config.i_freq", a bare key for either section, or a whole section name)"""
+		key = (name, systems, fields)
+		if key not in self._views:
+			self._views[key] = self._project(name, systems, fields)
+		return self._views[key]
+
+	def _project(self, name, systems, fields):
+		if name not in VIEWS:
+			raise ValueError("Unknown snapshot view {}".format(name))
+		sections = VIEWS[name]
+
+		selected = self.systems
+		if systems:
+			unknown = [s for s in systems if not any(s == i or s == c.get("s_type") for i, c, st in self.systems)]
+			if unknown:
+				raise ValueError("No system matches {}".format(", ".join(unknown)))
+			selected = [(i, c, st) for i, c, st in self.systems if i in systems or c.get("s_type") in systems]
+
+		# section -> set of keys, None for the whole section
+		keys = dict.fromkeys(sections) if not fields else {section: set() for section in sections}
+		for field in fields or ():
+			section, dot, key = field.partition(".")
+			if not dot and field in sections:
+				keys[field] = None
+			elif not dot:
+				for section in sections:
+					if keys[section] is not None:
+						keys[section].add(field)
+			elif section in sections:
+				if keys[section] is not None:
+					keys[section].add(key)
+			else:
+				raise ValueError("Field {} is not in {}".format(field, " or ".join(sections)))
+
+		items = []
+		for s_id, config, status in selected:
+			item = {"id": s_id}
+			for section, values in (("config", config), ("status", status)):
+				if section not in keys:
+					continue
+				if keys[section] is None:
+					item[section] = values
+				else:
+					projected = {k: v for k, v in values.items() if k in keys[section]}
+					if projected:
+						item[section] = projected
+
+			# Status values restored at boot which no fresh reading replaced yet, with the time they were last known
+			stale = self.stale.get(s_id)
+			if stale and "status" in item:
+				stale = {k: since for k, since in stale.items() if k in item["status"]}
+				if stale:
+					item["stale"] = stale
+			items.append(item)
+
+		return {"success": True, name: items}
+
+	def json(self, name, systems=None, fields=None):
+		key = ("json", name, systems, fields)
+		if key not in self._encoded:
+			self._encoded[key] = json.dumps(self.view(name, systems, fields), default=str).encode('utf-8')
+		return self._encoded[key]
+
+	def etag(self, name, systems=None, fields=None):
+		# Content based, so a projection keeps its tag while only unselected fields change
+		key = ("etag", name, systems, fields)
+		if key not in self._encoded:
+			self._encoded[key] = '"{}"'.format(hashlib.blake2b(self.json(name, systems, fields), digest_size=8).hexdigest())
+		return self._encoded[key]
+
+	def pickle(self, name):
+		key = ("pickle", name)
+		if key not in self._encoded:
+			self._encoded[key] = pickle.dumps(self.view(name))
+		return self._encoded[key]
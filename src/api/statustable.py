@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Fixed-layout status table in shared memory for readers on the deck itself (GUI, the I2C controller, scripts). The
+# server writes a configured set of status values whenever the state version moves; readers map the same block and
+# copy the values out without sockets or serialization.
+#
+# Block layout: a 32 byte header (HEADER.size; magic, layout size, sequence, state version, update time), the layout as
+# JSON, then the values at 8 byte aligned offsets. Numbers are float64 (NaN when missing), strings fixed-size UTF-8,
+# zero padded.
+# Writes are guarded by a seqlock: the sequence is odd while the writer is busy, a reader retries whenever it saw an
+# odd sequence or the sequence changed under it.
+#
+# Reader usage, without the server (state.py, imported here, only needs the standard library):
+#   table = StatusTable()
+#   table.read()["values"]["gps.lat"]
+
+import json
+import struct
+import time
+from threading import Thread
+
+import state
+
+MAGIC = b"CDST"
+HEADER = struct.Struct("<4sIQQd")	# magic, layout size, sequence, state version, update time
+SEQUENCE_OFFSET = 8
+DEFAULT_NAME = "cyberdeck_status"
+
+
+def _align(offset):
+	return (offset + 7) & ~7
+
+
+def parse_fields(specs):
+	"""["gps.lat", "battery.charge_state:16"] -> [(field, system, key, struct format)], a :N suffix is a string of N bytes"""
+	fields = []
+	for spec in specs:
+		field, colon, size = spec.partition(":")
+		system, dot, key = field.partition(".")
+		if not dot:
+			raise ValueError("Status table field {} is not system.key".format(spec))
+		fields.append((field, system, key, "{}s".format(int(size)) if colon else "d"))
+	return fields
+
+
+def layout(fields):
+	"""Encoded layout, offset of every field and the total block size"""
+	encoded = json.dumps([[field, fmt] for field, system, key, fmt in fields]).encode('utf-8')
+	offset = _align(HEADER.size + len(encoded))
+	offsets = []
+	for field, system, key, fmt in fields:
+		offsets.append(offset)
+		offset = _align(offset + struct.calcsize(fmt))
+	return encoded, offsets, offset
+
+
+class StatusTableWriter(Thread):
+
+	capabilities = ("get_status", "get_config")
+
+	def __init__(self, parent, config):
+		from multiprocessing import shared_memory
+
+		Thread.__init__(self)
+		self.parent = parent
+		self.config = config
+		self.name = self.config["s_id"]
+		self.running = True
+
+		self.fields = parse_fields(self.config["l_fields"])
+		encoded, self.offsets, size = layout(self.fields)
+
+		try:
+			self.shm = shared_memory.SharedMemory(name=self.config["s_shm_name"], create=True, size=size)
+		except FileExistsError:
+			# Left behind by a server that did not shut down cleanly, its layout may differ
+			stale = shared_memory.SharedMemory(name=self.config["s_shm_name"])
+			stale.close()
+			stale.unlink()
+			self.shm = shared_memory.SharedMemory(name=self.config["s_shm_name"], create=True, size=size)
+
+		self.buffer = self.shm.buf
+		self.buffer[HEADER.size:HEADER.size + len(encoded)] = encoded
+		HEADER.pack_into(self.buffer, 0, MAGIC, len(encoded), 0, 0, 0.0)
+		self.sequence = 0
+		self.version = None
+
+	def write(self, snapshot):
+		statuses = {s_id: status for s_id, config, status in snapshot.systems}
+
+		self.sequence += 1
+		struct.pack_into("<Q", self.buffer, SEQUENCE_OFFSET, self.sequence)
+		for (field, system, key, fmt), offset in zip(self.fields, self.offsets):
+			value = statuses.get(system, {}).get(key)
+			if fmt == "d":
+				try:
+					value = float(value)
+				except (TypeError, ValueError):
+					value = float("nan")
+			else:
+				value = str(value if value is not None else "").encode('utf-8')
+			struct.pack_into("<" + fmt, self.buffer, offset, value)
+		struct.pack_into("<Qd", self.buffer, SEQUENCE_OFFSET + 8, snapshot.version, time.time())
+		self.sequence += 1
+		struct.pack_into("<Q", self.buffer, SEQUENCE_OFFSET, self.sequence)
+
+	def run(self):
+		while self.running:
+			if self.version != state.current_version():
+				snapshot = self.parent.snapshot()
+				self.write(snapshot)
+				self.version = snapshot.version
+			time.sleep(self.config["f_period"])
+
+	def get_status(self):
+		return {"success": True, "status": {"sequence": self.sequence, "version": self.version}}
+
+	def get_config(self):
+		return {"success": True, "config": self.config}
+
+	def _shutdown_thread(self):
+		self.running = False
+		self.join()
+		self.buffer.release()
+		self.shm.close()
+		self.shm.unlink()
+
+
+class StatusTable(object):
+
+	def __init__(self, name=DEFAULT_NAME, retries=1000):
+		from multiprocessing import shared_memory
+
+		try:
+			self.shm = shared_memory.SharedMemory(name=name, track=False)
+		except TypeError:
+			# Before Python 3.13 every attached process registers the block and unlinks it on exit, undo that
+			from multiprocessing import resource_tracker
+			self.shm = shared_memory.SharedMemory(name=name)
+			resource_tracker.unregister(self.shm._name, "shared_memory")
+
+		self.buffer = self.shm.buf
+		magic, layout_size, sequence, version, updated = HEADER.unpack_from(self.buffer, 0)
+		if magic != MAGIC:
+			raise ValueError("Shared memory block {} is not a status table".format(name))
+
+		specs = json.loads(bytes(self.buffer[HEADER.size:HEADER.size + layout_size]))
+		self.fields = [field for field, fmt in specs]
+		self.values_offset = _align(HEADER.size + layout_size)
+
+		# One unpack for every value, the padding between them skipped by the format
+		formats = []
+		offset = cursor = self.values_offset
+		for field, fmt in specs:
+			formats.append("{}x{}".format(offset - cursor, fmt) if offset > cursor else fmt)
+			cursor = offset + struct.calcsize("<" + fmt)
+			offset = _align(cursor)
+		self.values = struct.Struct("<" + "".join(formats))
+		self.retries = retries
+
+	def read(self):
+		"""{"version", "updated", "values": {field: value}}, a consistent copy of the table"""
+		for attempt in range(self.retries):
+			before = struct.unpack_from("<Q", self.buffer, SEQUENCE_OFFSET)[0]
+			if before & 1:
+				continue
+			values = self.values.unpack_from(self.buffer, self.values_offset)
+			version, updated = struct.unpack_from("<Qd", self.buffer, SEQUENCE_OFFSET + 8)
+			if struct.unpack_from("<Q", self.buffer, SEQUENCE_OFFSET)[0] == before:
+				break
+		else:
+			raise RuntimeError("Status table kept changing while being read")
+
+		values = [value.rstrip(b"\0").decode('utf-8', errors='replace') if isinstance(value, bytes) else value for value in values]
+		return {"version": version, "updated": updated, "values": dict(zip(self.fields, values))}
+
+	def get(self, field):
+		return self.read()["values"][field]
+
+	def close(self):
+		self.buffer.release()
+		self.shm.close()
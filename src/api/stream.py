@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Status change streams for the WebSocket and Server-Sent Events endpoints. Every client diffs the latest snapshot
+# against what it sent last, so a slow client simply gets one coalesced delta covering everything it missed instead
+# of a backlog of intermediate updates.
+
+import asyncio
+
+import state
+
+_MISSING = object()
+
+
+def _diff(old, new):
+	return {key: value for key, value in new.items() if old.get(key, _MISSING) != value}
+
+
+async def deltas(server, view, systems, fields, rate, keepalive):
+	"""Yields {"version", "full", "systems": [{"id", <section>: {changed keys}}]} whenever the selection changes,
+	at most rate times per second, or None after keepalive seconds without changes. The first message is full."""
+	interval = 1.0 / rate
+	sent = {}	# s_id -> last sent item
+	full = True
+	loop = asyncio.get_running_loop()
+	last_message = loop.time()	# Unrelated subsystems move the global version too, only messages hold the keepalive off
+
+	while True:
+		snapshot = server.snapshot()
+		items = snapshot.view(view, systems, fields)[view]
+
+		changes = []
+		for item in items:
+			previous = sent.get(item["id"])
+			if previous is None:
+				changes.append(item)
+			else:
+				change = {"id": item["id"]}
+				for section in state.VIEWS[view]:
+					diff = _diff(previous.get(section, {}), item.get(section, {}))
+					if diff:
+						change[section] = diff
+				if previous.get("stale") != item.get("stale"):
+					# Whole map, keys leave it as fresh readings replace restored values
+					change["stale"] = item.get("stale", {})
+				if len(change) > 1:
+					changes.append(change)
+			sent[item["id"]] = item
+
+		if changes or full:
+			yield {"version": snapshot.version, "full": full, "systems": changes}
+			last_message = loop.time()
+			full = False
+			# Rate limit, whatever changes meanwhile is coalesced into the next delta
+			await asyncio.sleep(interval)
+
+		remaining = last_message + keepalive - loop.time()
+		if remaining <= 0 or await state.wait_for_version(snapshot.version, remaining) <= snapshot.version:
+			yield None
+			last_message = loop.time()
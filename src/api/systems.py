@@ -5,42 +5,43 @@ __author__ = 'Tom Mladenov'
 
 import json
 import time
-import pyalsaaudio
 import subprocess
 import os
-import telnetlib
 import socket
-import gpsd
-import mgrs
-import zmq
 import sys
-from threading import Thread
+from threading import Lock, Thread
 import logging
-import re
-from enum import Enum
 import pickle
 import datetime
+import queue
 from configparser import ConfigParser
-import multiprocessing
-import pyais
-from influxdb import InfluxDBClient
 
-from adafruit_ina219 import ADCResolution, BusVoltageRange, INA219, Mode, Gain
-import board
-import RPi.GPIO as GPIO
-from rpi_backlight import Backlight
-import netifaces
-import Adafruit_ADS1x15
-from rtlsdr import RtlSdr
-from aprspy import APRS, PositionPacket, GenericPacket
-from aprspy.packets.position import CompressionFix, CompressionSource, CompressionOrigin
-from packet import Packet
+from state import VersionedDict
+from schema import Configurable, Rule, READ_ONLY
+import telemetry
 
+# Heavy or subsystem specific modules (zmq, pyais, aprspy, mgrs, influxdb) are imported by the subsystems
+# using them, so disabled or unused subsystems do not pay for them at server start
 
-class Process:
+
+def bind_ipc(zmq_socket, endpoint):
+	"""Also bind zmq_socket on an ipc:// endpoint for same-host peers, skipped when the endpoint is not configured"""
+	if endpoint:
+		os.makedirs(os.path.dirname(endpoint[len("ipc://"):]), exist_ok=True)
+		zmq_socket.bind(endpoint)
+
+
+class Process(Configurable):
 
 	# This class should be used for any programs that require a data source from a device as an input (either RF or audio, or another device)
 
+	# Functions that may be invoked through the API, the server builds its dispatch table from these
+	capabilities = ("get_status", "get_config", "set_config", "start_process", "stop_process")
+	# Checked by set_config and when config.ini is loaded, see schema.py
+	config_rules = {"i_gain": Rule(minimum=0, maximum=50), "i_freq": Rule(minimum=0), "i_samprate": Rule(minimum=1)}
+	# Config keys a running process picks up without a restart, every other key ends up on its command line
+	live_config = ("s_name",)
+
 	def __init__(self, parent, config):
 		self.parent = parent
 		self.config = config
@@ -51,9 +52,9 @@ class Process:
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0
-						}
+						})
 
 	def _run_executable(self):
 		#Populate this in the subclassing
@@ -66,7 +67,7 @@ class Process:
 			if self.parent.rf.status["{}_power".format(device)]:
 				try:
 					index = self.parent.rf.status["{}_index".format(device)]
-					sdr = RtlSdr(index)
+					sdr = self.parent.hardware.rtlsdr(index)
 					sdr.close()
 
 					if not self.status["running"]:
@@ -95,11 +96,11 @@ class Process:
 
 		#kill all subcommands (SIGTERM)
 		for command in self.commands:
-			subprocess.run(['pkill -f \'{}\''.format(command)], shell=True)
+			self.parent.hardware.run('pkill -f \'{}\''.format(command))
 
 		#If for some reason a sigterm did not work, perform an additional SIGKILL (last resort)
 		for command in self.commands:
-			subprocess.run(['pkill -s 9 -f \'{}\''.format(command)], shell=True)
+			self.parent.hardware.run('pkill -s 9 -f \'{}\''.format(command))
 
 		self.status["running"] = 0
 
@@ -112,59 +113,29 @@ class Process:
 	def get_config(self):
 		return {"success": True, "config": self.config}
 
-	def set_config(self, key, value):
-		if key == "s_id":
-			return {"success": False, "message": "Modification of s_id is not allowed"}
-		else:
-			if key in self.config:
-				try:
-					type_tag = key[:2]
-					if type_tag == "s_":
-						new_value = value
-						self.config[key] = new_value
-						if key in self.status:
-							self.status[key] = self.config[key]
-						return {"success": True, "config": self.config}
-					elif type_tag == "f_":
-						new_value = float(value)
-						self.config[key] = new_value
-						if key in self.status:
-							self.status[key] = self.config[key]
-						return {"success": True, "config": self.config}
-					elif type_tag == "b_":
-						if value.lower() in ["true", "True", "1", "yes", "false", "False", "0", "no"]:
-							new_value = int(self.parent.str2bool(value.lower()))
-							self.config[key] = new_value
-							if key in self.status:
-								self.status[key] = self.config[key]
-							return {"success": True, "config": self.config}
-						else:
-							return {"success": False, "message": "Value {} not valid boolean".format(value)}
-					elif type_tag == "i_":
-						new_value = int(value)
-						self.config[key] = new_value
-						if key in self.status:
-							self.status[key] = self.config[key]
-						return {"success": True, "config": self.config}
-					elif type_tag == "l_":
-						new_value = json.loads(value)
-						self.config[key] = new_value
-						if key in self.status:
-							self.status[key] = self.config[key]
-						return {"success": True, "config": self.config}
-
-
-
-				except Exception as e:
-					return {"success": False, "message": "Exception occurred: {}".format(str(e))}
+	def store_config(self, key, value):
+		result = Configurable.store_config(self, key, value)
+		# Config values a process reports in its status as well, e.g. the frequency it is tuned to
+		if result["success"] and key in self.status:
+			self.status[key] = self.config[key]
+		return result
+
+	def apply_config(self, keys):
+		"""Restart the process when it is running and one of the changed config keys is on its command line"""
+		if not self.status["running"] or set(keys).issubset(self.live_config):
+			return {"success": True, "restarted": False}
+		self.stop_process()
+		result = self.start_process() or {}
+		return {"success": result.get("success", False), "restarted": True, "response": result}
 
-			else:
-				return {"success": False, "message": "Key {} not present in target configuration dict".format(key)}
 
-class Application():
+class Application(Configurable):
 
 	#This class should be used for any standalone applications that do not direclty require a data input device
 
+	capabilities = ("get_status", "get_config", "get_configstatus", "set_config", "start_process", "stop_process")
+	config_rules = {"s_name": READ_ONLY, "s_type": READ_ONLY}
+
 	def __init__(self, parent, config):
 		self.parent = parent
 		self.config = config
@@ -173,20 +144,20 @@ class Application():
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0
-						}
+						})
 
-		subprocess.run(["../scripts/stop_{}.sh &".format(self.config["s_id"])], shell=True)
+		self.parent.hardware.run("../scripts/stop_{}.sh &".format(self.config["s_id"]))
 
 	#This class starts apps via scripts so that additional more complex gui (via e.g. xdotool) configuration can happen downstream
 	def start_process(self):
-		subprocess.run(["../scripts/start_{}.sh &".format(self.config["s_id"])], shell=True)
+		self.parent.hardware.run("../scripts/start_{}.sh &".format(self.config["s_id"]))
 		self.status["running"] = 1
 		return {"success": True, "status": self.status}
 
 	def stop_process(self):
-		subprocess.run(["../scripts/stop_{}.sh &".format(self.config["s_id"])], shell=True)
+		self.parent.hardware.run("../scripts/stop_{}.sh &".format(self.config["s_id"]))
 		self.status["running"] = 0
 		return {"success": True, "status": self.status}
 
@@ -201,44 +172,6 @@ class Application():
 		return {"success": True, "config": configstatus}
 
 
-	def set_config(self, key, value):
-		if key in ["s_id", "s_name", "s_type"]:
-			return {"success": False, "message": "Modification of s_id is not allowed"}
-		else:
-			if key in self.config:
-				try:
-					type_tag = key[:2]
-					if type_tag == "s_":
-						new_value = value
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "f_":
-						new_value = float(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "b_":
-						if value.lower() in ["true", "True", "1", "yes", "false", "False", "0", "no"]:
-							new_value = int(self.parent.str2bool(value.lower()))
-							self.config[key] = new_value
-							return {"success": True, "config": self.config}
-						else:
-							return {"success": False, "message": "Value {} not valid boolean".format(value)}
-					elif type_tag == "i_":
-						new_value = int(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "l_":
-						new_value = json.loads(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-
-				except Exception as e:
-					return {"success": False, "message": "Exception occurred: {}".format(str(e))}
-
-			else:
-				return {"success": False, "message": "Key {} not present in target configuration dict".format(key)}
-
-
 class Gpredict(Application):
 
 	def start_process(self):
@@ -247,7 +180,10 @@ class Gpredict(Application):
 		gpredict_config.optionxform = str
 		gpredict_config.read(self.config["s_location_file"])
 
-		if self.parent.gps.status["mode"] == 3 and self.config["b_use_gps_onfix"]:
+		gps = self.parent.gps.status
+		# A position restored from the warm start cache is not a fix, only fresh readings are written as one
+		fix = gps["mode"] == 3 and not any(key in gps.stale for key in ("lat", "lon", "alt", "grid"))
+		if fix and self.config["b_use_gps_onfix"]:
 			gpredict_config["QTH"]["DESCRIPTION"] = "GPS"
 			gpredict_config["QTH"]["LOCATION"] = "{} location [N{} E{}] alt. {}m, grid. {}".format("GPS", 	round(self.parent.gps.status["lat"], 3),\
 																											round(self.parent.gps.status["lon"], 3),\
@@ -272,7 +208,7 @@ class Gpredict(Application):
 		with open(self.config["s_location_file"], 'w') as configfile:
 			gpredict_config.write(configfile)
 
-		subprocess.run(["../scripts/start_{}.sh &".format(self.config["s_id"])], shell=True)
+		self.parent.hardware.run("../scripts/start_{}.sh &".format(self.config["s_id"]))
 		self.status["running"] = 1
 		return {"success": True, "status": self.status}
 
@@ -280,6 +216,8 @@ class Gpredict(Application):
 
 class Proxy(Application, Thread):
 
+	capabilities = ("get_status", "get_config", "get_configstatus", "set_config")
+
 	def __init__(self, parent, config):
 		Thread.__init__(self)
 		self.parent = parent
@@ -290,30 +228,39 @@ class Proxy(Application, Thread):
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 1
-						}
+						})
 
 	def run(self):
 		self.proxy()
 
 	def proxy(self):
+		import zmq
 		try:
 			self.context = zmq.Context()
 
 			# Creating subX interface
 			self.subX = self.context.socket(zmq.SUB)
 			self.subX.bind("tcp://127.0.0.1:{}".format(self.config["i_subx_port"]))
+			bind_ipc(self.subX, self.config["s_subx_ipc"])
 
 			self.subX.setsockopt_string(zmq.SUBSCRIBE, "")
 
 			# Creating the pubX interface
 			self.pubX = self.context.socket(zmq.PUB)
 			self.pubX.bind("tcp://0.0.0.0:{}".format(self.config["i_pubx_port"]))
+			bind_ipc(self.pubX, self.config["s_pubx_ipc"])
 			zmq.device(zmq.FORWARDER, self.subX, self.pubX)
 		except Exception as e:
 			print("Proxy exited with exception: {}".format(e))
 
+	def subx_endpoint(self):
+		# Where forwarders publish decoder output, ipc:// when configured to skip the TCP stack
+		return self.config["s_subx_ipc"] or "tcp://127.0.0.1:{}".format(self.config["i_subx_port"])
+
+	def pubx_endpoint(self):
+		return self.config["s_pubx_ipc"] or "tcp://127.0.0.1:{}".format(self.config["i_pubx_port"])
 
 	#This class starts apps via scripts so that additional more complex gui configuration can happen downstream
 	def start_process(self):
@@ -340,10 +287,10 @@ class Subscriber(Application, Thread):
 
 		self.xastir_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
+		import zmq
 		self.context = zmq.Context()
 		self.socket = self.context.socket(zmq.SUB)
-		host = 'tcp://127.0.0.1:{}'.format(self.parent.proxy.config["i_pubx_port"])
-		self.socket.connect(host)
+		self.socket.connect(self.parent.proxy.pubx_endpoint())
 		self.socket.setsockopt_string(zmq.SUBSCRIBE, "")
 		self.socket.setsockopt(zmq.RCVTIMEO, 5000)
 
@@ -352,14 +299,16 @@ class Subscriber(Application, Thread):
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0
-						}
+						})
 
 		if self.config["b_autostart"]:
 			self.start_process()
 
 	def send_to_xastir(self, source, latitude, longitude, altitude, course, symbol_table, symbol_id, path):
+		from aprspy import PositionPacket
+		from aprspy.packets.position import CompressionFix, CompressionSource, CompressionOrigin
 
 		aprs_packet = PositionPacket(	compressed = True, source=source, destination=self.parent.navigation.config["s_xastir_call"], \
 										compression_fix = CompressionFix.CURRENT, compression_source = CompressionSource.GLL, compression_origin = CompressionOrigin.COMPRESSED, \
@@ -412,6 +361,7 @@ class Subscriber(Application, Thread):
 
 						#message = "!AIVDM,1,1,,A,15RTgt0PAso;90TKcjM8h6g208CQ,0*4A"
 						message = packet.payload
+						import pyais
 						aisMessage = json.loads(pyais.AISMessage(pyais.NMEAMessage.from_string(message)).to_json())
 
 						self.send_to_xastir(source=aisMessage["decoded"]["mmsi"], \
@@ -487,15 +437,15 @@ class APRS(Process):
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0,
 							"i_freq" : self.config["i_freq"],
 							"i_baud" : self.config["i_baud"],
 							"s_device" : self.config["s_device"]
-						}
+						})
 
-		subprocess.run(["killall rtl_fm"], shell=True)
-		subprocess.run(["killall direwolf"], shell=True)
+		self.parent.hardware.run("killall rtl_fm")
+		self.parent.hardware.run("killall direwolf")
 
 
 	def _run_executable(self):
@@ -508,12 +458,12 @@ class APRS(Process):
 
 		command1 = "rtl_fm -M fm -d {} -f {} -g {} -p {} -s {} -".format(index, freq, gain, ppm, samprate)
 		command2 = "direwolf -q dh -t 0 -r {} -D 1 -B {} -".format(samprate, baud)
-		command3 = "python3 forwarder.py -t {}".format(self.config["s_id"])
+		command3 = "python3 forwarder.py -t {} -e {}".format(self.config["s_id"], self.parent.proxy.subx_endpoint())
 
 		self.commands.append(command1)
 		self.commands.append(command2)
 		self.commands.append(command3)
-		self.process = subprocess.Popen("{} | {} | {} > /home/pi/aprsdebug 2>&1 &".format(command1, command2, command3), shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		self.process = self.parent.hardware.popen("{} | {} | {} > /home/pi/aprsdebug 2>&1 &".format(command1, command2, command3), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 		self.status["running"] = 1
 
 		return {"success": True, "status": self.status}
@@ -524,14 +474,14 @@ class AIS(Process):
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0,
 							"i_freq_l" : self.config["i_freq_l"],
 							"i_freq_r" : self.config["i_freq_r"],
 							"s_device" : self.config["s_device"]
-						}
+						})
 
-		subprocess.run(["killall rtl_ais"], shell=True)
+		self.parent.hardware.run("killall rtl_ais")
 
 
 	def _run_executable(self):
@@ -543,11 +493,11 @@ class AIS(Process):
 
 		#command1 = "rtl_ais -d {} -p {} -g {} -l {} -r {} -n".format(index, ppm, gain, freq_left, freq_right)
 		command1 = "for i in 1 2 3 4 5; do cat /home/pi/ais; done"
-		command2 = "python3 forwarder.py -t {}".format(self.config["s_id"])
+		command2 = "python3 forwarder.py -t {} -e {}".format(self.config["s_id"], self.parent.proxy.subx_endpoint())
 
 		self.commands.append(command1)
 		self.commands.append(command2)
-		self.process = subprocess.Popen("{} | {} &".format(command1, command2), shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		self.process = self.parent.hardware.popen("{} | {} &".format(command1, command2), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 		self.status["running"] = 1
 
 		return {"success": True, "status": self.status}
@@ -557,14 +507,14 @@ class RTLTCP(Process):
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0,
 							"s_host" : self.config["s_host"],
 							"i_port" : self.config["i_port"],
 							"s_device" : self.config["s_device"]
-						}
+						})
 
-		subprocess.run(["killall rtl_tcp"], shell=True)
+		self.parent.hardware.run("killall rtl_tcp")
 
 	def _run_executable(self):
 		host = self.config["s_host"]
@@ -578,7 +528,7 @@ class RTLTCP(Process):
 		command1 = "rtl_tcp -a {} -p {} -f {} -g {} -s {} -d {} -P {}".format(host, port, freq, gain, rate, index, ppm)
 
 		self.commands.append(command1)
-		self.process = subprocess.Popen("{} &".format(command1), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		self.process = self.parent.hardware.popen("{} &".format(command1), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 		self.status["running"] = 1
 
 		return {"success": True, "status": self.status}
@@ -586,18 +536,20 @@ class RTLTCP(Process):
 
 class RS(Process):
 
+	config_rules = dict(Process.config_rules, s_sonde=Rule(choices=("rs41", "dfm")))
+
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0,
 							"s_sonde" : self.config["s_sonde"],
 							"i_freq" : self.config["i_freq"],
 							"s_device" : self.config["s_device"]
-						}
+						})
 
-		subprocess.run(["killall rtl_fm"], shell=True)
-		subprocess.run(["killall rs41mod"], shell=True)
-		subprocess.run(["killall dfm09mod"], shell=True)
+		self.parent.hardware.run("killall rtl_fm")
+		self.parent.hardware.run("killall rs41mod")
+		self.parent.hardware.run("killall dfm09mod")
 
 	def _run_executable(self):
 		if 	self.config["s_device"] == self.parent.rf.config["s_rf1_serial"] or self.config["s_device"] == self.parent.rf.config["s_rf2_serial"]:
@@ -622,14 +574,14 @@ class RS(Process):
 			command3 = "dfm09mod --ecc --json --dist --auto"
 
 		#command4 = "/home/pi/git/pisdr-cyberdeck/src/scripts/sonde_to_xastir.py --sourceid {}".format(self.config["s_id"])
-		command4 = "python3 forwarder.py -t {}".format(self.config["s_id"])
+		command4 = "python3 forwarder.py -t {} -e {}".format(self.config["s_id"], self.parent.proxy.subx_endpoint())
 
 
 		self.commands.append(command1)
 		#self.commands.append(command2)
 		#self.commands.append(command3)
 		self.commands.append(command4)
-		self.process = subprocess.Popen("{} | {} | {} | {} &".format(command1, command2, command3, command4), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		self.process = self.parent.hardware.popen("{} | {} | {} | {} &".format(command1, command2, command3, command4), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 		self.status["running"] = 1
 
 		return {"success": True, "status": self.status}
@@ -639,12 +591,12 @@ class ACARS(Process):
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0,
 							"s_device" : self.config["s_device"]
-						}
+						})
 
-		subprocess.run(["killall acarsdec"], shell=True)
+		self.parent.hardware.run("killall acarsdec")
 
 	def _run_executable(self):
 		index = self.parent.rf.status["{}_index".format(self.config["s_device"])]
@@ -658,7 +610,7 @@ class ACARS(Process):
 		command1 = "acarsdec -d {} -p {} -g {} {}".format(index, ppm, gain, freqs_unpacked)
 
 		self.commands.append(command1)
-		self.process = subprocess.Popen("{} &".format(command1), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		self.process = self.parent.hardware.popen("{} &".format(command1), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 		self.status["running"] = 1
 
 		return {"success": True, "status": self.status}
@@ -668,12 +620,12 @@ class VDL(Process):
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0,
 							"s_device" : self.config["s_device"]
-						}
+						})
 
-		subprocess.run(["killall dumpvdl2"], shell=True)
+		self.parent.hardware.run("killall dumpvdl2")
 
 	def _run_executable(self):
 		index = self.parent.rf.status["{}_index".format(self.config["s_device"])]
@@ -690,7 +642,7 @@ class VDL(Process):
 
 		self.commands.append(command1)
 		self.commands.append(command2)
-		self.process = subprocess.Popen("{} | {} &".format(command1, command2), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		self.process = self.parent.hardware.popen("{} | {} &".format(command1, command2), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 		self.status["running"] = 1
 
 		return {"success": True, "status": self.status}
@@ -700,13 +652,13 @@ class ISM(Process):
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0,
 							"i_freq" : self.config["i_freq"],
 							"s_device" : self.config["s_device"]
-						}
+						})
 
-		subprocess.run(["killall rtl_433"], shell=True)
+		self.parent.hardware.run("killall rtl_433")
 
 	def _run_executable(self):
 		index = self.parent.rf.status["{}_index".format(self.config["s_device"])]
@@ -722,7 +674,7 @@ class ISM(Process):
 
 		self.commands.append(command1)
 		#self.commands.append(command2)
-		self.process = subprocess.Popen("{} &".format(command1), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		self.process = self.parent.hardware.popen("{} &".format(command1), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 		self.status["running"] = 1
 
 		return {"success": True, "status": self.status}
@@ -732,12 +684,12 @@ class ADSB(Process):
 
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0,
 							"s_device" : self.config["s_device"]
-						}
+						})
 
-		subprocess.run(["killall rtl_433"], shell=True)
+		self.parent.hardware.run("killall rtl_433")
 
 	def _run_executable(self, command2=None):
 		index = self.parent.rf.status["{}_index".format(self.config["s_device"])]
@@ -752,26 +704,117 @@ class ADSB(Process):
 
 		self.commands.append(command1)
 		#self.commands.append(command2)
-		self.process = subprocess.Popen("{} &".format(command1, command2), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		self.process = self.parent.hardware.popen("{} &".format(command1, command2), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 		self.status["running"] = 1
 
 		return {"success": True, "status": self.status}
 
 
+class RemoteControl(object):
+	"""Persistent connection to the gqrx remote control port (a subset of the rigctld protocol), one command at a time.
+	A dropped connection is opened again once per command."""
+
+	def __init__(self, host, port, timeout=1.0):
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.lock = Lock()
+		self.connection = None
+		self.reader = None
+
+	def _connect(self):
+		self.connection = socket.create_connection((self.host, self.port), self.timeout)
+		self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.reader = self.connection.makefile("rb")
+
+	def command(self, request, lines=1):
+		"""Reply lines of a command, e.g. command("m", 2) -> ["FM", "10000"]"""
+		with self.lock:
+			for attempt in range(2):
+				try:
+					if self.connection is None:
+						self._connect()
+					self.connection.sendall("{}\n".format(request).encode('ascii'))
+					reply = [self.reader.readline() for line in range(lines)]
+					if not all(reply):
+						raise ConnectionError("Connection closed by {}:{}".format(self.host, self.port))
+					return [line.decode('ascii').strip() for line in reply]
+				except OSError:
+					self._close()
+					if attempt:
+						raise
+
+	def set(self, request):
+		"""Commands answering RPRT 0 on success"""
+		reply = self.command(request)[0]
+		if reply != "RPRT 0":
+			raise RuntimeError("{} refused: {}".format(request, reply))
+
+	def _close(self):
+		if self.connection is not None:
+			self.reader.close()
+			self.connection.close()
+		self.connection = self.reader = None
+
+	def close(self):
+		with self.lock:
+			self._close()
+
+
 class GQRX(Process):
 
+	MODES = ("OFF", "RAW", "AM", "AMS", "FM", "WFM", "WFM_ST", "WFM_ST_OIRT", "LSB", "USB", "CW", "CWL", "CWU")
+	# [receiver] demod index of each mode in generic.conf, so gqrx starts with the mode the remote port would set
+	DEMOD = {"OFF": 0, "RAW": 1, "AM": 2, "FM": 3, "WFM": 4, "WFM_ST": 5, "LSB": 6, "USB": 7, "CW": 8, "CWL": 8, "CWU": 9,
+			 "WFM_ST_OIRT": 10, "AMS": 11}
+	# Retuned through the remote control port while gqrx runs, the other keys need gqrx to be started again
+	TUNING = ("i_freq", "s_mode", "i_passband")
+
+	config_rules = dict(Process.config_rules, s_mode=Rule(choices=MODES), i_passband=Rule(minimum=0))
+	live_config = Process.live_config + TUNING
+
 	def _init_status(self):
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"running" : 0,
+							"i_freq" : self.config["i_freq"],
+							"s_mode" : self.config["s_mode"],
+							"i_passband" : self.config["i_passband"],
 							"i_samprate" : self.config["i_samprate"],
 							"b_directsamp" : self.config["b_directsamp"],
 							"b_bias" : self.config["b_bias"],
 							"s_device" : self.config["s_device"]
-						}
+						})
 
+		self.remote = RemoteControl(self.config["s_rc_host"], self.config["i_rc_port"])
 		self.stop_process()
 
+	def _retune(self, keys):
+		try:
+			if "i_freq" in keys:
+				self.remote.set("F {}".format(self.config["i_freq"]))
+			if "s_mode" in keys or "i_passband" in keys:
+				self.remote.set("M {} {}".format(self.config["s_mode"], self.config["i_passband"]))
+		except (OSError, RuntimeError) as e:
+			return {"success": False, "message": "Could not retune gqrx: {}".format(e)}
+		return {"success": True, "status": self.status}
+
+	def config_applied(self, keys):
+		keys = [key for key in keys if key in self.TUNING]
+		if keys and self.status["running"]:
+			return self._retune(keys)
+		return None
+
+	def _filter(self):
+		# Filter edges in Hz around the tuned frequency for a passband, sidebands start 100 Hz off the carrier like gqrx's own
+		mode = self.config["s_mode"]
+		passband = self.config["i_passband"]
+		if mode == "USB":
+			return 100, 100 + passband
+		if mode == "LSB":
+			return -100 - passband, -100
+		return -(passband // 2), passband // 2
+
 	def _run_executable(self):
 		index = self.parent.rf.status["{}_index".format(self.config["s_device"])]
 
@@ -781,6 +824,14 @@ class GQRX(Process):
 		config["input"]["decimation"] = str(self.config["i_decimation"])
 		config["input"]["frequency"] = str(self.config["i_freq"])
 		config["input"]["sample_rate"] = str(self.config["i_samprate"])
+		# The remote port only retunes a running gqrx, a start has to come up with the configured mode and passband too
+		if not config.has_section("receiver"):
+			config.add_section("receiver")
+		low, high = self._filter()
+		config["receiver"]["demod"] = str(self.DEMOD[self.config["s_mode"]])
+		config["receiver"]["filter_low_cut"] = str(low)
+		config["receiver"]["filter_high_cut"] = str(high)
+		config["receiver"]["offset"] = "0"	# i_freq is the frequency demodulated, as with the F command
 
 		if self.config["b_directsamp"]:
 			config["input"]["device"] = '\"rtl={},direct_samp=3\"'.format(index)
@@ -791,7 +842,7 @@ class GQRX(Process):
 		with open(self.config["s_generic_config"], 'w') as configfile:
 			config.write(configfile)
 
-		subprocess.run(["/home/pi/git/pisdr-cyberdeck/src/scripts/start_{}.sh &".format(self.config["s_id"])], shell=True)
+		self.parent.hardware.run("/home/pi/git/pisdr-cyberdeck/src/scripts/start_{}.sh &".format(self.config["s_id"]))
 		self.status["running"] = 1
 
 		return {"success": True, "status": self.status}
@@ -804,7 +855,7 @@ class GQRX(Process):
 				if self.parent.rf.status["{}_power".format(device)]:
 					try:
 						index = self.parent.rf.status["{}_index".format(device)]
-						sdr = RtlSdr(index)
+						sdr = self.parent.hardware.rtlsdr(index)
 						sdr.close()
 
 						if not self.status["running"]:
@@ -828,12 +879,13 @@ class GQRX(Process):
 			else:
 				return {"success": False, "message": "Specified input device {} is not supported".format(device)}
 		else:
-			subprocess.run(["/home/pi/git/pisdr-cyberdeck/src/scripts/start_{}.sh &".format(self.config["s_id"])], shell=True)
+			self.parent.hardware.run("/home/pi/git/pisdr-cyberdeck/src/scripts/start_{}.sh &".format(self.config["s_id"]))
 			return {"success": True, "status": self.status}
 
 
 	def stop_process(self):
-		subprocess.run(["/home/pi/git/pisdr-cyberdeck/src/scripts/stop_{}.sh &".format(self.config["s_id"])], shell=True)
+		self.remote.close()
+		self.parent.hardware.run("/home/pi/git/pisdr-cyberdeck/src/scripts/stop_{}.sh &".format(self.config["s_id"]))
 		self.status["running"] = 0
 
 		return {"success": True, "status": self.status}
@@ -842,7 +894,12 @@ class GQRX(Process):
 
 
 
-class GenericSystem(Thread):
+class GenericSystem(Configurable, Thread):
+
+	capabilities = ("get_status", "get_config", "set_config")
+	config_rules = {key: READ_ONLY for key in ("s_name", "s_type", "i_sense_pin", "i_control_pin", "s_rf1_serial", "s_rf2_serial")}
+	# Status keys holding slow measurements, restored from the warm start cache at boot until fresh readings arrive
+	warm_status = ()
 
 	def __init__(self, parent, config):
 		Thread.__init__(self)
@@ -850,13 +907,12 @@ class GenericSystem(Thread):
 		self.config = config
 		self.name = self.config["s_id"]		
 
-		self.status = {}
+		self.status = VersionedDict()
 		self.running = True
 
 	def _getTemperatureDS18B20(self, ID):
 		try:
-			output = subprocess.check_output(['cat', '/sys/bus/w1/devices/{TEMP_ID}/temperature'.format(TEMP_ID=ID)])
-			return int(output.decode('utf-8'))/1000.0, True
+			return self.parent.hardware.ds18b20_temperature(ID), True
 		except Exception:
 			return 0.0, False
 
@@ -873,48 +929,12 @@ class GenericSystem(Thread):
 		while self.running:
 			time.sleep(1)
 
-	def set_config(self, key, value):
-		if key in ["s_id", "s_name", "s_type", "i_sense_pin", "i_control_pin", "s_rf1_serial", "s_rf2_serial"]:
-			return {"success": False, "message": "Modification of s_id is not allowed"}
-		else:
-			if key in self.config:
-				try:
-					type_tag = key[:2]
-					if type_tag == "s_":
-						new_value = value
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "f_":
-						new_value = float(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "b_":
-						if value.lower() in ["true", "True", "1", "yes", "false", "False", "0", "no"]:
-							new_value = int(self.parent.str2bool(value.lower()))
-							self.config[key] = new_value
-							return {"success": True, "config": self.config}
-						else:
-							return {"success": False, "message": "Value {} not valid boolean".format(value)}
-					elif type_tag == "i_":
-						new_value = int(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "l_":
-						new_value = json.loads(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-
-				except Exception as e:
-					return {"success": False, "message": "Exception occurred: {}".format(str(e))}
-
-			else:
-				return {"success": False, "message": "Key {} not present in target configuration dict".format(key)}
-
-
 
 class RigCtl(Application):
 	"""Basic rigctl client implementation. https://github.com/marmelo/gqrx-remote/blob/master/gqrx-remote.py """
 
+	capabilities = Application.capabilities + ("set_frequency", "get_frequency", "set_mode", "get_mode", "get_level")
+
 	def start_process(self):
 		self.status["running"] = 1
 		return {"success": True, "status": self.status}
@@ -923,14 +943,14 @@ class RigCtl(Application):
 		self.status["running"] = 0
 		return {"success": True, "status": self.status}
 
-	def _request(self, request):
+	def _init_status(self):
+		Application._init_status(self)
+		self.remote = RemoteControl(self.config["s_hostname"], self.config["i_port"])
+
+	def _request(self, request, lines=1):
 		try:
-			con = telnetlib.Telnet(self.config["s_hostname"], self.config["i_port"])
-			con.write(('%s\n' % request).encode('ascii'))
-			response = con.read_some().decode('ascii').strip()
-			con.write('c\n'.encode('ascii'))
+			response = "\n".join(self.remote.command(request, lines))
 			return {"success": True, "response" : response}
-			#return {"success": True}
 		except Exception as e:
 			return {"success": False, "message": str(e)}
 
@@ -944,7 +964,7 @@ class RigCtl(Application):
 		return self._request('M %s' % mode)
 
 	def get_mode(self):
-		return self._request('m')
+		return self._request('m', lines=2)
 
 	def get_level(self):
 		return self._request('l')
@@ -958,19 +978,21 @@ class Publisher(GenericSystem):
 		self.config = config
 		self.name = self.config["s_id"]		
 
-		self.status = {}
+		self.status = VersionedDict()
 
+		import zmq
 		self.context = zmq.Context()
 		self.socket = self.context.socket(zmq.PUB)
 		self.host = 'tcp://{}:{}'.format(self.config["s_host"], self.config["i_port"])
 		self.socket.bind(self.host)
+		bind_ipc(self.socket, self.config["s_ipc_endpoint"])
 
 		self.running = True
 
 	def run(self):
 		while self.running:
-			status = self.parent.get_configstatus()
-			to_send = pickle.dumps(status)
+			# Pickled once per state version and shared with every other reader of the snapshot
+			to_send = self.parent.snapshot().pickle("configstatus")
 
 			self.socket.send(to_send)
 			time.sleep(self.config["i_period"])
@@ -978,22 +1000,24 @@ class Publisher(GenericSystem):
 
 class Battery(GenericSystem):
 
+	warm_status = ("charge_state", "level", "temp1", "temp2", "t_left")
+
 	def __init__(self, parent, config):
 		Thread.__init__(self)
 		self.parent = parent
 		self.config = config
 		self.name = self.config["s_id"]
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"charge_state" : "",
 							"level": 0,
 							"temp1": 0.0,
 							"temp2" : 0.0,
 							"t_left" : 0.0
-						}
+						})
 
 
-		self.battadc = Adafruit_ADS1x15.ADS1115(address=int(self.config["s_level_i2c_addr"], 16))
+		self.battadc = self.parent.hardware.ads1115(int(self.config["s_level_i2c_addr"], 16))
 
 		self.running = True
 
@@ -1063,22 +1087,24 @@ class Battery(GenericSystem):
 
 class DCDC(GenericSystem):
 
+	warm_status = ("temp",)
+
 	def __init__(self, parent, config):
 		Thread.__init__(self)
 		self.parent = parent
 		self.config = config
 		self.name = self.config["s_id"]		
 
-		GPIO.setup(self.config["i_j1a_sense_pin"], GPIO.IN)
-		GPIO.setup(self.config["i_j1b_sense_pin"], GPIO.IN)
+		self.parent.hardware.gpio.setup(self.config["i_j1a_sense_pin"], self.parent.hardware.gpio.IN)
+		self.parent.hardware.gpio.setup(self.config["i_j1b_sense_pin"], self.parent.hardware.gpio.IN)
 
 
-		self.status = 	{
+		self.status = VersionedDict({
 								"power" : 0,
 								"temp": 0,
 								"j1a_power" : 0,
 								"j1b_power" : 0
-						}
+						})
 
 		self.running = True
 
@@ -1088,8 +1114,8 @@ class DCDC(GenericSystem):
 			if valid:
 				self.status["temp"] = temp
 
-			self.status["j1a_power"] = int(GPIO.input(self.config["i_j1a_sense_pin"]))
-			self.status["j1b_power"] = int(GPIO.input(self.config["i_j1b_sense_pin"]))
+			self.status["j1a_power"] = int(self.parent.hardware.gpio.input(self.config["i_j1a_sense_pin"]))
+			self.status["j1b_power"] = int(self.parent.hardware.gpio.input(self.config["i_j1b_sense_pin"]))
 
 			if self.status["j1b_power"]:
 				self.status["power"] = 1
@@ -1101,65 +1127,11 @@ class DCDC(GenericSystem):
 			
 
 
-class CustomINA219(INA219):
-
-	"""
-	Custom INA219 calibration due to use of 50mohm shunt resistor (standard is 100mohm)
-	"""
-
-	def set_custom_calibration_16V_3A(self):  # pylint: disable=invalid-name
-
-		# VBUS_MAX = 16V
-		# VSHUNT_MAX = 0.16          (Assumes Gain 3, 160mV)
-		# RSHUNT = 0.05              (Resistor value in ohms)
-
-		# 1. Determine max possible current
-		# MaxPossible_I = VSHUNT_MAX / RSHUNT
-		# MaxPossible_I = 3.2A
-
-		# 2. Determine max expected current
-		# MaxExpected_I = 3.0A
-
-		# 3. Calculate possible range of LSBs (Min = 15-bit, Max = 12-bit)
-		# MinimumLSB = MaxExpected_I/32767
-		# MinimumLSB = 0.000091556              (uA per bit)
-		# MaximumLSB = MaxExpected_I/4096
-		# MaximumLSB = 0.0007324              (uA per bit)
-
-		# 4. Choose an LSB between the min and max values
-		#    (Preferrably a roundish number close to MinLSB)
-		# CurrentLSB = 0.00016 (uA per bit)
-		self._current_lsb = 0.0916  # in milliamps
-
-		# 5. Compute the calibration register
-		# Cal = trunc (0.04096 / (Current_LSB * RSHUNT))
-		# Cal = 13434 (0x347a)
-
-		self._cal_value = 8943
-
-		# 6. Calculate the power LSB
-		# PowerLSB = 20 * CurrentLSB
-		# PowerLSB = 0.003 (3.048mW per bit)
-		self._power_lsb = 0.001832
-
-		# 7. Compute the maximum current and shunt voltage values before overflow
-		#
-		# 8. Compute the Maximum Power
-		#
-
-		# Set Calibration register to 'Cal' calcutated above
-		self._raw_calibration = self._cal_value
-
-		# Set Config register to take into account the settings above
-		self.bus_voltage_range = BusVoltageRange.RANGE_16V
-		self.gain = Gain.DIV_4_160MV
-		self.bus_adc_resolution = ADCResolution.ADCRES_12BIT_4S
-		self.shunt_adc_resolution = ADCResolution.ADCRES_12BIT_4S
-		self.mode = Mode.SANDBVOLT_CONTINUOUS
-
-
 class OBC(GenericSystem):
 
+	capabilities = GenericSystem.capabilities + ("reboot", "shutdown")
+	warm_status = ("temp1", "temp2", "voltage", "current", "consumption")
+
 	def __init__(self, parent, config):
 		Thread.__init__(self)
 		self.parent = parent
@@ -1168,31 +1140,26 @@ class OBC(GenericSystem):
 
 		self.running = True
 
-		self.I2C_BUS = board.I2C()
-
-		self.status = 	{
+		self.status = VersionedDict({
 							"power": 1,
 							"temp1": 0,
 							"temp2": 0,
 							"voltage" : 0,
 							"current" : 0,
 							"consumption" : 0
-						 }
+						 })
 
-		self.ina219 = CustomINA219(self.I2C_BUS, addr=int(self.config["s_power_ina219_addr"], 16))
-		self.ina219.set_custom_calibration_16V_3A()
+		self.ina219 = self.parent.hardware.ina219(int(self.config["s_power_ina219_addr"], 16))
 
 	def _getInternalTemperature(self):
-		output = subprocess.check_output(['vcgencmd', 'measure_temp'])
-		floats = re.findall("\d+\.\d+", output.decode('utf-8'))
-		return float(floats[0])
+		return self.parent.hardware.soc_temperature()
 
 	def reboot(self):
-		subprocess.run(["sudo reboot now"], shell=True)
+		self.parent.hardware.run("sudo reboot now")
 		return {"success": True, "status": self.status}
 
 	def shutdown(self):
-		subprocess.run(["sudo shutdown now"], shell=True)
+		self.parent.hardware.run("sudo shutdown now")
 		return {"success": True, "status": self.status}
 
 	def run(self):
@@ -1215,18 +1182,20 @@ class OBC(GenericSystem):
 
 class Indicator(GenericSystem):
 
+	capabilities = GenericSystem.capabilities + ("set_power",)
+
 	def __init__(self, parent, config):
 		Thread.__init__(self)
 		self.parent = parent
 		self.config = config
 		self.name = self.config["s_id"]		
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"power" : 0
-						}
+						})
 
-		GPIO.setup(self.config["i_control_pin"], GPIO.OUT)
-		GPIO.output(self.config["i_control_pin"], False)
+		self.parent.hardware.gpio.setup(self.config["i_control_pin"], self.parent.hardware.gpio.OUT)
+		self.parent.hardware.gpio.output(self.config["i_control_pin"], False)
 
 		self.interval_high = self.config["f_interval_high"]
 		self.interval_medium = self.config["f_interval_medium"]
@@ -1269,10 +1238,10 @@ class Indicator(GenericSystem):
 	def run(self):
 		while self.running:
 			while self.alarm_active:
-				GPIO.output(self.config["i_control_pin"], True)
+				self.parent.hardware.gpio.output(self.config["i_control_pin"], True)
 				time.sleep(self.interval)
 
-				GPIO.output(self.config["i_control_pin"], False)
+				self.parent.hardware.gpio.output(self.config["i_control_pin"], False)
 				time.sleep(self.interval)
 			time.sleep(0.5)
 			#self.parent.database.dumpData(id=self.config["s_id"], fields=self.status)
@@ -1287,12 +1256,12 @@ class RF(GenericSystem):
 		self.config = config
 		self.name = self.config["s_id"]		
 
-		self.status = 	{
+		self.status = VersionedDict({
 								"rf1_power": 0,
 								"rf1_index": 0,
 								"rf2_power": 0,
 								"rf2_index": 0
-							}
+							})
 
 		self.running = True
 
@@ -1316,11 +1285,13 @@ class RF(GenericSystem):
 			time.sleep(2)
 
 	def _getDeviceIndex(self, serial):
-		return RtlSdr.get_device_index_by_serial(serial)
+		return self.parent.hardware.rtlsdr_index_by_serial(serial)
 
 
 class LAN(GenericSystem):
 
+	capabilities = GenericSystem.capabilities + ("set_power", "toggle_power")
+
 	def __init__(self, parent, config):
 		Thread.__init__(self)
 		self.parent = parent
@@ -1329,10 +1300,10 @@ class LAN(GenericSystem):
 
 		self.running = True
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"power" : 0,
 							"eth0" : ""
-						}
+						})
 
 		if self.config["b_on_startup"]:
 			self.set_power(True)
@@ -1342,12 +1313,12 @@ class LAN(GenericSystem):
 	def set_power(self, power):
 		try:
 			if power:
-				subprocess.run(["sudo uhubctl -l 1-1 -p 1 -a 1"], shell=True)
+				self.parent.hardware.run("sudo uhubctl -l 1-1 -p 1 -a 1")
 				self.status["power"] = 1
 				return {"success": True, "status": self.status}
 			else:
-				subprocess.run(["sudo ifconfig eth0 down"], shell=True)
-				subprocess.run(["sudo uhubctl -l 1-1 -p 1 -a 0"], shell=True)
+				self.parent.hardware.run("sudo ifconfig eth0 down")
+				self.parent.hardware.run("sudo uhubctl -l 1-1 -p 1 -a 0")
 				self.status["power"] = 0
 				return {"success": True, "status": self.status}
 			self.parent.database.dumpData(id=self.config["s_id"], fields=self.status)
@@ -1366,7 +1337,7 @@ class LAN(GenericSystem):
 	def run(self):
 		while self.running:
 			try:
-				eth0_if = netifaces.ifaddresses("eth0")
+				eth0_if = self.parent.hardware.ifaddresses("eth0")
 				if 2 in eth0_if:
 					self.status["eth0"] = eth0_if[2][0]["addr"]
 				else:
@@ -1380,6 +1351,8 @@ class LAN(GenericSystem):
 
 class WLAN(GenericSystem):
 
+	capabilities = GenericSystem.capabilities + ("set_power", "toggle_power")
+
 	def __init__(self, parent, config):
 		Thread.__init__(self)
 		self.parent = parent
@@ -1388,11 +1361,11 @@ class WLAN(GenericSystem):
 
 		self.running = True
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"power" : 0,
 							"wlan0" : "",
 							"ssid" : ""
-						}
+						})
 
 		if self.config["b_on_startup"]:
 			self.set_power(True)
@@ -1402,11 +1375,11 @@ class WLAN(GenericSystem):
 	def set_power(self, power):
 		try:
 			if power:
-				subprocess.run(["sudo rfkill unblock wifi"], shell=True)
+				self.parent.hardware.run("sudo rfkill unblock wifi")
 				self.status["power"] = 1
 				return {"success": True, "status": self.status}
 			else:
-				subprocess.run(["sudo rfkill block wifi"], shell=True)
+				self.parent.hardware.run("sudo rfkill block wifi")
 				self.status["power"] = 0
 				return {"success": True, "status": self.status}
 			self.parent.database.dumpData(id=self.config["s_id"], fields=self.status)
@@ -1424,11 +1397,10 @@ class WLAN(GenericSystem):
 	def run(self):
 		while self.running:
 			try:
-				wlan0_if = netifaces.ifaddresses("wlan0")
+				wlan0_if = self.parent.hardware.ifaddresses("wlan0")
 				if 2 in wlan0_if:
 					self.status["wlan0"] = wlan0_if[2][0]["addr"]
-					ssid_output = subprocess.check_output(['iwgetid']).decode('utf-8')
-					self.status["ssid"] = ssid_output.split('"')[1]
+					self.status["ssid"] = self.parent.hardware.wifi_ssid()
 				else:
 					self.status["wlan0"] = "NO LINK"
 					self.status["ssid"] = ""
@@ -1441,16 +1413,18 @@ class WLAN(GenericSystem):
 
 
 
-class USB():
+class USB(Configurable):
+
+	capabilities = ("get_status", "get_config", "set_power", "toggle_power")
 
 	def __init__(self, parent, config):
 		self.parent = parent
 		self.config = config
 		self.name = self.config["s_id"]		
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"power" : 0
-						}
+						})
 
 		if self.config["b_on_startup"]:
 			self.set_power(True)
@@ -1460,13 +1434,13 @@ class USB():
 	def set_power(self, power):
 		try:
 			if power:
-				subprocess.run(["sudo uhubctl -l 1-1 -p 2 -a 1"], shell=True)
+				self.parent.hardware.run("sudo uhubctl -l 1-1 -p 2 -a 1")
 				self.status["power"] = 1
 				time.sleep(0.5)
-				subprocess.run(["rtl_eeprom -d 0 -r temp; rtl_eeprom -d 1 -r temp"], shell=True)
+				self.parent.hardware.run("rtl_eeprom -d 0 -r temp; rtl_eeprom -d 1 -r temp")
 				return {"success": True, "status": self.status}
 			else:
-				subprocess.run(["sudo uhubctl -l 1-1 -p 2 -a 0"], shell=True)
+				self.parent.hardware.run("sudo uhubctl -l 1-1 -p 2 -a 0")
 				self.status["power"] = 0
 				return {"success": True, "status": self.status}
 			self.parent.database.dumpData(id=self.config["s_id"], fields=self.status)
@@ -1487,23 +1461,26 @@ class USB():
 			return self.set_power(False)
 
 
-class Audio():
+class Audio(Configurable):
+
+	capabilities = ("get_status", "get_config", "set_config", "set_power", "set_volume", "increment_volume", "decrement_volume", "set_mute", "toggle_mute", "set_test")
+	config_rules = {"i_startup_volume": Rule(minimum=0, maximum=100)}
 
 	def __init__(self, parent, config):
 		self.parent = parent
 		self.config = config
 		self.name = self.config["s_id"]		
 
-		GPIO.setup(self.config["i_control_pin"], GPIO.OUT)
-		self.mixer = pyalsaaudio.Mixer(control="Headphone", id=0, cardindex=0, device="default")
+		self.parent.hardware.gpio.setup(self.config["i_control_pin"], self.parent.hardware.gpio.OUT)
+		self.mixer = self.parent.hardware.mixer(control="Headphone", id=0, cardindex=0, device="default")
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"power" : 0,
 							"volume": self.mixer.getvolume()[0],
 							"mute": int(self.mixer.getmute()[0]),
 							"test" : 0
 
-						 }
+						 })
 
 		if self.config["b_on_startup"]:
 			self.set_power(True)
@@ -1566,60 +1543,23 @@ class Audio():
 
 	def set_test(self, test):
 		if test:
-			subprocess.run(["aplay {} &".format(self.config["s_test_wav"])], shell=True)
+			self.parent.hardware.run("aplay {} &".format(self.config["s_test_wav"]))
 			return {"success": True, "test": 1}
 		else:
-			subprocess.run(["pkill -f {}".format(self.config["s_test_wav"])], shell=True)
+			self.parent.hardware.run("pkill -f {}".format(self.config["s_test_wav"]))
 			return {"success": True, "test": 0}
 		self.status["test"] = int(test)
 
 	def set_power(self, power):
 		if power:
-			GPIO.output(self.config["i_control_pin"], True)
+			self.parent.hardware.gpio.output(self.config["i_control_pin"], True)
 			self.status["power"] = 1
 			return {"success": True, "status": self.status}
 		else:
-			GPIO.output(self.config["i_control_pin"], False)
+			self.parent.hardware.gpio.output(self.config["i_control_pin"], False)
 			self.status["power"] = 0
 			return {"success": True, "status": self.status}
 
-	def set_config(self, key, value):
-		if key == "s_id":
-			return {"success": False, "message": "Modification of s_id is not allowed"}
-		else:
-			if key in self.config:
-				try:
-					type_tag = key[:2]
-					if type_tag == "s_":
-						new_value = value
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "f_":
-						new_value = float(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "b_":
-						if value.lower() in ["true", "True", "1", "yes", "false", "False", "0", "no"]:
-							new_value = int(self.parent.str2bool(value.lower()))
-							self.config[key] = new_value
-							return {"success": True, "config": self.config}
-						else:
-							return {"success": False, "message": "Value {} not valid boolean".format(value)}
-					elif type_tag == "i_":
-						new_value = int(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "l_":
-						new_value = json.loads(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-
-				except Exception as e:
-					return {"success": False, "message": "Exception occurred: {}".format(str(e))}
-
-			else:
-				return {"success": False, "message": "Key {} not present in target configuration dict".format(key)}
-
 
 class Clock(GenericSystem):
 
@@ -1629,9 +1569,9 @@ class Clock(GenericSystem):
 		self.config = config
 		self.name = self.config["s_id"]		
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"time_utc": ""
-						 }
+						 })
 
 		self.running = True
 
@@ -1643,6 +1583,9 @@ class Clock(GenericSystem):
 
 class Display(GenericSystem):
 
+	capabilities = GenericSystem.capabilities + ("set_power", "toggle_power", "set_brightness", "increment_brightness", "decrement_brightness", "screenshot")
+	config_rules = dict(GenericSystem.config_rules, i_backlight_startup=Rule(minimum=0, maximum=100), f_fade_duration=Rule(minimum=0))
+
 	def __init__(self, parent, config):
 		Thread.__init__(self)
 		self.parent = parent
@@ -1651,33 +1594,30 @@ class Display(GenericSystem):
 
 		logging.info("Display init")
 
-		self.I2C_BUS = board.I2C()
-
-		self.display_connected = os.path.isfile('/sys/class/backlight/rpi_backlight/max_brightness')
+		self.backlight = self.parent.hardware.backlight()
+		self.display_connected = self.backlight is not None
 
 		if self.display_connected:
-			self.backlight = Backlight()
 			self.backlight.fade_duration = self.config["f_fade_duration"]
-			self.status = {
+			self.status = VersionedDict({
 								"power": int(self.backlight.power),
 								"brightness": self.backlight.brightness,
 								"voltage" : 0,
 								"current" : 0,
 								"consumption" : 0
-							 }
+							 })
 		else:
-			self.status = {
+			self.status = VersionedDict({
 								"power": 0,
 								"brightness": 0,
 								"voltage" : 0,
 								"current" : 0,
 								"consumption" : 0
-							 }
+							 })
 
 
 		if self.config["b_power_polling_enabled"]:
-			self.ina219 = CustomINA219(self.I2C_BUS, addr=int(self.config["s_power_ina219_addr"], 16))
-			self.ina219.set_custom_calibration_16V_3A()
+			self.ina219 = self.parent.hardware.ina219(int(self.config["s_power_ina219_addr"], 16))
 
 
 		self.set_power(True)
@@ -1743,7 +1683,7 @@ class Display(GenericSystem):
 
 	def screenshot(self):
 		command = "scrot -e 'mv $f /home/pi/Pictures/screenshots/; echo $f'"
-		process = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True)
+		process = self.parent.hardware.popen(command, stdout=subprocess.PIPE)
 		file = process.communicate()[0].strip()
 
 		return {"success": True, "file": file}
@@ -1764,13 +1704,17 @@ class Display(GenericSystem):
 
 class GPS(GenericSystem):
 
+	capabilities = GenericSystem.capabilities + ("set_power",)
+	# mode is left out: restored, it would claim a fix the GPS does not have (yet)
+	warm_status = ("sats_visible", "sats_used", "lat", "lon", "track", "hspeed", "mgrs", "grid", "alt", "climb")
+
 	def __init__(self, parent, config):
 		Thread.__init__(self)
 		self.parent = parent
 		self.config = config
 		self.name = self.config["s_id"]
 
-		self.status = {
+		self.status = VersionedDict({
 							"power" : 0,
 							"mode" : 0,
 							"sats_visible" : 0,
@@ -1786,9 +1730,11 @@ class GPS(GenericSystem):
 							"alt" : 0.0,
 							"climb" : 0.0
 
-						 }
+						 })
 
+		import mgrs
 		self.m = mgrs.MGRS()
+		self.gpsd = self.parent.hardware.gpsd()
 
 		self.running = True
 		self.connected = False
@@ -1801,10 +1747,10 @@ class GPS(GenericSystem):
 
 	def set_power(self, bool):
 		if bool:
-			subprocess.run(["../scripts/enable_gps.sh"], shell=True) #Enable GPSD and wake GPS
+			self.parent.hardware.run("../scripts/enable_gps.sh") #Enable GPSD and wake GPS
 			time.sleep(0.5)
 			try:
-				gpsd.connect()
+				self.gpsd.connect()
 				self.connected = True
 				self.status["power"] = int(self.connected)
 				return {"success": True, "status": self.status}
@@ -1814,7 +1760,7 @@ class GPS(GenericSystem):
 		else:
 			if self.status["power"]:
 				self.connected = False
-				subprocess.run(["../scripts/disable_gps.sh"], shell=True) #Disable GPS
+				self.parent.hardware.run("../scripts/disable_gps.sh") #Disable GPS
 				self.status["power"] = int(self.connected)
 				self.status["mode"] = 0
 				self.status["sats_visible"] = 0
@@ -1859,6 +1805,13 @@ class GPS(GenericSystem):
 
 		return grid_lon_sq + grid_lat_sq + grid_lon_field + grid_lat_field + grid_lon_subsq + grid_lat_subsq
 
+	def _to_mgrs(self, lat, lon):
+		#Older mgrs releases return bytes, newer ones str
+		reference = self.m.toMGRS(lat, lon)
+		if isinstance(reference, bytes):
+			reference = reference.decode('utf-8')
+		return reference
+
 	def _shutdown_thread(self):
 		self.running = False
 		self.connected = False
@@ -1868,7 +1821,7 @@ class GPS(GenericSystem):
 		while self.running:
 			while self.connected:
 
-				self.packet = gpsd.get_current() #this will continue to loop and grab EACH set of gpsd info to clear the buffer
+				self.packet = self.gpsd.get_current() #this will continue to loop and grab EACH set of gpsd info to clear the buffer
 				self.status["mode"] = self.packet.mode
 				self.status["sats_visible"] = self.packet.sats
 				self.status["sats_used"] = self.packet.sats_valid
@@ -1926,7 +1879,7 @@ class GPS(GenericSystem):
 					self.status["error_x"] = 0.0
 					self.status["error_y"] = 0.0
 
-					self.status["mgrs"] = self.m.toMGRS(self.packet.lat, self.packet.lon).decode('utf-8')
+					self.status["mgrs"] = self._to_mgrs(self.packet.lat, self.packet.lon)
 					self.status["grid"] = self.to_grid(self.packet.lat, self.packet.lon)
 					self.status["alt"] = 0.0
 					self.status["climb"] = 0.0
@@ -1946,7 +1899,7 @@ class GPS(GenericSystem):
 					self.status["error_x"] = float(self.packet.error["x"])
 					self.status["error_y"] = float(self.packet.error["y"])
 
-					self.status["mgrs"] = self.m.toMGRS(self.packet.lat, self.packet.lon).decode('utf-8')
+					self.status["mgrs"] = self._to_mgrs(self.packet.lat, self.packet.lon)
 					self.status["grid"] = self.to_grid(self.packet.lat, self.packet.lon)
 					self.status["alt"] = self.packet.alt
 					self.status["climb"] = self.packet.climb
@@ -1956,37 +1909,152 @@ class GPS(GenericSystem):
 			time.sleep(0.5)
 
 
-class Database():
+class Database(Configurable, Thread):
+
+	# Points are encoded to line protocol by the polling threads and queued, this thread writes them to InfluxDB in
+	# batches of i_batch_size, or every f_flush_interval seconds. A full queue drops points instead of blocking. Batches
+	# InfluxDB does not take are spooled to s_spool_dir and replayed i_replay_batch lines at a time once it is back, see
+	# telemetry.py
+
+	capabilities = ("get_status", "get_config", "set_config")
+	config_rules = {"i_batch_size": Rule(minimum=1), "f_flush_interval": Rule(minimum=0.1), "i_queue_size": Rule(minimum=1), \
+					"i_replay_batch": Rule(minimum=1), "f_db_timeout": Rule(minimum=0.1), "f_keepalive": Rule(minimum=0), \
+					"l_deadbands": Rule(validate=telemetry.parse_deadbands)}
+	DEADBAND_CONFIG = ("l_deadbands", "f_keepalive", "b_change_only")
 
 	def __init__(self, parent, config):
+		Thread.__init__(self)
 		self.parent = parent
 		self.config = config
 		self.name = self.config["s_id"]		
 
-		self.status = 	{
-							"active" : 1
-						}
-
+		self.status = VersionedDict({
+							"active" : 1,
+							"queued" : 0,
+							"written" : 0,
+							"dropped" : 0,
+							"failed" : 0,
+							"batches" : 0,
+							"spooled" : 0,
+							"replayed" : 0,
+							"discarded" : 0,
+							"spool_bytes" : 0,
+							"reachable" : 1,
+							"suppressed" : 0
+						})
+
+		self.queue = queue.Queue(maxsize=self.config["i_queue_size"])
+		self.dropped = 0
+		self.running = True
 
-		self.dbclient = InfluxDBClient(host=self.config["s_db_host"], port=self.config["i_db_port"], username=self.config["s_db_username"], password=self.config["s_db_password"], database=self.config["s_db_name"])
+		self.spool = telemetry.Spool(self.config["s_spool_dir"], self.config["i_spool_segment"], self.config["i_spool_max"])
+		self.breaker = telemetry.CircuitBreaker(self.config["f_breaker_backoff"], self.config["f_breaker_max_backoff"])
+		self.deadband = self._deadband()
 
+		from influxdb import InfluxDBClient
+		self.dbclient = InfluxDBClient(host=self.config["s_db_host"], port=self.config["i_db_port"], username=self.config["s_db_username"], password=self.config["s_db_password"], database=self.config["s_db_name"], \
+									   timeout=self.config["f_db_timeout"], retries=1)
 
 
+	def _deadband(self):
+		return telemetry.Deadband(self.config["l_deadbands"], self.config["f_keepalive"], self.config["b_change_only"])
 
+	def store_config(self, key, value):
+		result = Configurable.store_config(self, key, value)
+		if result["success"] and key in self.DEADBAND_CONFIG:
+			deadband = self._deadband()
+			deadband.suppressed = self.deadband.suppressed
+			self.deadband = deadband
+		return result
 
 	def dumpData(self, id, fields):
+		# Called from the polling threads, never blocks: the point is timestamped and encoded here, written later.
+		# Fields that stayed within their deadband are left out
+		timestamp = time.time_ns()
+		fields = self.deadband.filter(id, dict(fields), time.monotonic())
+		line = telemetry.encode_line(id, fields, timestamp)
+		if line is None:
+			return
 		try:
-			json_body = [{
-							"measurement": id,
-							"time": datetime.datetime.utcnow(),
-							"fields": fields
-						}]
-
-			self.dbclient.write_points(json_body)
-		except Exception as e:
-			print("Exception when writing data to database:" + str(e))
-
+			self.queue.put_nowait(line)
+		except queue.Full:
+			self.dropped += 1
+
+	def _next_batch(self):
+		batch = []
+		deadline = time.monotonic() + self.config["f_flush_interval"]
+		while len(batch) < self.config["i_batch_size"]:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0 or (not self.running and self.queue.empty()):
+				break
+			try:
+				batch.append(self.queue.get(timeout=min(remaining, 0.5)))
+			except queue.Empty:
+				continue
+		return batch
+
+	def _write_points(self, batch):
+		self.dbclient.write_points(batch, time_precision="n", protocol="line")
+		self.status["written"] += len(batch)
+		self.status["batches"] += 1
+
+	def _write(self, batch):
+		if self.breaker.allow():
+			try:
+				self._write_points(batch)
+				self.breaker.success()
+				return
+			except Exception as e:
+				self.breaker.failure()
+				self.status["failed"] += 1
+				print("Exception when writing data to database, spooling to {}: {}".format(self.config["s_spool_dir"], e))
+		try:
+			self.spool.append(batch)
+		except OSError as e:
+			self.dropped += len(batch)
+			print("Could not spool {} points: {}".format(len(batch), e))
+
+	def _replay(self):
+		# One batch per round so fresh points are not held up, the first one after a failure probes the database
+		if not self.breaker.allow() or not self.spool.pending():
+			return
+		# Errors of the spool files and of the database are told apart: a connection error is an OSError as well, and only
+		# a failing database opens the breaker
+		try:
+			batch = self.spool.peek(self.config["i_replay_batch"])
+		except OSError as e:
+			print("Could not read spooled points: {}".format(e))
+			return
+		if batch:
+			try:
+				self._write_points(batch)
+			except Exception as e:
+				self.breaker.failure()
+				self.status["failed"] += 1
+				print("Exception when replaying spooled points to database: {}".format(e))
+				return
+			self.breaker.success()
+		try:
+			self.spool.advance(len(batch))
+		except OSError as e:
+			print("Could not remove replayed points from the spool: {}".format(e))
 
+	def run(self):
+		while self.running or not self.queue.empty():
+			batch = self._next_batch()
+			if batch:
+				self._write(batch)
+			if self.running:
+				self._replay()
+			self.status["queued"] = self.queue.qsize()
+			self.status["dropped"] = self.dropped
+			self.status["spooled"] = self.spool.spooled
+			self.status["replayed"] = self.spool.replayed
+			self.status["discarded"] = self.spool.discarded
+			self.status["spool_bytes"] = self.spool.size()
+			self.status["reachable"] = int(not self.breaker.is_open())
+			self.status["suppressed"] = self.deadband.suppressed
+		self.spool.close()
 
 	def get_status(self):
 		return {"success": True, "status": self.status}
@@ -1994,48 +2062,16 @@ class Database():
 	def get_config(self):
 		return {"success": True, "config": self.config}
 
-
-	def set_config(self, key, value):
-		if key == "s_id":
-			return {"success": False, "message": "Modification of s_id is not allowed"}
-		else:
-			if key in self.config:
-				try:
-					type_tag = key[:2]
-					if type_tag == "s_":
-						new_value = value
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "f_":
-						new_value = float(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "b_":
-						if value.lower() in ["true", "True", "1", "yes", "false", "False", "0", "no"]:
-							new_value = int(self.parent.str2bool(value.lower()))
-							self.config[key] = new_value
-							return {"success": True, "config": self.config}
-						else:
-							return {"success": False, "message": "Value {} not valid boolean".format(value)}
-					elif type_tag == "i_":
-						new_value = int(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-					elif type_tag == "l_":
-						new_value = json.loads(value)
-						self.config[key] = new_value
-						return {"success": True, "config": self.config}
-
-				except Exception as e:
-					return {"success": False, "message": "Exception occurred: {}".format(str(e))}
-
-			else:
-				return {"success": False, "message": "Key {} not present in target configuration dict".format(key)}
-
+	def _shutdown_thread(self):
+		# Points still queued are written before the thread ends
+		self.running = False
+		self.join()
 
 
 class Bluetooth(GenericSystem):
 
+	capabilities = GenericSystem.capabilities + ("set_power", "toggle_power")
+
 	def __init__(self, parent, config):
 		Thread.__init__(self)
 		self.parent = parent
@@ -2045,14 +2081,14 @@ class Bluetooth(GenericSystem):
 		self.running = False
 		self.alive = True
 
-		self.status = 	{
+		self.status = VersionedDict({
 							"power" : 0,
 							"mac" : "",
 							"conn" : "",
 							"cmds" : 0
-						}
+						})
 
-		self.socket = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+		self.socket = self.parent.hardware.bluetooth_socket()
 		self.size = 1024
 
 		self.socket.bind((self.config["s_bt_mac"], self.config["i_socket_port"]))
@@ -2066,7 +2102,7 @@ class Bluetooth(GenericSystem):
 	def set_power(self, power):
 		try:
 			if power:
-				subprocess.run(["sudo systemctl start rfcomm; rfkill unblock bluetooth"], shell=True)
+				self.parent.hardware.run("sudo systemctl start rfcomm; rfkill unblock bluetooth")
 				
 				self.status["power"] = 1
 				self.running = True
@@ -2075,7 +2111,7 @@ class Bluetooth(GenericSystem):
 
 			else:
 				self.running = False
-				subprocess.run(["sudo systemctl stop rfcomm; rfkill block bluetooth"], shell=True)
+				self.parent.hardware.run("sudo systemctl stop rfcomm; rfkill block bluetooth")
 				self.status["power"] = 0
 
 				return {"success": True, "status": self.status}
@@ -2093,6 +2129,7 @@ class Bluetooth(GenericSystem):
 	def run(self):
 		while self.alive:
 			while self.running:
+				client = None
 				try:
 					client, address = self.socket.accept()
 					#print("Incoming connection from {CLI}".format(CLI=address))
@@ -2106,7 +2143,8 @@ class Bluetooth(GenericSystem):
 
 				except Exception as e:
 					#print("Client disconnected with error:{ERR}".format(ERR=e))
-					client.close()
+					if client:
+						client.close()
 					self.status["conn"] = ""
 					time.sleep(1)
 			time.sleep(1) #Idle at 1 Hz if not active
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# InfluxDB line protocol for the Database subsystem. Polling threads encode a point the moment they measured it, the
+# Database writer thread only ships the encoded lines in batches. Field types follow what write_points sent before
+# (int with an i suffix, float, bool, string), so the existing series keep their field types.
+#
+# While InfluxDB is unreachable, batches go to a Spool on disk instead and a CircuitBreaker keeps the writer from
+# paying a connection timeout per batch; the spool is replayed in large batches once the database answers again.
+# A Deadband filter drops fields which did not move since they were last written, before they are even encoded.
+
+import math
+import os
+import time
+from threading import Lock
+
+
+def _escape_key(value):
+	return str(value).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def _escape_measurement(value):
+	return str(value).replace("\\", "\\\\").replace(",", "\\,").replace(" ", "\\ ")
+
+
+def _field_value(value):
+	if isinstance(value, bool):
+		return "true" if value else "false"
+	if isinstance(value, int):
+		return "{}i".format(value)
+	if isinstance(value, float):
+		return repr(value) if math.isfinite(value) else None	# InfluxDB rejects NaN and infinities
+	return '"{}"'.format(str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+
+
+def encode_line(measurement, fields, timestamp):
+	"""Line protocol for one point, timestamp in nanoseconds. None when no field has a value"""
+	encoded = []
+	for key, value in fields.items():
+		if value is None:
+			continue
+		value = _field_value(value)
+		if value is not None:
+			encoded.append("{}={}".format(_escape_key(key), value))
+	if not encoded:
+		return None
+	return "{} {} {}".format(_escape_measurement(measurement), ",".join(encoded), timestamp)
+
+
+class Spool(object):
+	"""Append-only store of encoded lines on disk while InfluxDB cannot take them, in numbered segment files of about
+	segment_size bytes. Beyond max_bytes the oldest segments are deleted. Replayed lines may be written twice after a
+	crash, InfluxDB keeps one point per series and timestamp so that is harmless."""
+
+	def __init__(self, directory, segment_size, max_bytes):
+		self.directory = directory
+		self.segment_size = segment_size
+		self.max_bytes = max_bytes
+		os.makedirs(directory, exist_ok=True)
+
+		self.current = None	# file object of the segment being appended to
+		self.current_number = None
+		self.replay_offset = 0	# lines of the oldest segment already replayed
+		self.peeked = None	# number of the segment the batch peek returned ends, removed by advance
+		self.spooled = 0
+		self.replayed = 0
+		self.discarded = 0
+
+	def _path(self, number):
+		return os.path.join(self.directory, "{:08d}.lp".format(number))
+
+	def segments(self):
+		return sorted(int(name[:-3]) for name in os.listdir(self.directory) if name.endswith(".lp") and name[:-3].isdigit())
+
+	def size(self):
+		return sum(os.path.getsize(self._path(number)) for number in self.segments())
+
+	def pending(self):
+		return bool(self.segments())
+
+	def append(self, lines):
+		if self.current is None:
+			segments = self.segments()
+			self.current_number = segments[-1] + 1 if segments else 0
+			self.current = open(self._path(self.current_number), "ab")
+		self.current.write("".join("{}\n".format(line) for line in lines).encode('utf-8'))
+		self.current.flush()
+		os.fsync(self.current.fileno())
+		self.spooled += len(lines)
+		if self.current.tell() >= self.segment_size:
+			self.rotate()
+			self._enforce_cap()
+
+	def rotate(self):
+		if self.current is not None:
+			self.current.close()
+			self.current = None
+
+	def _enforce_cap(self):
+		segments = self.segments()
+		total = self.size()
+		while total > self.max_bytes and len(segments) > 1:
+			path = self._path(segments.pop(0))
+			with open(path, "rb") as f:
+				data = f.read()
+			self.discarded += data.count(b"\n") - self.replay_offset
+			self.replay_offset = 0
+			total -= len(data)
+			os.remove(path)
+
+	def peek(self, batch_size):
+		"""The next batch_size lines of the oldest segment, they stay spooled until advance"""
+		self.peeked = None
+		segments = self.segments()
+		if not segments:
+			return []
+		if segments[0] == self.current_number:
+			self.rotate()	# Only the segment still being appended to is left, closed so it can be replayed
+		with open(self._path(segments[0]), "rb") as f:
+			# A line cut short by a power loss has no newline, it is left out
+			lines = [line.decode('utf-8', errors='replace') for line in f.read().split(b"\n")[:-1]]
+		batch = lines[self.replay_offset:self.replay_offset + batch_size]
+		# The segment is done with once this batch is written
+		self.peeked = segments[0] if self.replay_offset + len(batch) >= len(lines) else None
+		return batch
+
+	def advance(self, count):
+		"""Drop the count lines peek returned, once they are written"""
+		self.replay_offset += count
+		self.replayed += count
+		if self.peeked is not None:
+			os.remove(self._path(self.peeked))
+			self.replay_offset = 0
+			self.peeked = None
+
+	def close(self):
+		self.rotate()
+
+
+class CircuitBreaker(object):
+	"""Stops calling a failing database: after a failure no attempt is made for backoff seconds, doubling up to
+	max_backoff while attempts keep failing. One successful attempt closes it again."""
+
+	def __init__(self, backoff, max_backoff):
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.delay = backoff
+		self.open_until = None
+
+	def allow(self):
+		return self.open_until is None or time.monotonic() >= self.open_until
+
+	def is_open(self):
+		return self.open_until is not None
+
+	def success(self):
+		self.open_until = None
+		self.delay = self.backoff
+
+	def failure(self):
+		if self.open_until is not None:
+			self.delay = min(self.delay * 2, self.max_backoff)
+		self.open_until = time.monotonic() + self.delay
+
+
+ABSOLUTE = "absolute"
+RELATIVE = "relative"
+KEEPALIVE = "keepalive"
+MISSING = object()
+
+
+def parse_deadbands(rules):
+	"""{"gps.alt": 2, "voltage": "rel:0.01", "gps.time_utc": "keepalive"} -> {key: (kind, band)}. A key is
+	measurement.field or a field of any measurement; a number is an absolute deadband, rel:F one of a fraction F of the
+	value last written (no % sign, config.ini would take it for interpolation) and keepalive only writes the field with
+	the keepalive point"""
+	if not isinstance(rules, dict):
+		raise ValueError("Deadbands must be a JSON object of field: deadband")
+	parsed = {}
+	for key, rule in rules.items():
+		if rule == KEEPALIVE:
+			parsed[key] = (KEEPALIVE, None)
+		elif isinstance(rule, str) and rule.startswith("rel:"):
+			parsed[key] = (RELATIVE, float(rule[4:]))
+		elif isinstance(rule, (int, float)) and not isinstance(rule, bool):
+			parsed[key] = (ABSOLUTE, float(rule))
+		else:
+			raise ValueError("Deadband {} of {} is not a number, rel:F or keepalive".format(rule, key))
+	return parsed
+
+
+class Deadband(object):
+	"""Change-only reporting: a field is written when it moved past its deadband since the value last written, other
+	fields changing at all, unless change_only is off. Every keepalive seconds a measurement is written with every
+	field, so a gap in the data still means the data was missing."""
+
+	def __init__(self, rules, keepalive, change_only=True):
+		self.rules = parse_deadbands(rules)
+		self.keepalive = keepalive
+		self.default = (ABSOLUTE, 0.0) if change_only else None
+		self.lock = Lock()
+
+		self.compiled = {}	# (measurement, field) -> rule, looked up once
+		self.written = {}	# measurement -> {field: value last written}
+		self.last_keepalive = {}	# measurement -> monotonic time of the last point with every field
+		self.suppressed = 0
+
+	def _rule(self, measurement, field):
+		rule = self.compiled.get((measurement, field), MISSING)
+		if rule is MISSING:
+			rule = self.rules.get("{}.{}".format(measurement, field), self.rules.get(field, self.default))
+			self.compiled[(measurement, field)] = rule
+		return rule
+
+	@staticmethod
+	def _moved(rule, previous, value):
+		if rule is None or previous is MISSING:
+			return True
+		kind, band = rule
+		if kind == KEEPALIVE:
+			return False
+		numbers = isinstance(value, (int, float)) and isinstance(previous, (int, float)) and \
+				  not isinstance(value, bool) and not isinstance(previous, bool)
+		if not numbers:
+			return value != previous
+		change = abs(value - previous)
+		if kind == RELATIVE:
+			return change > band * abs(previous) or (previous == 0 and change > 0)
+		return change > band
+
+	def filter(self, measurement, fields, now):
+		"""The fields of a point worth writing, empty when nothing moved"""
+		with self.lock:
+			written = self.written.setdefault(measurement, {})
+			if now - self.last_keepalive.get(measurement, float("-inf")) >= self.keepalive:
+				self.last_keepalive[measurement] = now
+				written.update(fields)
+				return fields
+			moved = {}
+			for field, value in fields.items():
+				if self._moved(self._rule(measurement, field), written.get(field, MISSING), value):
+					moved[field] = value
+					written[field] = value
+			self.suppressed += len(fields) - len(moved)
+			return moved
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+# Last known status across server restarts. Subsystems list the status keys holding slow measurements in warm_status
+# (battery level, GPS fix, temperatures); those are saved to a small JSON file every few seconds while they change and
+# restored right after construction, marked stale since the time they were last known. The polling threads then
+# replace them one by one with fresh readings, so clients see useful values straight after a reboot instead of zeros.
+
+import json
+import os
+import time
+from threading import Event, Thread
+
+import state
+
+FORMAT = 1
+
+
+class WarmStartCache(Thread):
+
+	def __init__(self, server, path, period):
+		Thread.__init__(self, name="warmstart")
+		self.server = server
+		self.path = path
+		self.period = period
+
+		self.version = None
+		self.saved = None	# warm values in the file, the file is only rewritten when they change
+		self.stopped = Event()
+
+	def _warm_systems(self):
+		return [system for system in self.server.systems if getattr(system, "warm_status", ())]
+
+	def _warm_values(self):
+		values = {}
+		for system in self._warm_systems():
+			status = dict(system.status)
+			values[system.config["s_id"]] = {key: status[key] for key in system.warm_status if key in status}
+		return values
+
+	def restore(self):
+		"""Load the last saved values into the status of every subsystem still listing them in warm_status"""
+		try:
+			with open(self.path) as f:
+				cache = json.load(f)
+		except (OSError, ValueError):
+			return 0	# First boot, or a cache cut short by a power loss
+		if cache.get("format") != FORMAT:
+			return 0
+
+		restored = 0
+		for system in self._warm_systems():
+			values = cache["systems"].get(system.config["s_id"], {})
+			values = {key: tuple(value) for key, value in values.items() if key in system.warm_status}
+			if values:
+				system.status.restore(values)
+				restored += len(values)
+		self.saved = self._warm_values()
+		return restored
+
+	def save(self):
+		saved = time.time()
+		values = self._warm_values()
+		systems = {}
+		for system in self._warm_systems():
+			# Values nobody measured since they were restored keep the time they were really measured
+			stale = dict(system.status.stale)
+			systems[system.config["s_id"]] = {key: [value, stale.get(key, saved)] for key, value in values[system.config["s_id"]].items()}
+
+		directory = os.path.dirname(self.path)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		# Written next to the cache and renamed over it, a reader never sees half a file
+		temporary = "{}.tmp".format(self.path)
+		with open(temporary, "w") as f:
+			json.dump({"format": FORMAT, "systems": systems}, f, separators=(",", ":"), default=str)
+		os.replace(temporary, self.path)
+		self.saved = values
+
+	def run(self):
+		while not self.stopped.wait(self.period):
+			# The version moves with every status change (the clock alone every second), the SD card is only
+			# written when a warm value changed
+			version = state.current_version()
+			if version == self.version:
+				continue
+			self.version = version
+			if self._warm_values() == self.saved:
+				continue
+			try:
+				self.save()
+			except OSError as e:
+				print("Could not save warm start cache: {}".format(e))
+
+	def _shutdown_thread(self):
+		self.stopped.set()
+		self.join()
+		if self._warm_values() == self.saved:
+			return
+		try:
+			self.save()
+		except OSError as e:
+			print("Could not save warm start cache: {}".format(e))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Tom Mladenov'
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from state import VersionedDict
+import systems
+import telemetry
+
+
+class FailingClient(object):
+	"""Stands in for the InfluxDB client, raising what requests raises for an unreachable host until it is back up"""
+
+	def __init__(self):
+		self.up = False
+		self.written = []
+
+	def write_points(self, batch, **kwargs):
+		if not self.up:
+			raise ConnectionError("Connection refused")
+		self.written += batch
+
+
+def database(directory):
+	# Database without its constructor, which connects to InfluxDB
+	db = systems.Database.__new__(systems.Database)
+	db.config = {"i_replay_batch": 2}
+	db.status = VersionedDict({"written": 0, "failed": 0, "batches": 0})
+	db.spool = telemetry.Spool(directory, segment_size=1 << 20, max_bytes=1 << 24)
+	db.breaker = telemetry.CircuitBreaker(backoff=60, max_backoff=600)
+	db.dbclient = FailingClient()
+	return db
+
+
+def test_peek_keeps_lines_spooled_until_advance(tmp_path):
+	spool = telemetry.Spool(str(tmp_path), segment_size=1 << 20, max_bytes=1 << 24)
+	spool.append(["a 1", "b 2", "c 3"])
+
+	assert spool.peek(2) == ["a 1", "b 2"]
+	assert spool.peek(2) == ["a 1", "b 2"]
+	assert spool.pending() and spool.replayed == 0
+
+	spool.advance(2)
+	assert spool.peek(2) == ["c 3"]
+	spool.advance(1)
+	assert spool.replayed == 3
+	assert not spool.pending()
+
+
+def test_replay_opens_breaker_on_connection_errors(tmp_path):
+	db = database(str(tmp_path))
+	db.spool.append(["a 1", "b 2", "c 3"])
+
+	# A connection error is an OSError, it still has to count as a failing database
+	db._replay()
+	assert db.breaker.is_open() and not db.breaker.allow()
+	assert db.status["failed"] == 1
+	assert db.spool.pending() and db.spool.replayed == 0
+
+	db._replay()	# Not retried while the breaker is open
+	assert db.status["failed"] == 1
+
+	db.dbclient.up = True
+	db.breaker.open_until = 0
+	db._replay()
+	assert not db.breaker.is_open()
+	db._replay()
+	assert db.dbclient.written == ["a 1", "b 2", "c 3"]
+	assert db.status["written"] == 3
+	assert not db.spool.pending()